@@ -0,0 +1,164 @@
+"""In-process TTL/LRU cache for AniList GraphQL responses"""
+
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+
+# First root field of the query, ie. 'Staff' in: query ($id: Int) { Staff(id: $id) { ...
+ROOT_FIELD_RE = re.compile(r'\{\s*(\w+)')
+# What a Page query is actually listing
+PAGE_FIELD_RE = re.compile(r'\b(staff|media|mediaList|characters)\s*\(')
+
+# Seconds to keep each kind of response. 0 means never cache it, user lists have to be fresh.
+DEFAULT_TTLS = {
+    'Staff': 60 * 60,
+    'Media': 60 * 60,
+    'Page.staff': 10 * 60,
+    'Page.media': 10 * 60,
+    'Page.mediaList': 0,
+    'MediaListCollection': 0,
+    'User': 5 * 60,
+}
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def query_name(query):
+    """Short name for a query based on its root field, ie. 'Staff' or 'Page.media'"""
+
+    match = ROOT_FIELD_RE.search(query)
+    if not match:
+        return 'unknown'
+
+    name = match.group(1)
+    if name == 'Page':
+        inner = PAGE_FIELD_RE.search(query, match.end())
+        if inner:
+            name = f'Page.{inner.group(1)}'
+    return name
+
+
+def cache_key(query, variables):
+    """Hash of the query and variables, ignoring whitespace and variable order"""
+
+    normalized_query = ' '.join(query.split())
+    normalized_variables = json.dumps(variables or {}, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(f'{normalized_query}\n{normalized_variables}'.encode('utf-8')).hexdigest()
+
+
+class ResponseCache(object):
+    """LRU cache of raw response bodies with a TTL per query name.
+
+    Bodies are stored as the JSON text AniList sent, so every hit hands back a fresh copy the
+    caller is free to modify, and the size cap is measured in real bytes.
+    """
+
+    def __init__(self, max_entries=2000, max_bytes=64 * 1024 * 1024, ttls=None, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def ttl_for(self, name):
+        return self.ttls.get(name, 0)
+
+    def get(self, key):
+        """Parsed response for `key`, None on a miss"""
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                metrics.record_cache('anilist', 'miss')
+                return None
+
+            expires_at, body = entry
+            if expires_at <= self.clock():
+                self._remove(key)
+                self.misses += 1
+                metrics.record_cache('anilist', 'stale')
+                return None
+
+            # Most recently used goes to the end, eviction takes from the front
+            self.entries.move_to_end(key)
+            self.hits += 1
+        metrics.record_cache('anilist', 'hit')
+
+        return json.loads(body)
+
+    def set(self, key, name, body):
+        """Store the response text for `key` if queries called `name` are cacheable"""
+
+        ttl = self.ttl_for(name)
+        if ttl <= 0 or len(body) > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = (self.clock() + ttl, body)
+            self.size += len(body)
+
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        expires_at, body = self.entries.pop(key)
+        self.size -= len(body)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.size,
+            }
+
+
+def get_response_cache(app):
+    """Grab the process wide response cache, creating it on first use"""
+    global _cache
+
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache(
+                    max_entries=app.config.get('ANILIST_CACHE_MAX_ENTRIES', 2000),
+                    max_bytes=app.config.get('ANILIST_CACHE_MAX_BYTES', 64 * 1024 * 1024),
+                    ttls=app.config.get('ANILIST_CACHE_TTLS'),
+                )
+    return _cache
+
+
+def reset_response_cache():
+    """Drop the process wide response cache (next request builds a fresh one)"""
+    global _cache
+
+    with _cache_lock:
+        _cache = None
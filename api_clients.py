@@ -1,97 +1,477 @@
 from flask import flash
-import requests, json
+from requests.adapters import HTTPAdapter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from rate_limiter import get_scheduler, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from api_cache import get_response_cache, cache_key, query_name, ROOT_FIELD_RE
+from singleflight import SingleFlight
+from logs import lazy
+import metrics
+import requests, json, logging, re, threading, time
+
+
+# Log categories, see logs.py. Cache hits get their own, there's one for every cached lookup.
+log = logging.getLogger('onsei.anilist')
+cache_log = logging.getLogger('onsei.anilist.cache')
 
+# Default AniList GraphQL endpoint, can be overridden with ANILIST_API_URL in config
+ANILIST_API_URL = 'https://graphql.anilist.co'
 
-def make_api_request(query, variables, app):
+# Shared HTTP session for every AniList call. Reusing one pooled, keep-alive session means
+# a 20 page characterMedia walk does one TCP+TLS handshake instead of 20.
+_session = None
+_session_lock = threading.Lock()
+
+# Shared worker pool for fetching pages in parallel. It's module level so the total number of
+# in-flight AniList requests stays bounded no matter how many views are paginating at once.
+_page_executor = None
+
+# Header and body of a single query document, ie. 'query GetVA($page: Int) {' + selection + '}'
+OPERATION_RE = re.compile(r'^\s*query\b\s*\w*\s*(?:\(([^)]*)\))?\s*\{(.*)\}\s*$', re.S)
+VARIABLE_RE = re.compile(r'\$(\w+)')
+# Alias at the start of every query in a batch document, see build_batch_query
+BATCH_ALIAS_RE = re.compile(r'^(q\d+): ', re.M)
+# Pages past this share one label in the metrics, a 200 page walk shouldn't make 200 series
+MAX_PAGE_LABEL = 10
+
+# Identical calls already on their way to AniList are shared instead of sent again. Requests and
+# whole pagination walks get separate groups, a walk's key is the same as its own page 1 request.
+_request_flights = SingleFlight()
+_pagination_flights = SingleFlight()
+
+
+def build_session(pool_size=10):
+    """Build a requests Session with a keep-alive connection pool and gzip enabled"""
+
+    session = requests.Session()
+
+    # pool_maxsize is how many connections we keep open per host, so size it to the
+    # number of threads that can hit AniList at the same time.
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    session.headers.update({
+        'Content-Type': 'application/json',
+        'Accept': 'application/json',
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive',
+    })
+    return session
+
+
+def get_session(app):
+    """Grab the module level pooled session, creating it on first use"""
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            # Check again inside the lock in case another thread beat us here
+            if _session is None:
+                _session = build_session(app.config.get('ANILIST_POOL_SIZE', 10))
+    return _session
+
+
+def get_page_executor(app):
+    """Grab the module level page worker pool, creating it on first use"""
+    global _page_executor
+
+    if _page_executor is None:
+        with _session_lock:
+            if _page_executor is None:
+                _page_executor = ThreadPoolExecutor(
+                    max_workers=app.config.get('ANILIST_PAGE_WORKERS', 8),
+                    thread_name_prefix='anilist-page',
+                )
+    return _page_executor
+
+
+def reset_session():
+    """Close and drop the pooled session and page workers (next request builds fresh ones)"""
+    global _session, _page_executor
+
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+        if _page_executor is not None:
+            _page_executor.shutdown(wait=True)
+        _page_executor = None
+
+
+def make_api_request(query, variables, app, priority=PRIORITY_INTERACTIVE):
+
+    # Serve repeat lookups from the response cache without touching the network
+    cache = get_response_cache(app)
+    key = cache_key(query, variables)
+    cached = cache.get(key)
+
+    if cached is not None:
+        cache_log.debug('API request served from cache: %s', key)
+        return cached
+
+    # If the same request is already in flight, wait for its answer instead of sending another
+    return _request_flights.do(key, lambda: _send_request(query, variables, app, priority, cache, key))
+
+
+def _send_request(query, variables, app, priority, cache, key):
+    """Send a request to AniList (through the rate limit scheduler) and cache a clean answer"""
 
     # Set the GraphQL endpoint URL
-    anilist_api_url = 'https://graphql.anilist.co'
+    anilist_api_url = app.config.get('ANILIST_API_URL', ANILIST_API_URL)
 
-    # Set the request headers
-    anilist_api_headers = {'Content-Type': 'application/json'}
+    # Hard (connect, read) timeout so a stalled upstream can't hang a worker forever
+    timeout = (app.config.get('ANILIST_CONNECT_TIMEOUT', 3.05), app.config.get('ANILIST_READ_TIMEOUT', 10))
 
-    # log the request details
-    app.logger.debug(f"**************************************")
-    app.logger.debug(f"**************************************")
-    app.logger.debug(f"API request: {query}, {variables}")
+    # Every request waits its turn in the rate limit scheduler
+    scheduler = get_scheduler(app)
 
-    response = requests.post(anilist_api_url, json={'query': query, 'variables': variables}, headers=anilist_api_headers)
+    # Query name and page for the metrics and the log, not the whole query text
+    name, page, pages = describe_request(query, variables)
+    log.debug('API request %s page %s', name, page or '-', extra={'query': name, 'page': page, 'variables': variables})
 
-    # log the response
-    app.logger.debug(f"API response: {response}")
-    app.logger.debug(f"**************************************")
-    app.logger.debug(f"**************************************")
+    # A 429 means we wait out Retry-After and go again, rather than dropping the page
+    for attempt in range(app.config.get('ANILIST_MAX_RETRIES', 3) + 1):
+        if not scheduler.acquire(priority, timeout=app.config.get('ANILIST_QUEUE_TIMEOUT', 30)):
+            log.warning('API request %s timed out waiting for the rate limit', name)
+            return None
+
+        started = time.perf_counter()
+        try:
+            response = get_session(app).post(anilist_api_url, json={'query': query, 'variables': variables}, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            metrics.record_upstream(name, page, 'error', started, pages)
+            log.warning('API request %s failed: %s', name, e, extra={'query': name, 'page': page})
+            return None
+
+        metrics.record_upstream(name, page, response.status_code, started, pages)
+        scheduler.update(response.status_code, response.headers)
+
+        if response.status_code != 429:
+            break
+        log.info('API request %s rate limited, Retry-After: %s', name, response.headers.get('Retry-After'))
+
+    log.debug('API response %s page %s: %s in %.0fms', name, page or '-', response.status_code,
+              response.elapsed.total_seconds() * 1000, extra={'query': name, 'page': page, 'status': response.status_code})
 
     if response.status_code == 200:
-        return response.json()
+        data = response.json()
+        # Only keep clean answers, a 200 can still carry GraphQL errors
+        if 'errors' not in data:
+            cache.set(key, query_name(query), response.text)
+        return data
     elif response.status_code == 404:
-        app.logger.debug('MAKE API REQUEST returned 404 status code: %s', response.status_code)
-        app.logger.debug('Response: %s', response.text)
+        log.debug('API request %s returned 404: %s', name, lazy(lambda: response.text))
         return response.json()  # return the JSON response even though the status was 404
     else:
-        app.logger.debug('MAKE API REQUEST Failed with status code: %s', response.status_code)
-        app.logger.debug('Response: %s', response.text)
+        log.warning('API request %s failed with status code %s: %s', name, response.status_code, lazy(lambda: response.text))
         return None
 
 
-def search_voice_actors(search_query, app):
-    """Fetch all voice actors based on search query"""
+def describe_request(query, variables):
+    """(query name, page label, pages asked for) of a request for metrics.py, batches included.
 
-    graphql_query = '''
-    query ($page: Int, $perPage: Int, $search: String) {
-        Page(page: $page, perPage: $perPage) {
-            pageInfo {
-                total
-                currentPage
-                lastPage
-                hasNextPage
-                perPage
-            }
-            staff(search: $search) {
-                id
-                name {
-                    first
-                    last
-                    full
-                }
-                image {
-                    large
-                    medium
-                }
-                characters (perPage: 3) {
-                    nodes {
-                        name {
-                            full
-                        }
-                        image {
-                            medium
-                        }
-                        media {
-                            nodes {
-                            id
-                                title {
-                                    romaji
-                                    english
-                                    userPreferred
-                                }
-                                coverImage {
-                                    medium
-                                    color
-                                } 
-                                meanScore
-                                popularity
-                                trending
-                                favourites
-                            }
-                        }
-                    }
-                }
+    A batch is named after its first query, ie. 'Page.staff', and labelled with its first page.
+    """
+
+    aliases = BATCH_ALIAS_RE.findall(query)
+    if aliases:
+        name = query_name(BATCH_ALIAS_RE.sub('', query))
+        page = variables.get(f'{aliases[0]}_page')
+    else:
+        name = query_name(query)
+        page = variables.get('page')
+
+    if page is None:
+        page_label = ''
+    else:
+        page_label = str(page) if page <= MAX_PAGE_LABEL else f'{MAX_PAGE_LABEL + 1}+'
+    return name, page_label, len(aliases) or 1
+
+
+def alias_query(alias, query):
+    """Rename a single root field query for alias, returns (variable definitions, selection).
+
+    'query ($id: Int) { Staff(id: $id) { ... } }' becomes '$q0_id: Int' and
+    'q0: Staff(id: $q0_id) { ... }', so several can share one document without clashing.
+    """
+
+    match = OPERATION_RE.match(query)
+    definitions, selection = match.group(1) or '', match.group(2)
+
+    rename = lambda variable: f'${alias}_{variable.group(1)}'
+    return VARIABLE_RE.sub(rename, definitions).strip(), f'{alias}: ' + VARIABLE_RE.sub(rename, selection.strip())
+
+
+def build_batch_query(parts):
+    """Combine [(alias, query, variables), ...] into one aliased GraphQL document and its variables"""
+
+    definitions = []
+    selections = []
+    batch_variables = {}
+
+    for alias, query, variables in parts:
+        part_definitions, selection = alias_query(alias, query)
+        if part_definitions:
+            definitions.append(part_definitions)
+        selections.append(selection)
+        batch_variables.update({f'{alias}_{name}': value for name, value in variables.items()})
+
+    header = f"query ({', '.join(definitions)})" if definitions else 'query'
+    return header + ' {\n' + '\n'.join(selections) + '\n}', batch_variables
+
+
+def make_batch_request(parts, app, priority=PRIORITY_INTERACTIVE):
+    """Run several single root field queries in one POST. parts is [(query, variables), ...].
+
+    Returns one response per part, shaped like make_api_request's ({'data': {'Staff': ...}}),
+    or None for a part AniList didn't answer. Parts already in the response cache aren't sent,
+    and every part that comes back clean is cached under its own key, so a batch and the plain
+    make_api_request for the same query and variables share cache entries.
+    """
+
+    cache = get_response_cache(app)
+    responses = [cache.get(cache_key(query, variables)) for query, variables in parts]
+    missing = [i for i, response in enumerate(responses) if response is None]
+
+    if len(missing) <= 1:
+        for i in missing:
+            responses[i] = make_api_request(*parts[i], app, priority)
+        return responses
+
+    batch_query, batch_variables = build_batch_query([(f'q{i}', *parts[i]) for i in missing])
+    log.debug('API batch request: %s queries in one POST', len(missing))
+    response = make_api_request(batch_query, batch_variables, app, priority)
+
+    if response is None:
+        return responses
+
+    data = response.get('data') or {}
+    # Errors carry the alias as the first element of their path
+    errored = {error['path'][0] for error in response.get('errors') or [] if error.get('path')}
+
+    for i in missing:
+        query, variables = parts[i]
+        alias = f'q{i}'
+        if data.get(alias) is None:
+            continue
+
+        responses[i] = {'data': {ROOT_FIELD_RE.search(query).group(1): data[alias]}}
+        if alias not in errored:
+            cache.set(cache_key(query, variables), query_name(query), json.dumps(responses[i]))
+
+    return responses
+
+
+class IncompleteList(list):
+    """The items of a paginated walk that stopped at a failed page.
+
+    Still a list, so it can be shown as far as it goes, but it isn't the whole thing and
+    mustn't be stored as if it were (see CachedDocumentMixin.get_or_fetch).
+    """
+
+    incomplete = True
+
+
+def fetch_all_pages(query, variables, app, get_connection, items_key, priority=PRIORITY_INTERACTIVE):
+    """Fetch every page of a paginated query and return all the items in page order.
+
+    Page 1 is fetched first to read pageInfo.lastPage, then the remaining pages are fetched
+    in parallel on the shared worker pool. get_connection pulls the paginated object (the one
+    holding pageInfo) out of a response, items_key is the list inside it (edges, staff, media).
+
+    Returns None if the first page fails. If a later page fails we stop there and return the
+    pages before it as an IncompleteList.
+
+    Concurrent walks of the same list share one walk, so 50 people opening the same VA at once
+    cost one sequence of page requests.
+    """
+
+    # Pool threads have no app context, so make sure we're holding the real app and not current_app
+    app = app._get_current_object() if hasattr(app, '_get_current_object') else app
+
+    return _pagination_flights.do(
+        cache_key(query, variables),
+        lambda: _walk_pages(query, variables, app, get_connection, items_key, priority),
+    )
+
+
+def _walk_pages(query, variables, app, get_connection, items_key, priority):
+    """Page 1, then the rest in parallel, see fetch_all_pages"""
+
+    response = make_api_request(query, variables, app, priority)
+
+    if response is None:
+        return None
+
+    connection = get_connection(response)
+    all_items = list(connection[items_key])
+    page_info = connection['pageInfo']
+    page = variables.get('page', 1)
+
+    if not page_info['hasNextPage']:
+        return all_items
+
+    # Fan out for every page we know about
+    last_page = page_info.get('lastPage') or page
+    remaining_pages = range(page + 1, last_page + 1)
+    log.debug('Fetching pages %s-%s in parallel', page + 1, last_page)
+
+    executor = get_page_executor(app)
+    # bind_request so the pool's pages count toward the request that asked for them
+    fetch = metrics.bind_request(make_api_request)
+    responses = executor.map(lambda p: fetch(query, dict(variables, page=p), app, priority), remaining_pages)
+
+    # Reassemble in page order
+    for page, response in zip(remaining_pages, responses):
+        if response is None:
+            log.warning('Page %s failed, stopping at %s pages', page, page - 1)
+            return IncompleteList(all_items)
+        connection = get_connection(response)
+        all_items.extend(connection[items_key])
+
+    # lastPage can undercount when the list grows between calls, walk anything left serially
+    while connection['pageInfo']['hasNextPage']:
+        page += 1
+        log.debug('Page %s is past lastPage, requesting it too', page)
+        response = make_api_request(query, dict(variables, page=page), app, priority)
+
+        if response is None:
+            log.warning('Page %s failed, stopping at %s pages', page, page - 1)
+            return IncompleteList(all_items)
+        connection = get_connection(response)
+        all_items.extend(connection[items_key])
+
+    return all_items
+
+
+def iter_pages(query, variables, app, get_connection, items_key, priority=PRIORITY_INTERACTIVE):
+    """Yield the items of every page of a paginated query, in page order, as each page comes in.
+
+    Streaming version of fetch_all_pages. After page 1, up to ANILIST_PAGE_WORKERS pages are
+    fetched ahead on the shared worker pool, so that's the most held in memory at once. Yields
+    nothing if page 1 fails and stops at the first later page that fails.
+    """
+
+    # Pool threads have no app context, so make sure we're holding the real app and not current_app
+    app = app._get_current_object() if hasattr(app, '_get_current_object') else app
+
+    response = make_api_request(query, variables, app, priority)
+
+    if response is None:
+        return
+
+    connection = get_connection(response)
+    yield connection[items_key]
+
+    page = variables.get('page', 1)
+    last_page = connection['pageInfo'].get('lastPage') or page
+    next_page = page + 1
+
+    executor = get_page_executor(app)
+    window = app.config.get('ANILIST_PAGE_WORKERS', 8)
+    pending = deque()
+    fetch = metrics.bind_request(make_api_request)
+
+    try:
+        while next_page <= last_page or pending:
+            # Keep the window full, pages come back out in the order they went in
+            while next_page <= last_page and len(pending) < window:
+                pending.append(executor.submit(fetch, query, dict(variables, page=next_page), app, priority))
+                next_page += 1
+
+            response = pending.popleft().result()
+            page += 1
+
+            if response is None:
+                log.warning('Streamed page %s failed, stopping at %s pages', page, page - 1)
+                return
+            connection = get_connection(response)
+            yield connection[items_key]
+    finally:
+        # The client went away mid stream, don't fetch pages nobody will read
+        for future in pending:
+            future.cancel()
+
+    # lastPage can undercount when the list grows between calls, walk anything left serially
+    while connection['pageInfo']['hasNextPage']:
+        page += 1
+        response = make_api_request(query, dict(variables, page=page), app, priority)
+
+        if response is None:
+            log.warning('Streamed page %s failed, stopping at %s pages', page, page - 1)
+            return
+        connection = get_connection(response)
+        yield connection[items_key]
+
+
+def fetch_page(query, variables, app, get_connection, items_key, priority=PRIORITY_INTERACTIVE):
+    """Fetch the single page of a paginated query named by variables['page'].
+
+    Returns (items, next_page), next_page is None on the last page. (None, None) if it failed.
+    """
+
+    response = make_api_request(query, variables, app, priority)
+
+    if response is None or not response.get('data'):
+        return None, None
+
+    connection = get_connection(response)
+    next_page = variables['page'] + 1 if connection['pageInfo']['hasNextPage'] else None
+    return connection[items_key], next_page
+
+
+def search_response(items_key, items, next_page=None):
+    """Wrap search results the way the search routes expect them, items is None if the search failed.
+
+    next_page is the page to ask for to load more results, None when there aren't any.
+    """
+
+    if items is not None:
+        return {
+            "data": {
+                "status_code": 200,
+                items_key: items,
+                "next_page": next_page,
             }
         }
+
+    # If the response is None, return a dictionary with a status_code key
+    return {
+        "data": {
+            "status_code": 500,
+            items_key: [],
+            "next_page": None,
+        }
     }
-    '''
 
-    graphql_query3 = '''
+
+def anime_list_from_response(response, app):
+    """Turn a MediaListCollection response into {mediaId: {'status': .., 'score': ..}}"""
+
+    all_series = {}
+
+    if response is not None:
+        lists = response['data']['MediaListCollection']['lists']
+
+        # Combine all entries from all lists
+        for lst in lists:
+            log.debug('%s length: %s', lst['name'], len(lst['entries']))
+            for entry in lst['entries']:
+                all_series[entry['mediaId']] = {
+                    'status': entry['status'],
+                    'score': entry['score'],
+                    'updatedAt': entry.get('updatedAt'),
+                }
+
+        log.debug('User list has %s series', len(all_series))
+
+    return all_series
+
+
+# Voice actor search, each VA with their 6 most favourited characters
+VA_SEARCH_QUERY = '''
     query GetVA($page: Int, $perPage: Int, $search: String) {
 		Page(page: $page, perPage: $perPage) {
 			pageInfo {
@@ -125,71 +505,37 @@ def search_voice_actors(search_query, app):
 			}
 		}
     }
-    '''
-    # media(sort: FAVOURITES_DESC) {
-    #     nodes {
-    #         id
-    #         title {
-    #             english
-    #             romaji
-    #         }
-    #         type
-    #         favourites
-    #     }
-    # }
+'''
+
+
+def search_voice_actors(search_query, app, page=None):
+    """Fetch voice actors based on search query, every page of them or just the one page asked for.
+
+    With page the result's next_page says which page to ask for next, see search_response.
+    """
 
     # Variables for the GraphQL query
     variables = {
         'search': search_query,
-        'page': 1,
+        'page': page or 1,
         'perPage': 50
     }
 
-    # Make the initial API request
-    response = make_api_request(graphql_query3, variables, app)
+    # Only the page the user is looking at
+    if page is not None:
+        staff, next_page = fetch_page(VA_SEARCH_QUERY, variables, app, lambda response: response['data']['Page'], 'staff')
+        return search_response('va', staff, next_page)
 
-    app.logger.debug(f'*** SEARCH VOICE ACTORS: {search_query} ***')
+    # Fetch every page of results
+    all_staff = fetch_all_pages(VA_SEARCH_QUERY, variables, app, lambda response: response['data']['Page'], 'staff')
 
-    if response is not None:
-        app.logger.debug('***** RESPONSE IS NOT NONE *****')
-        search_staff = response['data']['Page']
-        all_staff = search_staff['staff']
-
-        # Fetch additional pages if available
-        while search_staff['pageInfo']['hasNextPage']:
-            app.logger.debug("*** NEXT PAGE AVAIL, +1 PAGE AND REQUEST API AGAIN ***")
-            variables['page'] += 1
-            app.logger.debug(f"*** PAGE {variables['page']} OF {search_staff['pageInfo']['total']} ***")
-            response = make_api_request(graphql_query, variables, app)
-
-            if response is not None:
-                app.logger.debug('*** RESPONSE WORKED, EXTEND all_staff ***')
-                search_staff = response['data']['Page']
-                all_staff.extend(search_staff['staff'])
-            else:
-                break
-
-        response_data = {
-            "data": {
-                "status_code": 200,
-                "va": all_staff,
-            }
-        }
-        return response_data
+    log.debug('Search voice actors: %s', search_query)
 
-    # If the response is None, return a dictionary with a status_code key
-    return {
-        "data": {
-            "status_code": response.status_code if response else 500,
-            "va": [],
-        }
-    }
+    return search_response('va', all_staff)
 
-def fetch_all_character_media(va_id, app):
-    """Fetch all characterMedia series for a VA based on ID."""
 
-    # GraphQL query to fetch characterMedia by staff ID
-    graphql_query = '''
+# Every series + character a VA has played, paginated by characterMedia
+CHARACTER_MEDIA_QUERY = '''
     query ($id: Int, $page: Int, $perPage: Int) {
         Staff(id: $id) {
             characterMedia(page: $page, perPage: $perPage) {
@@ -235,7 +581,11 @@ def fetch_all_character_media(va_id, app):
             }
         }
     }
-    '''
+'''
+
+
+def fetch_all_character_media(va_id, app):
+    """Fetch all characterMedia series for a VA based on ID."""
 
     # Variables for the GraphQL query
     variables = {
@@ -244,47 +594,82 @@ def fetch_all_character_media(va_id, app):
         'perPage': 25
     }
 
-    # Make the initial API request
-    response = make_api_request(graphql_query, variables, app)
+    # Fetch every page of characterMedia
+    all_series = fetch_all_pages(CHARACTER_MEDIA_QUERY, variables, app, lambda response: response['data']['Staff']['characterMedia'], 'edges')
 
+    log.debug('Fetch all character media: %s', va_id)
 
-    app.logger.debug(f'*** FETCH ALL CHARACTER MEDIA: {va_id} ***')
+    return all_series if all_series is not None else []
 
-    if response is not None:
-        app.logger.debug('***** RESPONSE IS NOT NONE *****')
-        character_media = response['data']['Staff']['characterMedia']
-        all_series = character_media['edges']
 
-        # Fetch additional pages if available
-        while character_media['pageInfo']['hasNextPage']:
-            app.logger.debug("*** NEXT PAGE AVAIL, +1 PAGE AND REQUEST API AGAIN ***")
-            variables['page'] += 1
-            app.logger.debug(f"*** PAGE {variables['page']} OF {character_media['pageInfo']['total']} ***")
-            response = make_api_request(graphql_query, variables, app)
+def iter_character_media_pages(va_id, app):
+    """Yield a VA's characterMedia edges a page at a time, see iter_pages"""
+
+    variables = {
+        'id': va_id,
+        'page': 1,
+        'perPage': 25
+    }
+
+    return iter_pages(CHARACTER_MEDIA_QUERY, variables, app, lambda response: response['data']['Staff']['characterMedia'], 'edges')
 
-            #print(f'@@@@ REQUESTED PAGE {variables['page']} OF {character_media['pageInfo']['total']} @@@@')
 
-            if response is not None:
 
-                app.logger.debug('*** RESPONSE WORKED, EXTEND all_series ***')
-                character_media = response['data']['Staff']['characterMedia']
-                #app.logger.debug('EXTENSION: ', character_media['edges'])
-                all_series.extend(character_media['edges'])
-            else:
-                break
+# Simplified query grabbing ONLY the staff info for the ID. No pagination needed, the series/character
+# data comes from CHARACTER_MEDIA_QUERY.
+VA_DETAILS_QUERY = '''
+    query ($id: Int) {
+        Staff(id: $id) {
+            id
+            name {
+                first
+                last
+                full
+            }
+            image {
+                large
+                medium
+            }
+            languageV2
+            description
+            gender
+            primaryOccupations
+            dateOfBirth {
+                year
+                month
+                day
+            }
+            dateOfDeath {
+                year
+                month
+                day
+            }
+            age
+            yearsActive
+            homeTown
+            bloodType
+        }
+    }
+'''
+
 
-        #print('ALL SERIES FINAL: ', all_series)
-        return all_series
+def fetch_va_details(va_id, app):
+    """Fetch a VA's details, and the first page of their characterMedia in the same request.
 
-    return []
+    The page lands in the response cache, so the /api/character_media call the details page
+    makes right after only has to fetch pages 2 and up.
+    """
 
+    staff, first_page = make_batch_request([
+        (VA_DETAILS_QUERY, {'id': va_id}),
+        (CHARACTER_MEDIA_QUERY, {'id': va_id, 'page': 1, 'perPage': 25}),
+    ], app)
 
+    return staff['data']['Staff'] if staff is not None and staff.get('data') else None
 
-def fetch_user_anime_list(username, app):
-    """Fetch all completed / current by username"""
 
-    # GraphQL query to fetch characterMedia by staff ID
-    graphql_query = '''
+# A user's completed and current anime
+USER_ANIME_LIST_QUERY = '''
     query UserListSearch($userName: String) {
         MediaListCollection(userName: $userName, type: ANIME, status_in: [COMPLETED, CURRENT]) {
             lists {
@@ -293,11 +678,20 @@ def fetch_user_anime_list(username, app):
                     mediaId
                     status
                     score
+                    updatedAt
                 }
             }
         }
     }
-    '''
+'''
+
+
+def fetch_user_anime_list(username, app, priority=PRIORITY_BACKGROUND):
+    """Fetch all completed / current by username
+
+    List refreshes run at background priority by default so they can't starve page views
+    of rate limit budget. Returns None if the request fails, an empty dict is an empty list.
+    """
 
     # Variables for the GraphQL query
     variables = {
@@ -305,42 +699,83 @@ def fetch_user_anime_list(username, app):
     }
 
     # Make the initial API request
-    response = make_api_request(graphql_query, variables, app)
+    response = make_api_request(USER_ANIME_LIST_QUERY, variables, app, priority)
 
-    all_series = {}
+    if response is None or 'errors' in response:
+        log.warning('Anime list for %s failed', username)
+        return None
+    return anime_list_from_response(response, app)
 
-    if response is not None:
-        app.logger.debug('*** USER LIST RESPONSE: IS NOT NONE ***')
-        lists = response['data']['MediaListCollection']['lists']
 
-        # Combine all entries from all lists
-        for lst in lists:
-            app.logger.debug(f"{lst['name']} Length: {len(lst['entries'])}")
-            for entry in lst['entries']:
-                all_series[entry['mediaId']] = {
-                    'status': entry['status'],
-                    'score': entry['score']
-                }
-                #all_series.append(entry['mediaId'])
+# Statuses USER_ANIME_LIST_QUERY fetches, everything else is left off the stored list
+USER_LIST_STATUSES = ('COMPLETED', 'CURRENT')
+
+# Every entry on a user's list, most recently changed first. AniList can't filter on
+# updatedAt, so delta syncs walk this until they reach an entry they've already seen.
+# No status filter, an entry moved off COMPLETED / CURRENT is a change we need to see too.
+USER_LIST_CHANGES_QUERY = '''
+    query UserListChanges($userName: String, $page: Int, $perPage: Int) {
+        Page(page: $page, perPage: $perPage) {
+            pageInfo {
+                hasNextPage
+            }
+            mediaList(userName: $userName, type: ANIME, sort: UPDATED_TIME_DESC) {
+                mediaId
+                status
+                score
+                updatedAt
+            }
+        }
+    }
+'''
 
-        app.logger.debug(f'ALL_SERIES: {len(all_series)}')
-        # print('ENTRIES: ', len(lists[-1]['entries']))
 
-    #print(all_series)
-    return all_series
+def fetch_user_list_changes(username, since, app, priority=PRIORITY_BACKGROUND):
+    """List entries changed after since (an AniList updatedAt timestamp), newest first.
 
-def is_anilist_username_accessible(username, app):
-    """Check if the AniList username is accessible."""
+    Usually a single small page. Returns None if a page fails, so the caller can retry
+    rather than record a sync that missed changes.
+    """
 
-    # GraphQL query to fetch user profile by username
-    graphql_query = '''
+    changes = []
+    page = 1
+
+    while True:
+        variables = {
+            'userName': username,
+            'page': page,
+            'perPage': 50
+        }
+        response = make_api_request(USER_LIST_CHANGES_QUERY, variables, app, priority)
+
+        if response is None or 'errors' in response:
+            log.warning('List changes for %s failed on page %s', username, page)
+            return None
+
+        connection = response['data']['Page']
+        for entry in connection['mediaList']:
+            if entry['updatedAt'] <= since:
+                return changes
+            changes.append(entry)
+
+        if not connection['pageInfo']['hasNextPage']:
+            return changes
+        page += 1
+
+
+# Just enough of a user profile to know it exists and is public
+USER_QUERY = '''
     query ($name: String) {
         User(name: $name) {
             id
             name
         }
     }
-    '''
+'''
+
+
+def is_anilist_username_accessible(username, app):
+    """Check if the AniList username is accessible."""
 
     # Variables for the GraphQL query
     variables = {
@@ -348,11 +783,16 @@ def is_anilist_username_accessible(username, app):
     }
 
     # Make the initial API request
-    response = make_api_request(graphql_query, variables, app)
+    response = make_api_request(USER_QUERY, variables, app)
+
+    # AniList down, timed out or still rate limiting us, we can't tell so don't count on it
+    if response is None:
+        log.warning('Checking AniList user %s failed', username)
+        return False
 
     # Check if the request returned an error
     if 'errors' in response and response['errors'][0]['status'] == 404:
-        app.logger.debug('The username does not exist on Anilist or the profile is private.')
+        log.debug('%s does not exist on AniList or the profile is private', username)
         #flash('The username does not exist on Anilist or the profile is private.', 'error')
         return False
 
@@ -360,10 +800,8 @@ def is_anilist_username_accessible(username, app):
     return True
 
 
-def search_anime_series(search_query, app):
-    """Fetch all media based on search query"""
-
-    graphql_query = '''
+# Anime series search
+SERIES_SEARCH_QUERY = '''
     query ($page: Int, $perPage: Int, $search: String) {
         Page(page: $page, perPage: $perPage) {
             pageInfo {
@@ -396,118 +834,84 @@ def search_anime_series(search_query, app):
             }
         }
     }
-    '''
+'''
+
+
+def search_anime_series(search_query, app, page=None):
+    """Fetch media based on search query, every page of it or just the one page asked for.
+
+    With page the result's next_page says which page to ask for next, see search_response.
+    """
 
     # Variables for the GraphQL query
     variables = {
         'search': search_query,
-        'page': 1,
+        'page': page or 1,
         'perPage': 50
     }
 
-    # Make the initial API request
-    response = make_api_request(graphql_query, variables, app)
-
-    app.logger.debug(f'*** SEARCH SERIES: {search_query} ***')
+    # Only the page the user is looking at
+    if page is not None:
+        media, next_page = fetch_page(SERIES_SEARCH_QUERY, variables, app, lambda response: response['data']['Page'], 'media')
+        return search_response('series', media, next_page)
 
-    if response is not None:
-        app.logger.debug('***** RESPONSE IS NOT NONE *****')
-        search_media = response['data']['Page']
-        all_media = search_media['media']
-
-        # Fetch additional pages if available
-        while search_media['pageInfo']['hasNextPage']:
-            app.logger.debug("*** NEXT PAGE AVAIL, +1 PAGE AND REQUEST API AGAIN ***")
-            variables['page'] += 1
-            app.logger.debug(f"*** PAGE {variables['page']} OF {search_media['pageInfo']['total']} ***")
-            response = make_api_request(graphql_query, variables, app)
-
-            #print(f'@@@@ REQUESTED PAGE {variables['page']} OF {search_media['pageInfo']['total']} @@@@')
-
-            if response is not None:
-                app.logger.debug('*** RESPONSE WORKED, EXTEND all_media ***')
-                search_media = response['data']['Page']
-                #app.logger.debug('EXTENSION: ', search_media['media'])
-                all_media.extend(search_media['media'])
-            else:
-                break
-
-        #print('ALL SERIES FINAL: ', all_media)
-        response_data = {
-            "data": {
-                "status_code": 200,
-                "series": all_media,
-            }
-        }
-        return response_data
+    # Fetch every page of results
+    all_media = fetch_all_pages(SERIES_SEARCH_QUERY, variables, app, lambda response: response['data']['Page'], 'media')
 
-    # If the response is None, return a dictionary with a status_code key
-    return {
-        "data": {
-            "status_code": response.status_code if response else 500,
-            "series": [],
-        }
-    }
-    # Response is none, return empty and 400 code
-    # return {"status_code": 404, "all_media": []}
+    log.debug('Search series: %s', search_query)
 
+    return search_response('series', all_media)
 
-def fetch_series_characters_roles(series_id, app):
-    """Fetch all characters and their VA's for a series based on ID."""
 
-    # Reworked query not pulling extra media on voiceActor > characters query
-    graphql_query2 = '''
-    query ($id: Int, $page: Int, $perPage: Int) {
-        Media(id: $id) {
-            characters (page: $page, perPage: $perPage, sort: FAVOURITES_DESC) {
-                pageInfo {
-                    total
-                    currentPage
-                    lastPage
-                    hasNextPage
-                }
+# Simplified query grabbing ONLY the series info for the ID. No pagination needed, the
+# character data comes from SERIES_ROLES_QUERY.
+SERIES_DETAILS_QUERY = '''
+    query ($id: Int) {
+		Media(id: $id) {
+            title {
+                english
+                romaji
+            }
+            bannerImage
+            coverImage {
+                color
+                large
+            }
+            description
+            genres
+            episodes
+            idMal
+            id
+            season
+            seasonYear
+            studios {
                 edges {
-                    role
                     node {
+                        name
                         id
-                        name {
-                            full
-                        }
-                        image {
-                            large
-                            medium
-                        }
-                    }
-                    voiceActors (language: JAPANESE) {
-                        name {
-                            full
-                        }
-                        id
-                        image {
-                            large
-                            medium
-                        }
-                        characters (page: 1, perPage: 6, sort:FAVOURITES_DESC) {
-                            nodes {
-                                name {
-                                    full
-                                }
-                                id
-                                image {
-                                    large
-                                    medium
-                                }
-                            }
-                        }
                     }
                 }
             }
-		}
+            tags {
+                name
+                category
+                id
+            }
+        }
     }
-    '''
+'''
+
+
+def fetch_series_details(series_id, app):
+    """Fetch a series' details by AniList ID, None if there's no such series"""
 
-    # GraphQL query to fetch characterMedia by staff ID
-    graphql_query = '''
+    response = make_api_request(SERIES_DETAILS_QUERY, {'id': series_id}, app)
+    return response['data']['Media'] if response is not None and response.get('data') else None
+
+
+# Every character in a series with their Japanese VA and a few of the VA's other characters.
+# Reworked query not pulling extra media on voiceActor > characters query
+SERIES_ROLES_QUERY = '''
     query ($id: Int, $page: Int, $perPage: Int) {
         Media(id: $id) {
             characters (page: $page, perPage: $perPage, sort: FAVOURITES_DESC) {
@@ -518,6 +922,7 @@ def fetch_series_characters_roles(series_id, app):
                     hasNextPage
                 }
                 edges {
+                    role
                     node {
                         id
                         name {
@@ -537,7 +942,7 @@ def fetch_series_characters_roles(series_id, app):
                             large
                             medium
                         }
-                        characters (page: 1, perPage: 5, sort:FAVOURITES_DESC) {
+                        characters (page: 1, perPage: 6, sort:FAVOURITES_DESC) {
                             nodes {
                                 name {
                                     full
@@ -547,19 +952,6 @@ def fetch_series_characters_roles(series_id, app):
                                     large
                                     medium
                                 }
-                                media {
-                                    edges {
-                                        node {
-                                            id
-                                            title {
-                                                english
-                                                romaji
-                                            }
-                                            type
-                                            favourites
-                                        }
-                                    }
-                                }
                             }
                         }
                     }
@@ -567,7 +959,11 @@ def fetch_series_characters_roles(series_id, app):
             }
 		}
     }
-    '''
+'''
+
+
+def fetch_series_characters_roles(series_id, app):
+    """Fetch all characters and their VA's for a series based on ID."""
 
     # Variables for the GraphQL query
     variables = {
@@ -576,36 +972,21 @@ def fetch_series_characters_roles(series_id, app):
         'perPage': 25
     }
 
-    # Make the initial API request
-    response = make_api_request(graphql_query2, variables, app)
+    # Fetch every page of characters
+    all_series = fetch_all_pages(SERIES_ROLES_QUERY, variables, app, lambda response: response['data']['Media']['characters'], 'edges')
 
+    log.debug('Fetch all series characters: %s', series_id)
 
-    app.logger.debug(f'*** FETCH ALL SERIES CHARACTERS: {series_id} ***')
+    return all_series if all_series is not None else []
 
-    if response is not None:
-        app.logger.debug('***** RESPONSE IS NOT NONE *****')
-        series_media = response['data']['Media']['characters']
-        all_series = series_media['edges']
-
-        # Fetch additional pages if available
-        while series_media['pageInfo']['hasNextPage']:
-            app.logger.debug("*** NEXT PAGE AVAIL, +1 PAGE AND REQUEST API AGAIN ***")
-            variables['page'] += 1
-            app.logger.debug(f"*** PAGE {variables['page']} OF {series_media['pageInfo']['total']} ***")
-            response = make_api_request(graphql_query, variables, app)
-
-            #print(f'@@@@ REQUESTED PAGE {variables['page']} OF {series_media['pageInfo']['total']} @@@@')
 
-            if response is not None:
+def iter_series_roles_pages(series_id, app):
+    """Yield a series' character edges (with their VA's) a page at a time, see iter_pages"""
 
-                app.logger.debug('*** RESPONSE WORKED, EXTEND all_series ***')
-                series_media = response['data']['Media']['characters']
-                #app.logger.debug('EXTENSION: ', series_media['edges'])
-                all_series.extend(series_media['edges'])
-            else:
-                break
-
-        #print('ALL SERIES FINAL: ', all_series)
-        return all_series
+    variables = {
+        'id': series_id,
+        'page': 1,
+        'perPage': 25
+    }
 
-    return []
\ No newline at end of file
+    return iter_pages(SERIES_ROLES_QUERY, variables, app, lambda response: response['data']['Media']['characters'], 'edges')
@@ -0,0 +1,400 @@
+"""asyncio version of the AniList client in api_clients.py
+
+Covers the VA / series searches (page= included), fetch_all_character_media,
+fetch_series_characters_roles, fetch_user_anime_list and is_anilist_username_accessible, with
+the same arguments and return values as in api_clients.py, they just have to be awaited. The
+details lookups, fetch_user_list_changes and the iter_*_pages streams are sync only.
+
+Every async AniList call runs on one background event loop that owns a single aiohttp
+ClientSession, so the connection pool, in-flight calls and page fan-out are shared by the whole
+process no matter which loop the caller is on (Flask runs each async view in its own short lived loop).
+
+The response cache and rate limit scheduler are the same ones the sync client uses.
+"""
+
+import asyncio
+import copy
+import json
+import logging
+import os
+import threading
+import time
+
+import aiohttp
+
+import metrics
+from api_cache import get_response_cache, cache_key, query_name
+from api_clients import (ANILIST_API_URL, VA_SEARCH_QUERY, CHARACTER_MEDIA_QUERY, USER_ANIME_LIST_QUERY,
+                         USER_QUERY, SERIES_SEARCH_QUERY, SERIES_ROLES_QUERY,
+                         search_response, anime_list_from_response, describe_request, IncompleteList)
+from rate_limiter import get_scheduler, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+
+
+# Same log categories as api_clients.py
+log = logging.getLogger('onsei.anilist')
+cache_log = logging.getLogger('onsei.anilist.cache')
+
+
+# How often a request queued for the rate limit looks again while it isn't at the head of the queue
+SCHEDULER_POLL_INTERVAL = 0.05
+
+# Event loop (and its thread) every async AniList call runs on
+_loop = None
+_loop_lock = threading.Lock()
+
+# Only ever touched from the AniList loop, so none of these need a lock
+_client = None
+_request_flights = {}
+_pagination_flights = {}
+
+
+def get_loop():
+    """Grab the AniList event loop, starting its thread on first use"""
+    global _loop
+
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='anilist-loop', daemon=True).start()
+                _loop = loop
+    return _loop
+
+
+async def run_on_loop(coro):
+    """Await coro on the AniList loop, from whichever loop we're running on"""
+
+    loop = get_loop()
+    if asyncio.get_running_loop() is loop:
+        return await coro
+    # Tasks on the AniList loop don't see our context, bring the request's metrics tally along
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(metrics.bind_request_coro(coro), loop))
+
+
+def build_client(pool_size=10, connect_timeout=3.05, read_timeout=10):
+    """Build an aiohttp ClientSession with a keep-alive connection pool, gzip is on by default.
+
+    aiohttp binds the session to the running loop, so only call this on the AniList loop.
+    """
+
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=pool_size, limit_per_host=pool_size),
+        # No total timeout, a request waiting for a free connection is already past the
+        # rate limit scheduler and the ones holding connections have a read timeout.
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout),
+        headers={
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+        },
+    )
+
+
+def get_client(app):
+    """Grab the shared ClientSession, creating it on first use. Only call this on the AniList loop."""
+    global _client
+
+    if _client is None:
+        _client = build_client(
+            pool_size=app.config.get('ANILIST_POOL_SIZE', 10),
+            connect_timeout=app.config.get('ANILIST_CONNECT_TIMEOUT', 3.05),
+            read_timeout=app.config.get('ANILIST_READ_TIMEOUT', 10),
+        )
+    return _client
+
+
+async def _close_client():
+    global _client
+
+    if _client is not None:
+        await _client.close()
+    _client = None
+    _request_flights.clear()
+    _pagination_flights.clear()
+
+
+def reset_client():
+    """Close the shared ClientSession (next request builds a fresh one)"""
+
+    if _loop is not None:
+        asyncio.run_coroutine_threadsafe(_close_client(), _loop).result()
+
+
+def _forget_loop_in_child():
+    """After a fork (gunicorn --preload workers) the loop's thread is gone, the child starts its own on first use"""
+    global _loop, _loop_lock, _client
+
+    _loop = None
+    _loop_lock = threading.Lock()
+    # Its connections belong to the parent's loop, leave them to the parent
+    _client = None
+    _request_flights.clear()
+    _pagination_flights.clear()
+
+
+os.register_at_fork(after_in_child=_forget_loop_in_child)
+
+
+async def _coalesce(flights, key, make_coro):
+    """Await make_coro(), or the identical call already running for key (see singleflight.py)"""
+
+    task = flights.get(key)
+    leader = task is None
+
+    if leader:
+        task = asyncio.ensure_future(make_coro())
+        flights[key] = task
+        task.add_done_callback(lambda done: flights.pop(key, None))
+
+    # Shielded so one caller going away doesn't cancel the call for everyone else
+    result = await asyncio.shield(task)
+    return result if leader else copy.deepcopy(result)
+
+
+async def acquire(scheduler, priority, timeout):
+    """scheduler.acquire() for the AniList loop, sleeps on the loop instead of holding a thread while it waits.
+
+    Takes its place in the same queue as the sync client's threads, so priorities hold across both.
+    """
+
+    ticket = scheduler.join(priority)
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            wait = scheduler.poll(ticket)
+            if wait == 0:
+                return True
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(SCHEDULER_POLL_INTERVAL if wait is None else wait, remaining))
+    finally:
+        scheduler.leave(ticket)
+
+
+async def make_api_request(query, variables, app, priority=PRIORITY_INTERACTIVE):
+    return await run_on_loop(_make_api_request(query, variables, app, priority))
+
+
+async def _make_api_request(query, variables, app, priority):
+
+    # Serve repeat lookups from the response cache without touching the network
+    cache = get_response_cache(app)
+    key = cache_key(query, variables)
+    cached = cache.get(key)
+
+    if cached is not None:
+        cache_log.debug('Async API request served from cache: %s', key)
+        return cached
+
+    # If the same request is already in flight, wait for its answer instead of sending another
+    return await _coalesce(_request_flights, key, lambda: _send_request(query, variables, app, priority, cache, key))
+
+
+async def _send_request(query, variables, app, priority, cache, key):
+    """Send a request to AniList (through the rate limit scheduler) and cache a clean answer"""
+
+    anilist_api_url = app.config.get('ANILIST_API_URL', ANILIST_API_URL)
+    scheduler = get_scheduler(app)
+
+    name, page, pages = describe_request(query, variables)
+    log.debug('Async API request %s page %s', name, page or '-', extra={'query': name, 'page': page, 'variables': variables})
+
+    # A 429 means we wait out Retry-After and go again, rather than dropping the page
+    for attempt in range(app.config.get('ANILIST_MAX_RETRIES', 3) + 1):
+        acquired = await acquire(scheduler, priority, app.config.get('ANILIST_QUEUE_TIMEOUT', 30))
+        if not acquired:
+            log.warning('Async API request %s timed out waiting for the rate limit', name)
+            return None
+
+        started = time.perf_counter()
+        try:
+            async with get_client(app).post(anilist_api_url, json={'query': query, 'variables': variables}) as response:
+                status, headers, text = response.status, response.headers, await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            metrics.record_upstream(name, page, 'error', started, pages)
+            log.warning('Async API request %s failed: %r', name, e, extra={'query': name, 'page': page})
+            return None
+
+        metrics.record_upstream(name, page, status, started, pages)
+
+        scheduler.update(status, headers)
+
+        if status != 429:
+            break
+        log.info('Async API request %s rate limited, Retry-After: %s', name, headers.get('Retry-After'))
+
+    if status == 200:
+        data = json.loads(text)
+        # Only keep clean answers, a 200 can still carry GraphQL errors
+        if 'errors' not in data:
+            cache.set(key, query_name(query), text)
+        return data
+    elif status == 404:
+        log.debug('Async API request %s returned 404: %s', name, text)
+        return json.loads(text)  # return the JSON response even though the status was 404
+    else:
+        log.warning('Async API request %s failed with status code %s: %s', name, status, text)
+        return None
+
+
+async def fetch_all_pages(query, variables, app, get_connection, items_key, priority=PRIORITY_INTERACTIVE):
+    """Fetch every page of a paginated query, see api_clients.fetch_all_pages.
+
+    Page 1 first to read lastPage, then every other page at once on the AniList loop. The
+    scheduler and the connection pool keep that in bounds, not a worker pool. Pages waiting on
+    the rate limit sleep on the loop (see acquire), they don't hold a thread each.
+    """
+
+    # The loop thread has no app context, so make sure we're holding the real app and not current_app
+    app = app._get_current_object() if hasattr(app, '_get_current_object') else app
+
+    return await run_on_loop(_coalesce(
+        _pagination_flights,
+        cache_key(query, variables),
+        lambda: _walk_pages(query, variables, app, get_connection, items_key, priority),
+    ))
+
+
+async def _walk_pages(query, variables, app, get_connection, items_key, priority):
+
+    response = await _make_api_request(query, variables, app, priority)
+
+    if response is None:
+        return None
+
+    connection = get_connection(response)
+    all_items = list(connection[items_key])
+    page = variables.get('page', 1)
+
+    if not connection['pageInfo']['hasNextPage']:
+        return all_items
+
+    last_page = connection['pageInfo'].get('lastPage') or page
+    remaining_pages = range(page + 1, last_page + 1)
+
+    responses = await asyncio.gather(*(
+        _make_api_request(query, dict(variables, page=p), app, priority) for p in remaining_pages
+    ))
+
+    # Reassemble in page order, stopping at the first page that failed
+    for page, response in zip(remaining_pages, responses):
+        if response is None:
+            log.warning('Async page %s failed, stopping at %s pages', page, page - 1)
+            return IncompleteList(all_items)
+        connection = get_connection(response)
+        all_items.extend(connection[items_key])
+
+    # lastPage can undercount when the list grows between calls, walk anything left serially
+    while connection['pageInfo']['hasNextPage']:
+        page += 1
+        response = await _make_api_request(query, dict(variables, page=page), app, priority)
+
+        if response is None:
+            log.warning('Async page %s failed, stopping at %s pages', page, page - 1)
+            return IncompleteList(all_items)
+        connection = get_connection(response)
+        all_items.extend(connection[items_key])
+
+    return all_items
+
+
+async def fetch_page(query, variables, app, get_connection, items_key, priority=PRIORITY_INTERACTIVE):
+    """Fetch the single page named by variables['page'], see api_clients.fetch_page"""
+
+    response = await make_api_request(query, variables, app, priority)
+
+    if response is None or not response.get('data'):
+        return None, None
+
+    connection = get_connection(response)
+    next_page = variables['page'] + 1 if connection['pageInfo']['hasNextPage'] else None
+    return connection[items_key], next_page
+
+
+async def search_voice_actors(search_query, app, page=None):
+    """Fetch voice actors based on search query, every page of them or just the one page asked for"""
+
+    variables = {
+        'search': search_query,
+        'page': page or 1,
+        'perPage': 50
+    }
+
+    if page is not None:
+        staff, next_page = await fetch_page(VA_SEARCH_QUERY, variables, app, lambda response: response['data']['Page'], 'staff')
+        return search_response('va', staff, next_page)
+
+    all_staff = await fetch_all_pages(VA_SEARCH_QUERY, variables, app, lambda response: response['data']['Page'], 'staff')
+    return search_response('va', all_staff)
+
+
+async def fetch_all_character_media(va_id, app):
+    """Fetch all characterMedia series for a VA based on ID."""
+
+    variables = {
+        'id': va_id,
+        'page': 1,
+        'perPage': 25
+    }
+
+    all_series = await fetch_all_pages(CHARACTER_MEDIA_QUERY, variables, app, lambda response: response['data']['Staff']['characterMedia'], 'edges')
+    return all_series if all_series is not None else []
+
+
+async def fetch_user_anime_list(username, app, priority=PRIORITY_BACKGROUND):
+    """Fetch all completed / current by username, None if the request fails"""
+
+    response = await make_api_request(USER_ANIME_LIST_QUERY, {"userName": username}, app, priority)
+    if response is None or 'errors' in response:
+        log.warning('Anime list for %s failed', username)
+        return None
+    return anime_list_from_response(response, app)
+
+
+async def is_anilist_username_accessible(username, app):
+    """Check if the AniList username is accessible."""
+
+    response = await make_api_request(USER_QUERY, {"name": username}, app)
+
+    # AniList down, timed out or still rate limiting us, we can't tell so don't count on it
+    if response is None:
+        log.warning('Checking AniList user %s failed', username)
+        return False
+
+    # Check if the request returned an error
+    if 'errors' in response and response['errors'][0]['status'] == 404:
+        log.debug('%s does not exist on AniList or the profile is private', username)
+        return False
+
+    return True
+
+
+async def search_anime_series(search_query, app, page=None):
+    """Fetch media based on search query, every page of it or just the one page asked for"""
+
+    variables = {
+        'search': search_query,
+        'page': page or 1,
+        'perPage': 50
+    }
+
+    if page is not None:
+        media, next_page = await fetch_page(SERIES_SEARCH_QUERY, variables, app, lambda response: response['data']['Page'], 'media')
+        return search_response('series', media, next_page)
+
+    all_media = await fetch_all_pages(SERIES_SEARCH_QUERY, variables, app, lambda response: response['data']['Page'], 'media')
+    return search_response('series', all_media)
+
+
+async def fetch_series_characters_roles(series_id, app):
+    """Fetch all characters and their VA's for a series based on ID."""
+
+    variables = {
+        'id': series_id,
+        'page': 1,
+        'perPage': 25
+    }
+
+    all_series = await fetch_all_pages(SERIES_ROLES_QUERY, variables, app, lambda response: response['data']['Media']['characters'], 'edges')
+    return all_series if all_series is not None else []
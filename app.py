@@ -1,113 +1,271 @@
-from flask import Flask, render_template, redirect, url_for, flash, request, session, g, abort, jsonify, current_app
+from flask import Flask, Blueprint, render_template, redirect, url_for, flash, request, session, g, abort, jsonify, current_app, Response, stream_with_context, make_response, send_file
 import requests
 import logging
 import json
+import hashlib
+from functools import partial
 from config import Config, DevelopmentConfig, ProductionConfig, TestingConfig
-from flask_debugtoolbar import DebugToolbarExtension
-from models import db, connect_db, migrate, User
+from flask_compress import Compress
+from models import db, connect_db, migrate_pickled_anime_lists, load_name_index, User, StaffDocument, MediaDocument, CharacterMediaList, SeriesRoleList
 from forms import SignUpForm, LoginForm, UserEditForm
 from sqlalchemy import text
 from sqlalchemy.exc import IntegrityError
-from api_clients import *
+from api_clients import (search_voice_actors, fetch_va_details, fetch_all_character_media, iter_character_media_pages,
+                         search_anime_series, fetch_series_details, fetch_series_characters_roles, iter_series_roles_pages)
+from helpers import annotate_character_media
+from jobs import enqueue_list_refresh, list_refresh_pending
+import assets
+import logs
+import metrics
+import thumbnails
+from name_index import get_name_index, staff_entry, media_entry, KIND_VA, KIND_SERIES
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from flask.ctx import _AppCtxGlobals
 
 CURR_USER_KEY = "curr_user"
+# Who's logged in, enough for the header without a query (the session cookie is signed, it can't be edited)
+IDENTITY_KEY = "identity"
 LIST_EXPIRY = 7
 ANILIST_API_URL = 'https://graphql.anilist.co'
 ANILIST_API_HEADERS = {'Content-Type': 'application/json'}
 
-app = Flask(__name__)
-load_dotenv()
-app.app_context().push()
+
+
+class RequestGlobals(_AppCtxGlobals):
+    """Flask's g, except g.user is only loaded from the database when something asks for it"""
+
+    @property
+    def user(self):
+        if '_user' not in self.__dict__:
+            self._user = load_current_user()
+        return self._user
+
+    @user.setter
+    def user(self, user):
+        self._user = user
+
+
+# Every route, template helper and CLI command below is registered on this, create_app() puts it on the app.
+# cli_group=None keeps the commands at the top level (flask build-assets, not flask views build-assets).
+views = Blueprint('views', __name__, cli_group=None)
+
+# Extensions are set up per app in create_app(), nothing here touches an app or the database
+compress = Compress()
+timing_log = logging.getLogger('onsei.timing')
+
+# Use ENV to decide which Config to use
+CONFIGS = {
+    'production': ProductionConfig,
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+}
+
+
+def create_app(config=None):
+    """Build the app. config is a Config class (or a dict of overrides), by default the one for ENV.
+
+    Nothing here connects to the database, the schema is managed with flask db upgrade (or flask create-db),
+    so starting a worker or importing this for the tests is quick and doesn't need a database up.
+    """
+
+    load_dotenv()
+    app = Flask(__name__)
+    app.app_ctx_globals_class = RequestGlobals
+
+    app.config.from_object(CONFIGS.get(app.config['ENV'], Config))
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
+
+    # Only imported when it's switched on, it's a development tool and slow to load
+    if app.config.get('DEBUG_TB_ENABLED', app.debug):
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    # gzip / brotli for HTML and JSON responses, see the COMPRESS_* settings in config.py
+    compress.init_app(app)
+
+    # Queued, per category logging, see logs.py and the LOG_* settings in config.py
+    logs.setup_logging(app)
+
+    # Call our connect_db function from models, Flask-Migrate comes with it under the flask command
+    connect_db(app)
+
+    # Time every SQL statement and template render for /metrics and the Server-Timing header
+    with app.app_context():
+        metrics.track_queries(db.engine)
+    metrics.track_templates(app)
+
+    app.register_blueprint(views)
+    return app
+
 
 # Contect Processor Function: This function will be called every time a template is rendered.
 # The returned dictionary will be injected into the template's context, meaning its keys will become variables available in the template.
-@app.context_processor
+@views.app_context_processor
 def inject_is_prod():
     # We're adding the 'is_prod' variable, which is True if the app is running in production.
     # This variable will be accessible in all templates, allowing us to conditionally add or remove things based on the environment.
-    return dict(is_prod=app.config['ENV'] == 'production')
+    return dict(is_prod=current_app.config['ENV'] == 'production')
+
+@views.app_context_processor
+def inject_identity():
+    # {{ identity.username }} in templates, straight from the session. None when logged out.
+    return {'identity': current_identity()}
 
-@app.context_processor
+@views.app_context_processor
 def inject_current_year():
     return {'current_year': datetime.now().year}
 
+@views.app_context_processor
+def inject_assets():
+    # asset_url('app.css') / responsive_image('images/x.jpg', alt=...), see assets.py
+    app = current_app._get_current_object()
+    return {'asset_url': partial(assets.asset_url, app=app), 'responsive_image': partial(assets.responsive_image, app=app)}
+
 
 # Temp notes about render deploy attempts
 # 1. I tried making a Procfile  REMOVED
-# 2. I added app.app_context().push()
+# 2. I added app.app_context().push() REMOVED, create_app() builds the app and requests / commands bring their own context
 # 3. Manually specified a version of setuptools instead of letting it install as a dependency REMOVED
 
-# Use ENV to decide which Config to use
-if app.config['ENV'] == 'production':
-    app.config.from_object(ProductionConfig)
-elif app.config['ENV'] == 'development':
-    app.config.from_object(DevelopmentConfig)
-elif app.config['ENV'] == 'testing':
-    app.config.from_object(TestingConfig)
+##############################################################################
+# Metrics, see metrics.py
+
+
+@views.before_app_request
+def start_request_metrics():
+    """Start the clock (and the AniList page count) for this request, before anything else runs"""
+    g.metrics = metrics.start_request()
+
+
+@views.after_app_request
+def record_request_metrics(response):
+    """Record the request in /metrics, and say where its time went in Server-Timing (shows up in devtools)"""
+    tally = g.pop('metrics', None)
+    if tally is None:
+        return response
 
-debug = DebugToolbarExtension(app)
+    # The view's name without the blueprint, the labels stay va_details rather than views.va_details
+    endpoint = request.endpoint and request.endpoint.rpartition('.')[2]
+    metrics.finish_request(tally, endpoint, request.method, response.status_code)
 
-# If DEBUG = True, setup logging
-if app.debug:
-    logging.basicConfig(level=logging.DEBUG)
-    app.logger.setLevel(logging.DEBUG)
+    if current_app.config.get('SERVER_TIMING', True):
+        response.headers['Server-Timing'] = tally.server_timing()
 
-# Call our connect_db function from models
-connect_db(app)
+    # Breakdown in the log for requests at least this slow (seconds), None is off
+    threshold = current_app.config.get('REQUEST_TIMING_LOG')
+    if threshold is not None and tally.elapsed >= threshold:
+        timing_log.info('%s %s %s %s', request.method, request.full_path.rstrip('?'), response.status_code, tally.summary(),
+                        extra={'endpoint': endpoint, 'status': response.status_code,
+                               **{f'{name}_ms': round(seconds * 1000, 1) for name, seconds, description in tally.breakdown()}})
+    return response
 
-# Initialize Flask-Migrate
-migrate.init_app(app, db)
+
+@views.route('/metrics')
+def metrics_view():
+    """Everything in metrics.py in the Prometheus text format. Needs METRICS_TOKEN as a bearer token when it's set.
+
+    Without a token it's only served with METRICS_PUBLIC on, or in debug / testing. Route names and
+    upstream latencies aren't for everyone, so a production app nobody configured hides it.
+    """
+    token = current_app.config.get('METRICS_TOKEN')
+    if token:
+        if request.headers.get('Authorization') != f'Bearer {token}':
+            abort(403)
+    elif not (current_app.config.get('METRICS_PUBLIC') or current_app.debug or current_app.testing):
+        abort(404)
+
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE, headers={'Cache-Control': 'no-store'})
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@views.before_app_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """Forget the last request's user, g.user loads the logged in one the first time a view uses it.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    Anonymous requests, and the ones that never look at g.user (the JSON API, the header, 404s),
+    don't query the users table at all.
+    """
 
-    else:
-        g.user = None
+    g.pop('_user', None)
+
+
+def load_current_user():
+    """The logged in User, or None"""
+
+    user_id = session.get(CURR_USER_KEY)
+    if user_id is None:
+        return None
+
+    with metrics.phase('user'):
+        user = db.session.get(User, user_id)
+
+    if user is None:
+        # Deleted since they logged in
+        do_logout()
+    elif IDENTITY_KEY not in session:
+        # Logged in before there was an identity in the session
+        remember_identity(user)
+    return user
+
+
+def remember_identity(user):
+    """Keep what templates show about the user in the session, call it whenever those fields change"""
+
+    session[IDENTITY_KEY] = {
+        'id': user.id,
+        'username': user.username,
+        'anilist_username': user.anilist_username,
+        'anilist_profile_accessible': bool(user.anilist_profile_accessible),
+    }
+
+
+def current_identity():
+    """The logged in user's identity from the session, None when logged out"""
+
+    if CURR_USER_KEY not in session:
+        return None
+    if IDENTITY_KEY not in session:
+        # Loading the user fills it in (or logs out a deleted one)
+        g.user
+    return session.get(IDENTITY_KEY)
 
 
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    remember_identity(user)
+    g.user = user
 
-    app.logger.debug('******* LOGIN STARTED *******')
-    app.logger.debug('LIST LAST UPDATED AT: %s', user.anime_list_updated_at)
-    app.logger.debug('CURRENT DATE/TIME: %s', datetime.utcnow())
-    app.logger.debug('*****************************')
+    current_app.logger.debug('Login for user #%s, list last updated at %s', user.id, user.anime_list_updated_at)
 
     # Check if profile is accessible (database field) and if the current list data is more than 7 days old
     if user.anilist_profile_accessible and (not user.anime_list_updated_at or datetime.utcnow() - user.anime_list_updated_at > timedelta(days=LIST_EXPIRY)):
     
-        app.logger.debug("***** IT'S BEEN MORE THAN 7 DAYS. RE-FETCH LIST. *****")
-        # Update anime list for user
-        user.anime_list = fetch_user_anime_list(user.anilist_username, app)
-        user.anime_list_updated_at = datetime.utcnow()
+        current_app.logger.debug('List is more than %s days old, queueing a refresh', LIST_EXPIRY)
+        # worker.py fetches the list, the login doesn't wait on AniList
+        enqueue_list_refresh(user)
 
         # Commit the changes to the database
         db.session.commit()
-    else:
-        app.logger.debug("***** IT'S BEEN LESS THAN 7 DAYS. LIST IS GOOD. *****")
 
 
 
 def do_logout():
     """Logout user."""
 
-    if CURR_USER_KEY in session:
-        del session[CURR_USER_KEY]
+    session.pop(CURR_USER_KEY, None)
+    session.pop(IDENTITY_KEY, None)
+    g.user = None
 
 
-@app.route('/test-db')
+@views.route('/test-db')
 def test_db():
     """Test and confim database connection. DELETE THIS ON PRODUCTION!"""
     try:
@@ -119,7 +277,7 @@ def test_db():
 
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@views.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -147,8 +305,7 @@ def signup():
             db.session.commit()
 
         except IntegrityError as e:
-            app.logger.debug('Error is in Signup except')
-            app.logger.debug(f"IntegrityError: {str(e)}")  # Add this line for debugging
+            current_app.logger.info('Signup failed: %s', e)
             flash(f"Signup Error: Already Taken {e}", 'danger')
             
             return render_template('users/signup.html', form=form)
@@ -161,7 +318,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@views.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
@@ -184,7 +341,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@views.route('/logout')
 def logout():
     """Handle logout of user."""
     if not g.user:
@@ -198,7 +355,7 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.route('/profile')
+@views.route('/profile')
 def profile_view():
     """Show user profile."""
 
@@ -208,9 +365,9 @@ def profile_view():
 
     user = User.query.get_or_404(g.user.id)
     
-    return render_template('users/profile.html', user=user)
+    return render_template('users/profile.html', user=user, list_refreshing=list_refresh_pending(user))
 
-@app.route('/profile/edit', methods=["GET", "POST"])
+@views.route('/profile/edit', methods=["GET", "POST"])
 def profile_edit():
     """Update profile for current user."""
 
@@ -236,13 +393,13 @@ def profile_edit():
                 # If it has, update it and check if it's public profile
                 user.update_anilist_username(form.anilist_username.data)
             
-                # If profile is accessible, refresh the anime list
+                # If profile is accessible, queue a refresh of the anime list
                 if user.anilist_profile_accessible:
-                    user.anime_list = fetch_user_anime_list(user.anilist_username, app)
-                    user.anime_list_updated_at = datetime.utcnow()
+                    enqueue_list_refresh(user)
             
 
             db.session.commit()
+            remember_identity(user)
             flash("Profile edited successfully!", 'success')
             return redirect(f"/profile")
 
@@ -250,7 +407,7 @@ def profile_edit():
 
     return render_template('users/edit-profile.html', form=form, user_id=user.id)
 
-@app.route('/refresh-list', methods=['GET', 'POST'])
+@views.route('/refresh-list', methods=['GET', 'POST'])
 def refresh_list():
     """Refresh the anime list for the current user."""
 
@@ -268,17 +425,29 @@ def refresh_list():
         flash("AniList profile is not accessible.", "danger")
         return redirect("/profile")
 
-    # Update anime list for the user
-    user.anime_list = fetch_user_anime_list(user.anilist_username, app)
-    user.anime_list_updated_at = datetime.utcnow()
+    # Queue the refresh, the profile page shows it as refreshing until worker.py is done
+    enqueue_list_refresh(user)
 
     # Commit the changes to the database
     db.session.commit()
 
-    flash("Anime List successfully refreshed!", "success")
+    flash("Anime List refresh queued!", "success")
     return redirect("/profile")
 
-@app.route('/profile/delete', methods=["POST"])
+@views.route('/api/list_status', methods=['GET'])
+def list_status():
+    """Is the current user's list refresh still queued or running? The profile page polls this."""
+
+    if not g.user:
+        abort(401)
+
+    updated_at = g.user.anime_list_updated_at
+    return jsonify({
+        'refreshing': list_refresh_pending(g.user),
+        'updated_at': updated_at.isoformat() if updated_at else None,
+    })
+
+@views.route('/profile/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
 
@@ -286,9 +455,10 @@ def delete_user():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    user = g.user
     do_logout()
 
-    db.session.delete(g.user)
+    db.session.delete(user)
     db.session.commit()
     
     flash("Account deleted", "danger")
@@ -296,7 +466,7 @@ def delete_user():
 
 ##############################################################################
 # App Routes
-@app.route('/')
+@views.route('/')
 def search_form():
     """General homepage"""
 
@@ -304,11 +474,17 @@ def search_form():
 
 
 
-@app.route('/va/search', methods=['GET', 'POST'])
+@views.route('/va/search', methods=['GET', 'POST'])
 def va_search():
-    """Search for a voice actor"""
-    query = request.form.get('va-search')
-    print('QUERY:', query)
+    """Search for a voice actor.
+
+    Only the first page of results is fetched. The "load more" button asks for the next one
+    with ?q=..&page=N&partial=1 and gets back just that page's cards.
+    """
+    app = current_app._get_current_object()
+    query = request.form.get('va-search') or request.args.get('q')
+    page = request.args.get('page', 1, type=int)
+    partial = request.args.get('partial') == '1'
     search_made = False
 
     if not query:
@@ -316,13 +492,19 @@ def va_search():
         return render_template('va-search.html', search_made=search_made)
 
     # Send the search query to the AniList API
-    response_data = search_voice_actors(query, app)
+    response_data = search_voice_actors(query, app, page=page)
     #print('RESPONSE DATA:', response_data)
     staff = response_data['data']['va']
     status_code = response_data['data']['status_code']
+    next_page = response_data['data']['next_page']
     search_made = True
 
+    # Remember the names for /api/suggest
+    get_name_index(app).add_many(staff_entry(va) for va in staff)
+
     if status_code != 200:
+        if partial:
+            abort(502)
         flash(f'An error occurred when contacting the AniList API. (Status code: {status_code})')
         return render_template('va-search.html', search_made=search_made)
 
@@ -336,77 +518,64 @@ def va_search():
             va['characters']['nodes'] = valid_characters[:5]  # Limit the number of characters to 5
             filtered_staff.append(va)
 
+    if partial:
+        return search_results_page('va-search-results.html', next_page, staff=filtered_staff)
+
     #print('FILTERED STAFF:', filtered_staff)
     # Send the results to the search results page
-    return render_template('va-search.html', staff=filtered_staff, query=query, search_made=search_made)
+    return render_template('va-search.html', staff=filtered_staff, query=query, search_made=search_made, next_page=next_page)
+
 
+def search_results_page(template, next_page, **context):
+    """Just the result cards for a "load more" request, the page after this one goes in X-Next-Page"""
 
-@app.route('/va/<int:va_id>', methods=['GET', 'POST'])
+    response = make_response(render_template(template, **context))
+    response.headers['X-Next-Page'] = next_page or ''
+    return response
+
+
+@views.route('/api/suggest', methods=['GET'])
+def suggest():
+    """Typeahead for VA and series names we've already seen, never asks AniList.
+
+    ?q= is the prefix, ?type=va or ?type=series to only get one kind, ?limit= defaults to 10.
+    """
+    app = current_app._get_current_object()
+    token = request.headers.get('Authorization')
+    if not token or token != "Bearer wnYW3pY6b/pmAsNur?sbx=EOrTDKqslHIGjG":
+        abort(403)
+
+    kind = request.args.get('type')
+    if kind not in (None, KIND_VA, KIND_SERIES):
+        abort(400)
+
+    index = get_name_index(app)
+    index.ensure_loaded(load_name_index)
+
+    limit = min(request.args.get('limit', 10, type=int), 50)
+    return jsonify(index.suggest(request.args.get('q', ''), kind=kind, limit=limit))
+
+
+@views.route('/va/<int:va_id>', methods=['GET', 'POST'])
 def va_details(va_id):
     """Grab the VA details by AniList ID"""
+    app = current_app._get_current_object()
 
-    # Simplified query grabbing ONLY the staff info for the ID. No pagination needed. We're grabbing the series/character data in a separate call.
-    va_query = '''
-    query ($id: Int) {
-        Staff(id: $id) {
-            id
-            name {
-                first
-                last
-                full
-            }
-            image {
-                large
-                medium
-            }
-            languageV2
-            description
-            gender
-            primaryOccupations
-            dateOfBirth {
-                year
-                month
-                day
-            }
-            dateOfDeath {
-                year
-                month
-                day
-            }
-            age
-            yearsActive
-            homeTown
-            bloodType
-        }
-    }
-    '''
-
-    # Variables, we literally only need ID here.
-    variables = {
-        'id': va_id,
-    }
+    def fetch_staff():
+        # VA details, and the first characterMedia page for the browser's follow up call, in one request
+        return fetch_va_details(va_id, app)
 
-    # Send the GraphQL query to the AniList API
-    response = make_api_request(va_query, variables, app)
+    # Read from the database cache first, only hit AniList when it's missing or stale
+    va = StaffDocument.get_or_fetch(va_id, fetch_staff, app.config['DOCUMENT_CACHE_MAX_AGE'])
 
-    
-    if response is None or response['data']['Staff'] is None:
+    if va is None:
         # handle the case when the staff is not found
         abort(404)
     else:
-        # Process the response
-        va = response['data']['Staff']
-
-        app.logger.debug('&&&&&&&&&&& RESPONSE FOR VA: &&&&&&&&&&&' )
-        app.logger.debug(va)
-
-        # Check if user profile is accessible and anime_list isn't empty, if so fetch anime list
-        anime_list = g.user.anime_list if g.user and g.user.anilist_profile_accessible and g.user.anime_list else None
-
-        # Construct the output dictionary
+        # The list itself stays on the server, the page asks /api/character_media to merge it in
         output = {
             'va': va,
-            'anime_list': anime_list if anime_list else [] # Empty list if anime_list not avail
+            'has_user_list': user_list_available(),
         }
 
 
@@ -414,22 +583,172 @@ def va_details(va_id):
     
 
 
-@app.route('/api/character_media/<int:va_id>', methods=['GET'])
+def user_list_available():
+    """Does the logged in user have an accessible, non empty anime list?"""
+    return bool(g.user and g.user.anilist_profile_accessible and g.user.has_anime_list())
+
+
+def merge_user_list(edges):
+    """Mark characterMedia edges with the logged in user's list status and score.
+
+    Only when asked for with ?user_list=1 (or ?user_list=only to drop the series that aren't
+    on the list), otherwise the edges go out as they are.
+    """
+
+    mode = request.args.get('user_list')
+    if not mode or not user_list_available():
+        return edges
+
+    # Only the list entries for these series come out of the database
+    entries = g.user.anime_list_entries(edge['node']['id'] for edge in edges)
+    return annotate_character_media(edges, entries, on_list_only=(mode == 'only'))
+
+
+# Items per NDJSON line when a streamed list comes out of the document cache, same as an AniList page
+STREAM_CHUNK_SIZE = 25
+
+
+def cacheable(response, etag=None):
+    """Add validators to an API response and answer If-None-Match with a 304.
+
+    The ETag is a hash of the body unless one is passed in. Cache-Control is private (the
+    user's list can be merged in) and revalidates after API_CACHE_MAX_AGE seconds, so a
+    repeat visit costs a 304 instead of the whole list.
+    """
+
+    if etag:
+        response.set_etag(etag)
+    else:
+        response.add_etag()
+    etag = response.get_etag()[0]
+
+    # Flask-Compress tags compressed bodies "<etag>:gzip" / "<etag>:br", the browser sends that back
+    matched = next((tag for tag in request.if_none_match.as_set() if tag.rsplit(':', 1)[0] == etag), None)
+    if matched:
+        response = Response(status=304)
+        response.set_etag(matched)
+
+    response.cache_control.private = True
+    response.cache_control.max_age = current_app.config.get('API_CACHE_MAX_AGE', 0)
+    response.cache_control.must_revalidate = True
+    response.vary.add('Cookie')
+    return response
+
+
+def user_list_version():
+    """What a ?user_list response depends on besides the list itself, None when nothing is merged"""
+
+    mode = request.args.get('user_list')
+    if not mode or not user_list_available():
+        return None
+    return mode, g.user.id, g.user.anime_list_updated_at.isoformat()
+
+
+def stream_list(model, anilist_id, fetch_pages, transform=None, version=None):
+    """NDJSON response for a cached list, one JSON array of items per line.
+
+    A fresh copy in the document cache goes out in STREAM_CHUNK_SIZE chunks, with an ETag.
+    Otherwise every AniList page is sent the moment it arrives (fetch_pages() yields them) and
+    let go of right after, so the server only ever holds one page of it. That means a streamed
+    list isn't stored in the document cache, storing it needs all of it at once: the JSON
+    endpoints (get_or_fetch) fill that, and repeat streams within the response cache TTLs
+    (api_cache.py) don't go back to AniList. The names on each page still go in the name index.
+    transform(items) runs on each chunk, ie. merge_user_list, version is whatever else changes
+    the output (see user_list_version).
+    """
+
+    max_age = current_app.config['DOCUMENT_CACHE_MAX_AGE']
+    fetched_at = db.session.execute(db.select(model.fetched_at).where(model.id == anilist_id)).scalar()
+    fresh = fetched_at is not None and datetime.utcnow() - fetched_at <= max_age
+
+    # The body isn't known up front, but a fresh cached list (plus the user's list version when
+    # it's merged in) always streams the same, so that's what the ETag covers
+    etag = None
+    if fresh:
+        etag = hashlib.sha1(repr((model.__tablename__, anilist_id, fetched_at.isoformat(), version)).encode()).hexdigest()
+        if request.if_none_match.contains(etag):
+            return cacheable(Response(mimetype='application/x-ndjson'), etag)
+
+    document = db.session.get(model, anilist_id) if fetched_at is not None else None
+    name_index = get_name_index(current_app)
+
+    def cached_pages(data):
+        for i in range(0, len(data), STREAM_CHUNK_SIZE):
+            yield data[i:i + STREAM_CHUNK_SIZE]
+
+    def fetched_pages():
+        fetched_any = False
+        for items in fetch_pages():
+            fetched_any = fetched_any or bool(items)
+            name_index.add_many(model.name_entries(anilist_id, items))
+            yield items
+
+        if not fetched_any and document is not None:
+            # AniList failed, the stale copy beats nothing
+            yield from cached_pages(document.data)
+
+    def generate():
+        for items in (cached_pages(document.data) if fresh else fetched_pages()):
+            items = transform(items) if transform else items
+            if items:
+                yield json.dumps(items) + '\n'
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    return cacheable(response, etag) if etag else response
+
+
+@views.route('/api/character_media/<int:va_id>', methods=['GET'])
 def get_character_media(va_id):
     """API Endpoint to fetch media + characters from a va's id and return json for front end"""
+    app = current_app._get_current_object()
     token = request.headers.get('Authorization')
     # Not a secture token or anything since we're storing it in git and it's visible on the front end js calls, but it's something I guess.
     if not token or token != "Bearer wnYW3pY6b/pmAsNur?sbx=EOrTDKqslHIGjG":
         abort(403)
-    data = fetch_all_character_media(va_id, app)
-    return jsonify(data)
+    # Empty lists aren't worth caching, they're usually a failed fetch
+    data = CharacterMediaList.get_or_fetch(va_id, lambda: fetch_all_character_media(va_id, app) or None,
+                                           app.config['DOCUMENT_CACHE_MAX_AGE'])
+    return cacheable(jsonify(merge_user_list(data or [])))
+
+
+@views.route('/api/async/character_media/<int:va_id>', methods=['GET'])
+async def get_character_media_async(va_id):
+    """Async version of /api/character_media, the page fetches don't hold a thread each while they wait on AniList"""
+    app = current_app._get_current_object()
+    token = request.headers.get('Authorization')
+    if not token or token != "Bearer wnYW3pY6b/pmAsNur?sbx=EOrTDKqslHIGjG":
+        abort(403)
+
+    async def fetch():
+        # Only imported here, aiohttp is a good part of startup time and only these two views use it
+        import api_clients_async
+        # Empty lists aren't worth caching, they're usually a failed fetch
+        return await api_clients_async.fetch_all_character_media(va_id, app) or None
+
+    data = await CharacterMediaList.get_or_fetch_async(va_id, fetch, app.config['DOCUMENT_CACHE_MAX_AGE'])
+    return cacheable(jsonify(merge_user_list(data or [])))
+
+
+@views.route('/api/stream/character_media/<int:va_id>', methods=['GET'])
+def stream_character_media(va_id):
+    """Streaming version of /api/character_media, NDJSON with a line per page as AniList sends them"""
+    app = current_app._get_current_object()
+    token = request.headers.get('Authorization')
+    if not token or token != "Bearer wnYW3pY6b/pmAsNur?sbx=EOrTDKqslHIGjG":
+        abort(403)
+
+    return stream_list(CharacterMediaList, va_id, lambda: iter_character_media_pages(va_id, app), transform=merge_user_list,
+                       version=user_list_version())
 
 
-@app.route('/series/search', methods=['GET', 'POST'])
+@views.route('/series/search', methods=['GET', 'POST'])
 def series_search():
+    """Search for an anime series, one page at a time like va_search"""
+    app = current_app._get_current_object()
     
-    query = request.form.get('series-search')
-    print('QUERY:', query)
+    query = request.form.get('series-search') or request.args.get('q')
+    page = request.args.get('page', 1, type=int)
+    partial = request.args.get('partial') == '1'
     search_made = False
 
     if not query:
@@ -437,83 +756,42 @@ def series_search():
         return render_template('series-search.html', search_made=search_made)
 
     # Send the GraphQL query to the AniList API
-    response = search_anime_series(query, app)
+    response = search_anime_series(query, app, page=page)
     data = response["data"]
     search_made = True
 
-    app.logger.debug(f'*** SERIES SEARCH ROUTE. STATUS CODE: {data["status_code"]} ***')
-
     # Process the response
     if data['status_code'] == 200:
-        app.logger.debug('*** 200 CODE, RESPONSE IS GOOD ***')
         series = data['series']
+        # Remember the names for /api/suggest
+        get_name_index(app).add_many(media_entry(s) for s in series)
     else:
-        app.logger.debug(f'*** Request failed with status code: {data["status_code"]} ***')
+        app.logger.warning('Series search for %r failed with status code %s', query, data['status_code'])
         series = None
 
-    return render_template('series-search.html', series=series, query=query, search_made=search_made)
+    if partial:
+        if series is None:
+            abort(502)
+        return search_results_page('series-search-results.html', data['next_page'], series=series)
+
+    return render_template('series-search.html', series=series, query=query, search_made=search_made, next_page=data['next_page'])
 
-@app.route('/series/<int:series_id>', methods=['GET', 'POST'])
+@views.route('/series/<int:series_id>', methods=['GET', 'POST'])
 def series_details(series_id):
     """Grab the series details by AniList ID"""
+    app = current_app._get_current_object()
 
-    # Simplified query grabbing ONLY the series info for the ID. 
-    # No pagination needed. We're grabbing the series/character data in a separate call.
-    series_query = '''
-    query ($id: Int) {
-		Media(id: $id) {
-            title {
-                english
-                romaji
-            }
-            bannerImage
-            coverImage {
-                color
-                large
-            }
-            description
-            genres
-            episodes
-            idMal
-            id
-            season
-            seasonYear
-            studios {
-                edges {
-                    node {
-                        name
-                        id
-                    }
-                }
-            }
-            tags {
-                name
-                category
-                id
-            }
-        }
-    }
-    '''
-
-    # Variables, we literally only need ID here.
-    variables = {
-        'id': series_id,
-    }
+    def fetch_series():
+        return fetch_series_details(series_id, app)
 
-    # Send the GraphQL query to the AniList API
-    response = make_api_request(series_query, variables, app)
+    # Read from the database cache first, only hit AniList when it's missing or stale
+    series = MediaDocument.get_or_fetch(series_id, fetch_series, app.config['DOCUMENT_CACHE_MAX_AGE'])
 
     # Check if Media is None, 404 page if so
-    if response is None or response['data']['Media'] is None:
+    if series is None:
         # handle the case when the series is not found
         abort(404)
     else:
-        # Process the response normally
-        series = response['data']['Media']
-
-        app.logger.debug('########### RESPONSE FOR SERIES SUCCESSFUL ###########' )
-        #app.logger.debug(series)
-
         # Construct the output dictionary
         output = {
             'series': series
@@ -522,25 +800,96 @@ def series_details(series_id):
         return render_template('series-details.html', series_id=series_id, output=output)
 
 
-@app.route('/api/series_roles/<int:series_id>', methods=['GET'])
+@views.route('/api/series_roles/<int:series_id>', methods=['GET'])
 def get_series_roles(series_id):
     """API Endpoint to fetch characters & VA's from a series id and return json for front end"""
+    app = current_app._get_current_object()
     token = request.headers.get('Authorization')
     # Not a secture token or anything since we're storing it in git and it's visible on the front end js calls, but it's something I guess.
     if not token or token != "Bearer wnYW3pY6b/pmAsNur?sbx=EOrTDKqslHIGjG":
         abort(403)
-    data = fetch_series_characters_roles(series_id, app)
-    return jsonify(data)
+    # Empty lists aren't worth caching, they're usually a failed fetch
+    data = SeriesRoleList.get_or_fetch(series_id, lambda: fetch_series_characters_roles(series_id, app) or None,
+                                       app.config['DOCUMENT_CACHE_MAX_AGE'])
+    return cacheable(jsonify(data or []))
+
+
+@views.route('/api/async/series_roles/<int:series_id>', methods=['GET'])
+async def get_series_roles_async(series_id):
+    """Async version of /api/series_roles, the page fetches don't hold a thread each while they wait on AniList"""
+    app = current_app._get_current_object()
+    token = request.headers.get('Authorization')
+    if not token or token != "Bearer wnYW3pY6b/pmAsNur?sbx=EOrTDKqslHIGjG":
+        abort(403)
+
+    async def fetch():
+        # Imported on first use, see get_character_media_async
+        import api_clients_async
+        # Empty lists aren't worth caching, they're usually a failed fetch
+        return await api_clients_async.fetch_series_characters_roles(series_id, app) or None
 
+    data = await SeriesRoleList.get_or_fetch_async(series_id, fetch, app.config['DOCUMENT_CACHE_MAX_AGE'])
+    return cacheable(jsonify(data or []))
+
+
+@views.route('/api/stream/series_roles/<int:series_id>', methods=['GET'])
+def stream_series_roles(series_id):
+    """Streaming version of /api/series_roles, NDJSON with a line per page as AniList sends them"""
+    app = current_app._get_current_object()
+    token = request.headers.get('Authorization')
+    if not token or token != "Bearer wnYW3pY6b/pmAsNur?sbx=EOrTDKqslHIGjG":
+        abort(403)
 
-@app.errorhandler(404)
+    return stream_list(SeriesRoleList, series_id, lambda: iter_series_roles_pages(series_id, app))
+
+
+@views.route('/assets/<path:filename>')
+def serve_asset(filename):
+    """Fingerprinted files from flask build-assets, cached by browsers for good"""
+    app = current_app._get_current_object()
+    return assets.serve_asset(filename, app, request.accept_encodings)
+
+
+@views.route('/img/<int:width>', methods=['GET'])
+def image_proxy(width):
+    """Downsized, cached copy of an AniList image, see thumbnails.py. Use the thumbnail filter to link one."""
+    app = current_app._get_current_object()
+
+    url = request.args.get('url', '')
+    if width not in app.config['IMAGE_PROXY_WIDTHS'] or not thumbnails.allowed_url(url, app):
+        abort(404)
+
+    # Only when asked for by name, every browser sends */* too
+    fmt = 'webp' if any(mimetype == 'image/webp' and quality for mimetype, quality in request.accept_mimetypes) else 'jpeg'
+    try:
+        path = thumbnails.thumbnail(url, width, fmt, app)
+    except thumbnails.ImageProxyError as e:
+        # Let the browser try the original, a big image beats a broken one
+        app.logger.warning('Image proxy failed: %s', e)
+        return redirect(url)
+
+    response = send_file(path, mimetype=thumbnails.mimetype(fmt), conditional=True,
+                         max_age=app.config.get('IMAGE_PROXY_MAX_AGE', 30 * 24 * 3600))
+    response.vary.add('Accept')
+    return response
+
+
+@views.app_template_filter('thumbnail')
+def thumbnail_url(url, width=150):
+    """{{ character.image.large | thumbnail(150) }}, proxied + downsized image URL"""
+    if not url:
+        return url
+    return url_for('views.image_proxy', width=width, url=url)
+
+
+@views.app_errorhandler(404)
 def page_not_found(e):
     """404 Page Template"""
     return render_template('404.html'), 404
 
 
 # Register the time_since filter as a decorator
-@app.template_filter('time_since')
+@views.app_template_filter('time_since')
 def time_since(dt):
     now = datetime.utcnow()
     diff = now - dt
@@ -563,9 +912,32 @@ def time_since(dt):
         return "Just now"
 
 
-# Add the following lines to create the application context and call db.create_all()
-with app.app_context():
+@views.cli.command('migrate-anime-lists')
+def migrate_anime_lists():
+    """Move pickled users.anime_list data into the user_list_entries table"""
+    print(f'Migrated {migrate_pickled_anime_lists()} anime lists')
+
+
+@views.cli.command('build-assets')
+def build_assets():
+    """Fingerprint, precompress and resize everything in static/ into static/dist"""
+    app = current_app._get_current_object()
+    manifest = assets.build_assets(app.static_folder, assets.dist_folder(app),
+                                   widths=app.config['ASSET_IMAGE_WIDTHS'], formats=app.config['ASSET_IMAGE_FORMATS'],
+                                   exclude=app.config['ASSET_EXCLUDE'])
+    print(f"Built {len(manifest['files'])} files, {len(manifest['images'])} with responsive variants")
+
+
+@views.cli.command('create-db')
+def create_db():
+    """Create any missing tables, for a fresh local database. Use flask db upgrade for real ones."""
     db.create_all()
+    print('Created the tables')
+
+
+# gunicorn app:app, flask run, worker.py and the tests all use this one. Building it only sets things up,
+# the database is first touched by a request.
+app = create_app()
 
 if __name__ == '__main__':
     # Use app.run() only when running locally
@@ -0,0 +1,294 @@
+"""Static asset pipeline, fingerprinted filenames + precompressed siblings + responsive images
+
+`flask build-assets` copies everything under static/ into static/dist/ with a content hash in
+the filename (app.css -> app.3f2a9c01d4e5.css) and writes a manifest.json mapping the
+original paths to the hashed ones. Because a changed file gets a new name, /assets/ can tell
+browsers to cache forever (immutable) and nothing ever goes stale.
+
+Alongside that:
+- text assets (css, js, svg) get .gz and .br siblings, compressed once at the highest level
+  and picked by serve_asset from Accept-Encoding instead of compressing every request
+- JPG / PNG images get AVIF + WebP variants at ASSET_IMAGE_WIDTHS, which responsive_image
+  turns into a <picture> with srcset, and app.css background images into image-set()
+
+Templates use asset_url('app.css') and responsive_image('images/x.jpg', ...). With no
+manifest (build never ran, ie. tests or a quick local run) they fall back to plain /static/
+URLs so the app still works, just without the long cache.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+import brotli
+from flask import send_from_directory, url_for
+from markupsafe import Markup, escape
+from PIL import Image, features
+
+
+MANIFEST_NAME = 'manifest.json'
+
+# Served through serve_asset with the right encoding, compressing them again is wasted CPU
+TEXT_EXTENSIONS = {'.css', '.js', '.svg', '.json', '.txt'}
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+# Sources and dev leftovers, not served
+SKIP_EXTENSIONS = {'.scss', '.map'}
+
+IMAGE_MIMETYPES = {'avif': 'image/avif', 'webp': 'image/webp'}
+# Encoder settings per variant format, quality picked by eye on the backgrounds
+IMAGE_SAVE_OPTIONS = {'avif': {'quality': 55, 'speed': 6}, 'webp': {'quality': 78, 'method': 6}}
+
+# url(/static/...) in css, rewritten to the hashed file under /assets/ (see serve_asset in app.py)
+CSS_URL_RE = re.compile(r'url\(\s*([\'"]?)/static/([^)\'"]+)\1\s*\)')
+CSS_BACKGROUND_RE = re.compile(r'background-image:\s*url\(\s*[\'"]?/static/([^)\'"]+)[\'"]?\s*\);')
+
+_manifest = None
+
+
+def content_hash(data):
+    """Short hex digest of a file's bytes, goes in its filename"""
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def hashed_name(path, digest, suffix='', extension=None):
+    """images/bg.jpg -> images/bg<suffix>.<digest>.jpg (or .<extension>)"""
+
+    root, ext = os.path.splitext(path)
+    return f'{root}{suffix}.{digest}{extension and "." + extension or ext}'
+
+
+def write_compressed(path, data):
+    """Write .gz / .br siblings of a text asset, only where they actually come out smaller"""
+
+    for encoding_ext, compressed in (('.gz', gzip.compress(data, compresslevel=9, mtime=0)),
+                                     ('.br', brotli.compress(data, quality=11))):
+        if len(compressed) < len(data):
+            with open(path + encoding_ext, 'wb') as f:
+                f.write(compressed)
+
+
+def image_variants(source_path, rel_path, original_name, out_folder, widths, formats):
+    """Resize one image to every width in every format, never upscaling (a width past the
+    image's own is made at its own width instead). Where a full size variant comes out bigger
+    than the original (already well compressed JPGs) the original is listed in its place.
+
+    Returns the manifest entry, {'width', 'height', 'variants': {mimetype: [[url path, width], ...]}}.
+    """
+
+    entry = {'variants': {}}
+
+    with Image.open(source_path) as image:
+        entry['width'], entry['height'] = image.size
+        sizes = sorted({min(width, image.width) for width in widths})
+
+        for fmt in formats:
+            if not features.check(fmt):
+                print(f'  Pillow was built without {fmt} support, skipping {fmt} variants')
+                continue
+
+            variants = []
+            for width in sizes:
+                resized = image if width == image.width else image.resize(
+                    (width, round(image.height * width / image.width)), Image.LANCZOS)
+                # Palette / greyscale PNGs, keeping any transparency
+                if resized.mode not in ('RGB', 'RGBA'):
+                    has_alpha = 'A' in resized.mode or 'transparency' in resized.info
+                    resized = resized.convert('RGBA' if has_alpha else 'RGB')
+
+                tmp_path = os.path.join(out_folder, f'.tmp.{fmt}')
+                resized.save(tmp_path, fmt.upper(), **IMAGE_SAVE_OPTIONS[fmt])
+                with open(tmp_path, 'rb') as f:
+                    data = f.read()
+
+                if width == image.width and len(data) >= os.path.getsize(source_path):
+                    os.remove(tmp_path)
+                    variants.append([original_name, width])
+                    continue
+
+                name = hashed_name(rel_path, content_hash(data), suffix=f'-{width}w', extension=fmt)
+                os.replace(tmp_path, os.path.join(out_folder, name))
+                variants.append([name, width])
+
+            entry['variants'][IMAGE_MIMETYPES[fmt]] = variants
+
+    return entry
+
+
+def build_assets(static_folder, out_folder, widths=(480, 960, 1920), formats=('avif', 'webp'), exclude=()):
+    """Build static_folder into out_folder (emptied first) and write its manifest.json. Returns the manifest.
+
+    Paths under static_folder starting with anything in exclude are left out.
+    """
+
+    if os.path.isdir(out_folder):
+        shutil.rmtree(out_folder)
+    os.makedirs(out_folder)
+
+    manifest = {'files': {}, 'images': {}}
+    css_files = []
+
+    for dirpath, dirnames, filenames in os.walk(static_folder):
+        # Don't build the last build
+        dirnames[:] = [d for d in dirnames if os.path.join(dirpath, d) != out_folder]
+
+        for filename in sorted(filenames):
+            source_path = os.path.join(dirpath, filename)
+            rel_path = os.path.relpath(source_path, static_folder).replace(os.sep, '/')
+            ext = os.path.splitext(filename)[1].lower()
+
+            if ext in SKIP_EXTENSIONS or filename.startswith('.') or rel_path.startswith(tuple(exclude)):
+                continue
+            # css points at images, hash those first so its url()'s can be rewritten
+            if ext == '.css':
+                css_files.append((source_path, rel_path))
+                continue
+
+            with open(source_path, 'rb') as f:
+                data = f.read()
+            name = hashed_name(rel_path, content_hash(data))
+            out_path = os.path.join(out_folder, name)
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            shutil.copyfile(source_path, out_path)
+            manifest['files'][rel_path] = name
+
+            if ext in TEXT_EXTENSIONS:
+                write_compressed(out_path, data)
+            elif ext in IMAGE_EXTENSIONS and formats:
+                manifest['images'][rel_path] = image_variants(source_path, rel_path, name, out_folder, widths, formats)
+
+    for source_path, rel_path in css_files:
+        with open(source_path, encoding='utf-8') as f:
+            css = rewrite_css(f.read(), manifest)
+
+        data = css.encode('utf-8')
+        name = hashed_name(rel_path, content_hash(data))
+        out_path = os.path.join(out_folder, name)
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        with open(out_path, 'wb') as f:
+            f.write(data)
+        write_compressed(out_path, data)
+        manifest['files'][rel_path] = name
+
+    with open(os.path.join(out_folder, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def rewrite_css(css, manifest):
+    """Point url(/static/...) at the hashed files. Background images that have AVIF / WebP
+    variants also get an image-set() declaration after the plain one, browsers that don't
+    know image-set() keep the first."""
+
+    def background(match):
+        image = manifest['images'].get(match.group(1))
+        if not image or not image['variants']:
+            return match.group(0)
+
+        # A background is drawn across the page, use the largest variant of each format
+        # (skipping formats that fell back to the original)
+        candidates = [f'url(/assets/{variants[-1][0]}) type("{mimetype}")'
+                      for mimetype, variants in image['variants'].items()
+                      if variants and variants[-1][0].endswith('.' + mimetype.split('/')[1])]
+        if not candidates:
+            return match.group(0)
+        return f'{match.group(0)}\n  background-image: image-set({", ".join(candidates)});'
+
+    def url(match):
+        name = manifest['files'].get(match.group(2))
+        return f'url(/assets/{name})' if name else match.group(0)
+
+    return CSS_URL_RE.sub(url, CSS_BACKGROUND_RE.sub(background, css))
+
+
+def dist_folder(app):
+    return os.path.join(app.static_folder, app.config.get('ASSET_DIST_FOLDER', 'dist'))
+
+
+def get_manifest(app):
+    """The built manifest, read once per process. Empty if the build hasn't been run."""
+    global _manifest
+
+    if _manifest is None:
+        try:
+            with open(os.path.join(dist_folder(app), MANIFEST_NAME)) as f:
+                _manifest = json.load(f)
+        except FileNotFoundError:
+            app.logger.info('No asset manifest, serving unhashed /static/ files. Run flask build-assets.')
+            _manifest = {'files': {}, 'images': {}}
+
+    return _manifest
+
+
+def reset_manifest():
+    """Forget the manifest (next use reads it again)"""
+    global _manifest
+    _manifest = None
+
+
+def asset_url(path, app):
+    """URL of the built, hashed copy of static/<path>, or the plain static URL if there is none"""
+
+    name = get_manifest(app)['files'].get(path)
+    if name is None:
+        return url_for('static', filename=path)
+    return url_for('views.serve_asset', filename=name)
+
+
+def responsive_image(path, app, alt='', sizes='100vw', **attrs):
+    """<picture> for static/<path> with AVIF / WebP srcsets, the original as the <img> fallback.
+
+    attrs go on the <img>, use class_ for class.
+    """
+
+    image = get_manifest(app)['images'].get(path, {})
+    attrs = {key.rstrip('_').replace('_', '-'): value for key, value in attrs.items()}
+    if 'width' in image:
+        # Lets the browser reserve the space before the image arrives
+        attrs.setdefault('width', image['width'])
+        attrs.setdefault('height', image['height'])
+
+    sources = []
+    for mimetype, variants in image.get('variants', {}).items():
+        srcset = ', '.join(f'{url_for("views.serve_asset", filename=name)} {width}w' for name, width in variants)
+        sources.append(f'<source type="{mimetype}" srcset="{escape(srcset)}" sizes="{escape(sizes)}" />')
+
+    img_attrs = ''.join(f' {key}="{escape(value)}"' for key, value in attrs.items())
+    img = f'<img src="{escape(asset_url(path, app))}" alt="{escape(alt)}"{img_attrs} />'
+
+    return Markup(f'<picture>{"".join(sources)}{img}</picture>')
+
+
+def serve_asset(filename, app, accept_encodings):
+    """Response for a built asset: the .br / .gz sibling when the client takes it, cached forever"""
+
+    folder = dist_folder(app)
+    mimetype = None
+    encoding = None
+
+    for candidate, ext in (('br', '.br'), ('gzip', '.gz')):
+        if accept_encodings[candidate] and os.path.isfile(os.path.join(folder, filename + ext)):
+            encoding = candidate
+            break
+
+    # Typed as the file it stands in for, not as .br / .gz
+    if encoding:
+        mimetype = mimetypes.guess_type(filename)[0]
+
+    response = send_from_directory(folder, filename + ('.br' if encoding == 'br' else '.gz' if encoding else ''),
+                                   mimetype=mimetype, conditional=True)
+
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    # Every file that could be compressed varies, whether or not this client got it compressed
+    if os.path.splitext(filename)[1].lower() in TEXT_EXTENSIONS:
+        response.vary.add('Accept-Encoding')
+
+    response.cache_control.public = True
+    response.cache_control.max_age = int(app.config.get('ASSET_MAX_AGE', 365 * 24 * 3600))
+    response.cache_control.immutable = True
+    return response
@@ -0,0 +1,117 @@
+"""Concurrent throughput of the sync AniList client vs the async one.
+
+Fires --concurrency different series_roles lookups at once (different ids, so nothing is
+coalesced or cached) against the local stand-in in tests/fake_anilist.py and reports lookups
+per second and how many threads each side needed to get there.
+
+    python benchmarks/bench_async_client.py
+    python benchmarks/bench_async_client.py --concurrency 50 --pages 8 --latency 0.2
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import api_cache
+import api_clients
+import api_clients_async
+import rate_limiter
+from tests.fake_anilist import FakeAniList
+
+
+def client_threads():
+    """Threads alive right now, leaving out the fake AniList's own request handlers"""
+    return sum(1 for thread in threading.enumerate() if 'process_request_thread' not in thread.name)
+
+
+class ThreadCounter(object):
+    """Samples client_threads() in the background and keeps the peak"""
+
+    def __init__(self):
+        self.peak = client_threads()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.done.wait(0.005):
+            self.peak = max(self.peak, client_threads())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.done.set()
+        self.thread.join()
+
+
+def reset():
+    api_clients.reset_session()
+    api_clients_async.reset_client()
+    rate_limiter.reset_scheduler()
+    api_cache.reset_response_cache()
+
+
+def run_sync(app, ids):
+    """One request thread per lookup, like a threaded worker serving that many users"""
+    with ThreadPoolExecutor(max_workers=len(ids)) as pool:
+        return list(pool.map(lambda series_id: api_clients.fetch_series_characters_roles(series_id, app), ids))
+
+
+def run_async(app, ids):
+    """Every lookup awaited together on one loop"""
+    async def lookups():
+        return await asyncio.gather(*(api_clients_async.fetch_series_characters_roles(series_id, app) for series_id in ids))
+    return asyncio.run(lookups())
+
+
+def measure(label, fake, app, ids, run):
+    reset()
+    fake.reset_counts()
+    baseline = client_threads()
+
+    with ThreadCounter() as threads:
+        start = time.perf_counter()
+        results = run(app, ids)
+        elapsed = time.perf_counter() - start
+
+    assert all(results), f'{label}: a lookup came back empty'
+    print(f'{label:<6} lookups={len(ids):<4} upstream requests={fake.request_count:<5} '
+          f'wall={elapsed:6.2f}s  throughput={len(ids) / elapsed:7.1f}/s  extra threads={threads.peak - baseline}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--pages', type=int, default=6)
+    parser.add_argument('--latency', type=float, default=0.1, help='seconds the fake AniList takes per request')
+    parser.add_argument('--pool-size', type=int, default=50)
+    args = parser.parse_args()
+
+    with FakeAniList(pages=args.pages, latency=args.latency) as fake:
+        app = Flask('bench')
+        app.config.update(
+            ANILIST_API_URL=fake.url,
+            ANILIST_POOL_SIZE=args.pool_size,
+            ANILIST_PAGE_WORKERS=args.pool_size,
+            # Measuring the client, not the rate limit
+            ANILIST_RATE_LIMIT=1000000,
+        )
+        ids = list(range(1, args.concurrency + 1))
+
+        measure('sync', fake, app, ids, run_sync)
+        measure('async', fake, app, ids, run_async)
+        reset()
+
+
+if __name__ == '__main__':
+    main()
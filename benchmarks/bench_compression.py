@@ -0,0 +1,96 @@
+"""Bytes on the wire and CPU cost of response compression.
+
+Requests /api/series_roles/<id> and /series/<id> through the Flask app (against the local
+stand-in in tests/fake_anilist.py, with a throwaway sqlite database) with no compression,
+gzip and brotli at a few levels, and reports the response size and the extra CPU time per
+response compared to sending it uncompressed.
+
+    python benchmarks/bench_compression.py
+    python benchmarks/bench_compression.py --pages 8 --repeat 200
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app.py reads these at import time
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+os.environ.setdefault('SECRET_KEY', 'bench')
+
+import api_cache
+import api_clients
+import rate_limiter
+from app import app
+from models import db
+from tests.fake_anilist import FakeAniList
+
+AUTH_HEADER = {'Authorization': 'Bearer wnYW3pY6b/pmAsNur?sbx=EOrTDKqslHIGjG'}
+
+# (Accept-Encoding, config setting for the level, levels to try)
+ENCODINGS = [
+    ('identity', None, [None]),
+    ('gzip', 'COMPRESS_LEVEL', [1, 6, 9]),
+    ('br', 'COMPRESS_BR_LEVEL', [1, 4, 11]),
+]
+
+
+def measure(client, path, encoding, repeat):
+    """(bytes on the wire, CPU seconds per response)"""
+
+    headers = dict(AUTH_HEADER, **{'Accept-Encoding': encoding})
+    size = len(client.get(path, headers=headers).data)
+
+    start = time.process_time()
+    for _ in range(repeat):
+        client.get(path, headers=headers).data
+    return size, (time.process_time() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=6, help='pages of characters the series has')
+    parser.add_argument('--repeat', type=int, default=100, help='requests timed per row')
+    args = parser.parse_args()
+
+    with FakeAniList(pages=args.pages) as fake, app.app_context():
+        app.config.update(ANILIST_API_URL=fake.url, DEBUG_TB_ENABLED=False)
+        db.engine.echo = False
+        api_clients.reset_session()
+        rate_limiter.reset_scheduler()
+        api_cache.reset_response_cache()
+        db.create_all()
+
+        client = app.test_client()
+        levels = {setting: app.config[setting] for _, setting, _ in ENCODINGS if setting}
+
+        for path in ('/api/series_roles/7', '/series/7'):
+            # Warm the caches so only rendering + compression is timed
+            for _ in range(10):
+                client.get(path, headers=AUTH_HEADER)
+            baseline = None
+            print(path)
+
+            for encoding, setting, encoding_levels in ENCODINGS:
+                for level in encoding_levels:
+                    if setting:
+                        app.config[setting] = level
+                    size, cpu = measure(client, path, encoding, args.repeat)
+
+                    if baseline is None:
+                        baseline = (size, cpu)
+                    label = encoding if level is None else f'{encoding}-{level}'
+                    print(f'  {label:<9} bytes={size:<8} ratio={baseline[0] / size:5.1f}x  '
+                          f'cpu/response={cpu * 1000:7.2f}ms  extra cpu={(cpu - baseline[1]) * 1000:6.2f}ms')
+
+            app.config.update(levels)
+
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Per-page latency of AniList requests: one-off requests.post vs the pooled session.
+
+Runs against the local stand-in server in tests/fake_anilist.py, so no network access needed.
+
+    python benchmarks/bench_http_pool.py
+    python benchmarks/bench_http_pool.py --pages 20 --tls   # TLS shows the handshake cost best
+"""
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+from flask import Flask
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import api_clients
+from tests.fake_anilist import FakeAniList
+
+CHARACTER_MEDIA_QUERY = '''
+query ($id: Int, $page: Int, $perPage: Int) {
+    Staff(id: $id) {
+        characterMedia(page: $page, perPage: $perPage) {
+            pageInfo { total currentPage lastPage hasNextPage }
+            edges { node { id } characters { id } }
+        }
+    }
+}
+'''
+
+
+def make_self_signed_cert(directory):
+    """Create a throwaway cert/key pair with the openssl CLI"""
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+         '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1', '-keyout', keyfile, '-out', certfile],
+        check=True, capture_output=True,
+    )
+    return certfile, keyfile
+
+
+def unpooled_page(url, page):
+    """What make_api_request used to do: a brand new connection for every page"""
+    variables = {'id': 1, 'page': page, 'perPage': 25}
+    response = requests.post(url, json={'query': CHARACTER_MEDIA_QUERY, 'variables': variables},
+                             headers={'Content-Type': 'application/json'})
+    return response.json()
+
+
+def pooled_page(app, page):
+    variables = {'id': 1, 'page': page, 'perPage': 25}
+    return api_clients.make_api_request(CHARACTER_MEDIA_QUERY, variables, app)
+
+
+def run(label, fake, pages, rounds, fetch_page):
+    timings = []
+    fake.reset_counts()
+    for _ in range(rounds):
+        for page in range(1, pages + 1):
+            start = time.perf_counter()
+            fetch_page(page)
+            timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    print(f'{label:<10} pages={len(timings):<5} connections={fake.connection_count:<5} '
+          f'mean={statistics.mean(timings):7.2f}ms  p50={timings[len(timings) // 2]:7.2f}ms  '
+          f'p95={timings[int(len(timings) * 0.95) - 1]:7.2f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--tls', action='store_true', help='serve over HTTPS with a self-signed cert')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    certfile = keyfile = None
+    if args.tls:
+        certfile, keyfile = make_self_signed_cert(tmpdir)
+        # Trust our self-signed cert (it is its own CA), requests reads this for every call
+        os.environ['REQUESTS_CA_BUNDLE'] = certfile
+
+    try:
+        with FakeAniList(pages=args.pages, certfile=certfile, keyfile=keyfile) as fake:
+            app = Flask('bench')
+            app.config['ANILIST_API_URL'] = fake.url
+
+            api_clients.reset_session()
+
+            run('before', fake, args.pages, args.rounds, lambda page: unpooled_page(fake.url, page))
+            run('after', fake, args.pages, args.rounds, lambda page: pooled_page(app, page))
+
+            api_clients.reset_session()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
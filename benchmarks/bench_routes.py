@@ -0,0 +1,70 @@
+"""Route timings against the recorded AniList fixtures, so regressions show up as numbers.
+
+Every route runs twice over:
+    cold -- nothing cached (response cache and document tables emptied before each round),
+            so every AniList page is fetched, parsed, stored and rendered
+    warm -- the same request again, served from the document cache
+
+    pip install pytest-benchmark
+    python -m pytest benchmarks/bench_routes.py
+    python -m pytest benchmarks/bench_routes.py --anilist-pages 10 --anilist-latency 0.05
+    python -m pytest benchmarks/bench_routes.py --benchmark-autosave     # later: --benchmark-compare
+
+See conftest.py for the fake AniList options.
+"""
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+import api_cache
+from app import app
+from models import db, StaffDocument, MediaDocument, CharacterMediaList, SeriesRoleList
+
+AUTH_HEADER = {'Authorization': 'Bearer wnYW3pY6b/pmAsNur?sbx=EOrTDKqslHIGjG'}
+
+# (route, url), the ids and searches are the ones in tests/fixtures/anilist
+ROUTES = [
+    ('va_search', '/va/search?q=Nakai'),
+    ('va_details', '/va/100938'),
+    ('get_character_media', '/api/character_media/111635'),
+    ('series_search', '/series/search?q=Demon+Slayer'),
+    ('get_series_roles', '/api/series_roles/101922'),
+]
+
+
+def clear_caches():
+    api_cache.reset_response_cache()
+    for model in (StaffDocument, MediaDocument, CharacterMediaList, SeriesRoleList):
+        db.session.execute(db.delete(model))
+    db.session.commit()
+
+
+@pytest.fixture
+def get(anilist):
+    """GET a url through the test client, failing loudly if the answer isn't a full 200"""
+
+    client = app.test_client()
+
+    def get(url):
+        resp = client.get(url, headers=AUTH_HEADER)
+        assert resp.status_code == 200, url
+        return resp.get_data()
+
+    clear_caches()
+    anilist.misses.clear()
+    yield get
+    assert not anilist.misses, f'No fixture for {anilist.misses}'
+
+
+@pytest.mark.parametrize('route, url', ROUTES, ids=[route for route, url in ROUTES])
+def test_cold(benchmark, get, route, url):
+    benchmark.group = 'cold'
+    benchmark.pedantic(get, args=(url,), setup=clear_caches, rounds=20, warmup_rounds=1)
+
+
+@pytest.mark.parametrize('route, url', ROUTES, ids=[route for route, url in ROUTES])
+def test_warm(benchmark, get, route, url):
+    benchmark.group = 'warm'
+    get(url)
+    benchmark(get, url)
@@ -0,0 +1,83 @@
+"""Cold start: how long a fresh process takes to import app.py, build another app with create_app(),
+and answer its first request.
+
+Every run is a new interpreter, the way a gunicorn worker or a test run starts. DATABASE_URL points
+at a database that can't be opened, so this also checks that starting up never touches it.
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 20 --importtime   # plus the 15 slowest imports
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the child process, prints its timings as JSON
+CHILD = '''
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+second = app.create_app()
+created = time.perf_counter()
+status = app.app.test_client().get('/').status_code
+answered = time.perf_counter()
+print(json.dumps({'import': imported - started, 'create_app': created - imported,
+                  'first_request': answered - created, 'status': status}))
+'''
+
+
+def run_child(env, importtime=False):
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', CHILD]
+    result = subprocess.run(command, cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode:
+        sys.exit(result.stderr)
+    return json.loads(result.stdout.splitlines()[-1]), result.stderr
+
+
+def slowest_imports(stderr, count):
+    """(cumulative microseconds, module) from python -X importtime output, slowest first"""
+
+    rows = []
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and 'cumulative' not in line:
+            _, cumulative, module = line[len('import time:'):].split('|')
+            # Only app.py's own imports (indented one level under it), the ones under those are counted in them already
+            if module.startswith('   ') and not module.startswith('    '):
+                rows.append((int(cumulative), module.strip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10, help='fresh processes timed')
+    parser.add_argument('--importtime', action='store_true', help='also list the slowest imports')
+    args = parser.parse_args()
+
+    env = dict(os.environ, SECRET_KEY='bench', LOG_LEVEL='WARNING',
+               # Opening this fails, so any query at startup shows up as an error
+               DATABASE_URL='sqlite:///' + os.path.join(tempfile.gettempdir(), 'onsei-no-such-dir', 'bench.db'))
+
+    # One unmeasured run so the .pyc files are written
+    run_child(env)
+    runs = [run_child(env)[0] for _ in range(args.runs)]
+
+    for key in ('import', 'create_app', 'first_request'):
+        times = [run[key] * 1000 for run in runs]
+        print(f'{key:<14} median={statistics.median(times):7.1f}ms  min={min(times):7.1f}ms  max={max(times):7.1f}ms')
+    print(f"GET / answered {runs[0]['status']} without a database")
+
+    if args.importtime:
+        print('\nslowest imports (cumulative):')
+        for microseconds, module in slowest_imports(run_child(env, importtime=True)[1], 15):
+            print(f'  {microseconds / 1000:7.1f}ms  {module}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""pytest setup for benchmarks/bench_routes.py, the app runs against the recorded AniList fixtures"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+# create_app() reads these when app.py is imported
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+os.environ.setdefault('SECRET_KEY', 'bench')
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('anilist', 'fake AniList for the route benchmarks')
+    group.addoption('--anilist-latency', type=float, default=0.0, help='seconds the fake AniList takes per request')
+    group.addoption('--anilist-pages', type=int, default=4, help='pages every recorded list is stretched to')
+    group.addoption('--anilist-transport', choices=['inprocess', 'http'], default='inprocess',
+                    help='hand requests straight to the fake, or go through a local HTTP server')
+
+
+@pytest.fixture(scope='session')
+def anilist(request):
+    """The fake AniList the app is pointed at, fixtures only"""
+
+    import api_cache
+    import api_clients
+    import rate_limiter
+    from app import app
+    from fake_anilist import FakeAniList, FIXTURES_DIR
+    from models import db
+
+    option = request.config.getoption
+    fake = FakeAniList(fixtures=FIXTURES_DIR, generate=False, repeat_pages=option('--anilist-pages'),
+                       latency=option('--anilist-latency'))
+    if option('--anilist-transport') == 'http':
+        fake.start()
+
+    settings = {key: app.config.get(key) for key in ('ANILIST_API_URL', 'ANILIST_RATE_LIMIT', 'DEBUG_TB_ENABLED')}
+    # Measuring the app, not the rate limit
+    app.config.update(ANILIST_API_URL=fake.url, ANILIST_RATE_LIMIT=1000000, DEBUG_TB_ENABLED=False)
+
+    api_clients.reset_session()
+    rate_limiter.reset_scheduler()
+    api_cache.reset_response_cache()
+    if fake.server is None:
+        fake.install(api_clients.get_session(app))
+
+    with app.app_context():
+        db.engine.echo = False
+        db.create_all()
+        yield fake
+        db.session.remove()
+        db.drop_all()
+
+    fake.stop()
+    app.config.update(settings)
+    api_clients.reset_session()
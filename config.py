@@ -1,15 +1,96 @@
 """ Config class setup """
 import os
+import tempfile
+from datetime import timedelta
 
 class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
     ANILIST_CLIENT_ID = os.environ.get('ANILIST_CLIENT_ID')
     ANILIST_CLIENT_SECRET = os.environ.get('ANILIST_CLIENT_SECRET')
-    # ANILIST_API_URL = 'https://graphql.anilist.co'
-    # ANILIST_API_HEADERS = {'Content-Type': 'application/json'}
+    # AniList GraphQL client, see api_clients.py
+    ANILIST_API_URL = 'https://graphql.anilist.co'
+    ANILIST_POOL_SIZE = 10
+    ANILIST_CONNECT_TIMEOUT = 3.05
+    ANILIST_READ_TIMEOUT = 10
+    # Max pages fetched in parallel across the whole process
+    ANILIST_PAGE_WORKERS = 8
+    # Rate limit scheduler, see rate_limiter.py. The limit is learned from response headers,
+    # this is just the starting guess.
+    ANILIST_RATE_LIMIT = 90
+    ANILIST_BACKGROUND_RESERVE = 0.2
+    ANILIST_QUEUE_TIMEOUT = 30
+    ANILIST_MAX_RETRIES = 3
+    # Response cache, see api_cache.py. TTLs (seconds) are per query name and merged over
+    # the defaults there, ie. {'Staff': 600}
+    ANILIST_CACHE_MAX_ENTRIES = 2000
+    ANILIST_CACHE_MAX_BYTES = 64 * 1024 * 1024
+    ANILIST_CACHE_TTLS = None
+    # How long Staff / Media documents stored in the database stay fresh, see models.py
+    DOCUMENT_CACHE_MAX_AGE = timedelta(hours=24)
+    # Seconds browsers may reuse a JSON API response before revalidating it with its ETag
+    API_CACHE_MAX_AGE = 0
+    # Most VA's + series the /api/suggest name index holds, see name_index.py
+    NAME_INDEX_MAX_ENTRIES = 50000
+    # Background jobs, see jobs.py / worker.py. Failed jobs retry after JOB_RETRY_DELAY * attempts,
+    # running jobs older than JOB_MAX_RUNTIME are assumed dead and queued again.
+    JOB_POLL_INTERVAL = 1.0
+    JOB_MAX_ATTEMPTS = 3
+    JOB_RETRY_DELAY = timedelta(seconds=30)
+    JOB_MAX_RUNTIME = timedelta(minutes=10)
+    # List refreshes only fetch what changed since the last one, with a full resync this often
+    ANILIST_LIST_FULL_SYNC_INTERVAL = timedelta(days=7)
+    # Response compression (Flask-Compress), brotli for browsers that take it, else gzip. Small
+    # responses aren't worth the CPU. NDJSON streams go out as they are so pages aren't held back.
+    COMPRESS_ALGORITHM = ['br', 'gzip']
+    COMPRESS_MIMETYPES = ['text/html', 'application/json']
+    COMPRESS_MIN_SIZE = 1024
+    COMPRESS_LEVEL = 6
+    COMPRESS_BR_LEVEL = 4
+    COMPRESS_STREAMS = False
+    # Static asset build (flask build-assets), see assets.py. Output goes in static/<ASSET_DIST_FOLDER>
+    # and is served from /assets/ with a year long immutable Cache-Control, the names change with the content.
+    ASSET_DIST_FOLDER = 'dist'
+    ASSET_IMAGE_WIDTHS = (480, 960, 1920)
+    ASSET_IMAGE_FORMATS = ('avif', 'webp')
+    # Only linked from the README on GitHub
+    ASSET_EXCLUDE = ('images/screens/',)
+    ASSET_MAX_AGE = 365 * 24 * 3600
+    # Image proxy for AniList artwork (/img/<width>?url=...), see thumbnails.py. Thumbnails are
+    # kept on disk up to IMAGE_PROXY_MAX_BYTES, least recently used deleted first.
+    IMAGE_PROXY_HOSTS = ('s4.anilist.co',)
+    IMAGE_PROXY_WIDTHS = (64, 150, 300)
+    IMAGE_PROXY_FOLDER = os.environ.get('IMAGE_PROXY_FOLDER', os.path.join(tempfile.gettempdir(), 'onsei-thumbnails'))
+    IMAGE_PROXY_MAX_BYTES = 256 * 1024 * 1024
+    IMAGE_PROXY_MAX_SOURCE_BYTES = 10 * 1024 * 1024
+    # Originals are refused over this many pixels before they're decoded, small files can be huge images
+    IMAGE_PROXY_MAX_SOURCE_PIXELS = 25 * 1000 * 1000
+    IMAGE_PROXY_QUALITY = 80
+    IMAGE_PROXY_MAX_AGE = 30 * 24 * 3600
+    # /metrics (see metrics.py) asks for this as a bearer token when it's set, Prometheus sends it
+    # with authorization: {credentials: ...} in the scrape config
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # Without a token /metrics is a 404 unless this is on (METRICS_PUBLIC=1 in .env), or in debug / testing
+    METRICS_PUBLIC = os.environ.get('METRICS_PUBLIC', '').lower() in ('1', 'true', 'yes')
+    # Server-Timing header on every response, user / anilist / db / template / total time
+    SERVER_TIMING = True
+    # Log the same breakdown for requests taking at least this many seconds, 0 logs every
+    # request, None is off. ie. REQUEST_TIMING_LOG=0.5 in .env
+    REQUEST_TIMING_LOG = float(os.environ['REQUEST_TIMING_LOG']) if os.environ.get('REQUEST_TIMING_LOG') else None
+    # Logging, see logs.py. LOG_LEVELS sets the exceptions per category, ie.
+    # LOG_LEVELS=onsei.anilist=DEBUG,sqlalchemy.engine=INFO in .env shows AniList requests and SQL.
+    # LOG_SAMPLING keeps 1 in N DEBUG / INFO lines per category, the same way.
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+    LOG_LEVELS = os.environ.get('LOG_LEVELS')
+    LOG_SAMPLING = os.environ.get('LOG_SAMPLING')
+    LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+    # Longest message (or extra field) written, past that it's cut off
+    LOG_MAX_CHARS = 2000
+    # Records waiting for the log thread, past that they're dropped rather than slowing requests down
+    LOG_QUEUE_SIZE = 10000
     SECRET_KEY = os.environ.get('SECRET_KEY')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    SQLALCHEMY_ECHO = True
+    # SQL goes through logging instead, LOG_LEVELS=sqlalchemy.engine=INFO
+    SQLALCHEMY_ECHO = False
     DEBUG = False
     DEBUG_TB_INTERCEPT_REDIRECTS = False
 
@@ -19,6 +100,8 @@ class ProductionConfig(Config):
 
 class DevelopmentConfig(Config):
     DEBUG = True
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'DEBUG')
+    LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
     DEBUG_TB_INTERCEPT_REDIRECTS = False
 
 class TestingConfig(Config):
@@ -0,0 +1,29 @@
+"""Helpers for joining AniList data with a user's own anime list"""
+
+
+def annotate_character_media(edges, entries, on_list_only=False):
+    """Copy of the characterMedia edges with the user's list status and score on each node.
+
+    entries is {media_id: {'status': .., 'score': ..}} for the user's list, User.anime_list_entries()
+    only needs to load the ids in edges. Adds the onUserList / userListStatus / userListScore /
+    userListSeasonYear fields the VA page used to work out in the browser. With on_list_only,
+    edges not on the list are dropped.
+    """
+
+    annotated = []
+
+    for edge in edges:
+        node = edge['node']
+        entry = entries.get(node['id'])
+
+        if entry is not None:
+            node = dict(node, onUserList=True, userListStatus=entry['status'], userListScore=entry['score'],
+                        userListSeasonYear=node.get('seasonYear'))
+        elif on_list_only:
+            continue
+        else:
+            node = dict(node, onUserList=False)
+
+        annotated.append(dict(edge, node=node))
+
+    return annotated
@@ -0,0 +1,225 @@
+"""Background job queue, kept in the jobs table so queued work survives restarts
+
+The web app enqueues jobs (enqueue, enqueue_list_refresh) and commits them with its own
+transaction, worker.py claims and runs them. Claiming is a conditional UPDATE on the job's
+status, so any number of workers can poll the same database without running a job twice.
+"""
+
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+
+from models import db, User, Job, JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED
+from api_clients import fetch_user_anime_list, fetch_user_list_changes, USER_LIST_STATUSES
+
+
+LIST_REFRESH = 'refresh_anime_list'
+
+# kind -> fn(job, app), see job_handler
+_handlers = {}
+
+
+def job_handler(kind):
+    """Register the decorated fn(job, app) as the runner for jobs of this kind"""
+
+    def register(fn):
+        _handlers[kind] = fn
+        return fn
+    return register
+
+
+def enqueue(kind, user_id=None, payload=None):
+    """Add a job to the queue. Runs in the current transaction, the caller commits."""
+
+    job = Job(kind=kind, user_id=user_id, payload=payload or {})
+    db.session.add(job)
+    return job
+
+
+def pending_job(kind, user_id):
+    """The user's queued or running job of this kind, or None"""
+
+    return db.session.execute(
+        db.select(Job)
+        .where(Job.user_id == user_id, Job.kind == kind, Job.status.in_([JOB_QUEUED, JOB_RUNNING]))
+        .limit(1)
+    ).scalar()
+
+
+def enqueue_list_refresh(user):
+    """Queue a refresh of the user's anime list, unless one is already waiting. The caller commits."""
+
+    if user.id is None:
+        db.session.flush()
+
+    return pending_job(LIST_REFRESH, user.id) or enqueue(LIST_REFRESH, user_id=user.id)
+
+
+def list_refresh_pending(user):
+    """Is the user's anime list waiting on a refresh? Drives the "refreshing" state in the UI."""
+
+    return user.id is not None and pending_job(LIST_REFRESH, user.id) is not None
+
+
+@job_handler(LIST_REFRESH)
+def refresh_anime_list(job, app):
+    """Sync the user's list with AniList, see sync_anime_list"""
+
+    user = db.session.get(User, job.user_id)
+
+    # Account deleted or profile gone private since the job was queued
+    if user is None or not user.anilist_profile_accessible:
+        return
+
+    sync_anime_list(user, app)
+
+
+def sync_anime_list(user, app):
+    """Bring the user's stored list up to date with AniList, returns 'full' or 'delta'.
+
+    A delta sync only fetches entries changed since the newest updatedAt already stored. Entries
+    deleted outright on AniList never show up as changes, so every ANILIST_LIST_FULL_SYNC_INTERVAL
+    (or with no watermark yet) the whole list is fetched and swapped in instead.
+    """
+
+    now = datetime.utcnow()
+    full_sync_interval = app.config.get('ANILIST_LIST_FULL_SYNC_INTERVAL', timedelta(days=7))
+
+    if (user.anime_list_synced_through is None or user.anime_list_full_sync_at is None
+            or now - user.anime_list_full_sync_at > full_sync_interval):
+        entries = fetch_user_anime_list(user.anilist_username, app)
+        if entries is None:
+            # Leave the stored list alone and let the job retry
+            raise RuntimeError(f'Fetching the anime list for user #{user.id} failed')
+
+        user.replace_anime_list(entries)
+        user.anime_list_synced_through = max((entry.get('updatedAt') or 0 for entry in entries.values()), default=0)
+        user.anime_list_full_sync_at = now
+        mode = 'full'
+    else:
+        changes = fetch_user_list_changes(user.anilist_username, user.anime_list_synced_through, app)
+        if changes is None:
+            raise RuntimeError(f'Fetching list changes for user #{user.id} failed')
+
+        # Oldest first, so if an entry shows up twice (it changed mid walk) the newest wins
+        latest = {}
+        for entry in reversed(changes):
+            latest[entry['mediaId']] = entry
+
+        user.update_anime_list(
+            {media_id: entry for media_id, entry in latest.items() if entry['status'] in USER_LIST_STATUSES},
+            removed_media_ids=[media_id for media_id, entry in latest.items() if entry['status'] not in USER_LIST_STATUSES],
+        )
+        if changes:
+            user.anime_list_synced_through = max(entry['updatedAt'] for entry in changes)
+        mode = 'delta'
+
+    app.logger.debug('%s list sync for user #%s', mode, user.id)
+    user.anime_list_updated_at = now
+    return mode
+
+
+def claim_next_job():
+    """Mark the oldest runnable job as running and hand it back, None if the queue is empty"""
+
+    while True:
+        now = datetime.utcnow()
+        job_id = db.session.execute(
+            db.select(Job.id)
+            .where(Job.status == JOB_QUEUED, Job.run_at <= now)
+            .order_by(Job.run_at, Job.id)
+            .limit(1)
+        ).scalar()
+
+        if job_id is None:
+            db.session.commit()
+            return None
+
+        # Only one worker gets to flip it from queued to running, the others go round again
+        claimed = db.session.execute(
+            db.update(Job)
+            .where(Job.id == job_id, Job.status == JOB_QUEUED)
+            .values(status=JOB_RUNNING, started_at=now, attempts=Job.attempts + 1)
+        ).rowcount
+        db.session.commit()
+
+        if claimed:
+            return db.session.get(Job, job_id)
+
+
+def requeue_stale_jobs(max_runtime):
+    """Put running jobs older than max_runtime (a worker died mid job) back in the queue"""
+
+    requeued = db.session.execute(
+        db.update(Job)
+        .where(Job.status == JOB_RUNNING, Job.started_at < datetime.utcnow() - max_runtime)
+        .values(status=JOB_QUEUED)
+    ).rowcount
+    db.session.commit()
+    return requeued
+
+
+def run_job(job, app):
+    """Run a claimed job and record how it went. A failed job is retried with backoff until it
+    runs out of attempts."""
+
+    handler = _handlers.get(job.kind)
+
+    try:
+        if handler is None:
+            raise LookupError(f'No handler for job kind {job.kind!r}')
+        handler(job, app)
+    except Exception as e:
+        db.session.rollback()
+        app.logger.exception('Job #%s (%s) failed on attempt %s', job.id, job.kind, job.attempts)
+
+        job.error = repr(e)
+        if job.attempts < app.config.get('JOB_MAX_ATTEMPTS', 3):
+            job.status = JOB_QUEUED
+            job.run_at = datetime.utcnow() + app.config.get('JOB_RETRY_DELAY', timedelta(seconds=30)) * job.attempts
+        else:
+            job.status = JOB_FAILED
+            job.finished_at = datetime.utcnow()
+    else:
+        job.status = JOB_DONE
+        job.error = None
+        job.finished_at = datetime.utcnow()
+
+    db.session.commit()
+    return job.status
+
+
+def run_worker(app, once=False):
+    """Run queued jobs until stopped. With once, stop as soon as the queue is empty.
+
+    Returns how many jobs were run.
+    """
+
+    worker_name = f'{socket.gethostname()}:{os.getpid()}'
+    poll_interval = app.config.get('JOB_POLL_INTERVAL', 1.0)
+    max_runtime = app.config.get('JOB_MAX_RUNTIME', timedelta(minutes=10))
+    ran = 0
+
+    with app.app_context():
+        app.logger.info('Worker %s started', worker_name)
+        requeue_stale_jobs(max_runtime)
+
+        while True:
+            job = claim_next_job()
+
+            if job is None:
+                if once:
+                    break
+                time.sleep(poll_interval)
+                requeue_stale_jobs(max_runtime)
+                continue
+
+            app.logger.info('Worker %s running job #%s (%s)', worker_name, job.id, job.kind)
+            run_job(job, app)
+            ran += 1
+
+            # Don't keep every job's objects around in the session
+            db.session.remove()
+
+    return ran
@@ -0,0 +1,257 @@
+"""Logging setup, structured lines written off the request thread
+
+Every module logs to a category, a logger under onsei (plus Flask's app logger and the
+libraries' own):
+
+    app                     views
+    onsei.anilist           AniList requests, pagination, user lists (api_clients*.py)
+    onsei.anilist.cache     response cache hits, one per cached lookup so it's the noisy one
+    onsei.timing            the slow request breakdown, see REQUEST_TIMING_LOG
+    sqlalchemy.engine       SQL statements at INFO, this replaces SQLALCHEMY_ECHO
+
+Levels are per category (LOG_LEVEL for everything, LOG_LEVELS for the exceptions, ie.
+LOG_LEVELS=onsei.anilist=DEBUG,sqlalchemy.engine=INFO in .env), and a logger.debug() under
+its level costs a level check and nothing else. Always pass the values as arguments
+(log.debug('Page %s', page)) rather than formatting them in, so they're only turned into text
+when the line is actually written. lazy() does the same for values that are expensive to get.
+
+The records that do get through are put on a queue and a listener thread formats and writes
+them, so a request never waits on log I/O:
+- The request thread only merges the message and caps it at LOG_MAX_CHARS, so one huge
+  response body can't blow up the logs.
+- LOG_SAMPLING keeps 1 in N DEBUG / INFO records per category. Warnings and up always go out.
+- When the queue is full (LOG_QUEUE_SIZE) new records are dropped and counted in /metrics,
+  the request doesn't wait for room.
+
+LOG_FORMAT=json writes one JSON object per line (anything passed as extra={...} becomes a
+field), text is for reading in a terminal.
+"""
+
+import atexit
+import copy
+import itertools
+import json
+import logging
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from flask.logging import default_handler
+
+import metrics
+
+
+# Merged over by LOG_LEVELS
+DEFAULT_LEVELS = {
+    # SQL is INFO, it's only worth seeing when you ask for it
+    'sqlalchemy.engine': 'WARNING',
+}
+# Merged over by LOG_SAMPLING, {category: keep 1 in N}
+DEFAULT_SAMPLING = {
+    'onsei.anilist.cache': 100,
+}
+
+# What every LogRecord has, anything else on a record came in through extra={...}
+RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+_listener = None
+_queue_handler = None
+
+
+class lazy(object):
+    """Value worked out only if the line gets written, ie. log.debug('Body: %s', lazy(lambda: response.text))"""
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __str__(self):
+        return str(self.fn())
+
+    __repr__ = __str__
+
+
+def cap(text, max_chars, keep_end=False):
+    """text cut down to max_chars, keep_end keeps the end instead (the useful bit of a traceback)"""
+
+    if not max_chars or len(text) <= max_chars:
+        return text
+    if keep_end:
+        return f'({len(text) - max_chars} chars cut) ...{text[-max_chars:]}'
+    return f'{text[:max_chars]}... ({len(text) - max_chars} more chars)'
+
+
+def extra_fields(record):
+    return {key: value for key, value in vars(record).items() if key not in RECORD_FIELDS}
+
+
+class CappedQueueHandler(QueueHandler):
+    """Hands records to the listener thread, capped in size, dropping them when the queue is full"""
+
+    def __init__(self, log_queue, max_chars=2000):
+        super().__init__(log_queue)
+        self.max_chars = max_chars
+
+    def prepare(self, record):
+        # Arguments are merged here, the objects in them may change once we return. Everything
+        # else (timestamps, JSON, the write) is left to the listener thread.
+        record = copy.copy(record)
+        record.msg = cap(record.getMessage(), self.max_chars)
+        record.args = None
+
+        if record.exc_info:
+            record.exc_text = cap(logging.Formatter().formatException(record.exc_info), self.max_chars * 4, keep_end=True)
+            record.exc_info = None
+
+        for key, value in extra_fields(record).items():
+            if not isinstance(value, (int, float, bool, type(None))):
+                setattr(record, key, cap(value if isinstance(value, str) else repr(value), self.max_chars))
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.LOG_RECORDS_DROPPED.inc()
+
+
+class SampleFilter(logging.Filter):
+    """Keep 1 in N DEBUG / INFO records for the categories in rates, {category: N}"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = {category: n for category, n in rates.items() if n and n > 1}
+        # next() on a count is atomic, no lock needed
+        self.counters = {category: itertools.count() for category in self.rates}
+        # logger name -> its sampled category (or None), worked out once per name
+        self.categories = {}
+
+    def category(self, name):
+        try:
+            return self.categories[name]
+        except KeyError:
+            pass
+
+        # Most specific category wins, onsei.anilist.cache over onsei.anilist
+        parts = name.split('.')
+        candidates = ('.'.join(parts[:i]) for i in range(len(parts), 0, -1))
+        category = self.categories[name] = next((c for c in candidates if c in self.rates), None)
+        return category
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+
+        category = self.category(record.name)
+        if category is None:
+            return True
+
+        n = self.rates[category]
+        if next(self.counters[category]) % n:
+            return False
+        record.sampled = n
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, extra={...} fields included"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        entry.update(extra_fields(record))
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """The usual line, extra={...} fields tacked on the end as key=value"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def formatMessage(self, record):
+        fields = extra_fields(record)
+        line = super().formatMessage(record)
+        return line + ''.join(f' {key}={value}' for key, value in fields.items()) if fields else line
+
+
+def parse_mapping(value):
+    """'a=DEBUG,b=INFO' (as it comes from .env) or a dict, to a dict"""
+
+    if not value:
+        return {}
+    if isinstance(value, dict):
+        return dict(value)
+    return dict(item.split('=', 1) for item in value.replace(' ', '').split(',') if item)
+
+
+def setup_logging(app):
+    """Point every logger at the queue, set the category levels and start the listener thread"""
+    global _listener, _queue_handler
+
+    config = app.config
+    stop_logging()
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter() if config.get('LOG_FORMAT') == 'json' else TextFormatter())
+
+    queue_handler = CappedQueueHandler(queue.Queue(config.get('LOG_QUEUE_SIZE', 10000)), config.get('LOG_MAX_CHARS', 2000))
+    sampling = dict(DEFAULT_SAMPLING, **{category: int(n) for category, n in parse_mapping(config.get('LOG_SAMPLING')).items()})
+    queue_handler.addFilter(SampleFilter(sampling))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        if isinstance(existing, CappedQueueHandler):
+            root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(config.get('LOG_LEVEL', 'INFO'))
+
+    # Flask's own handler writes on the request thread, the app logger goes through the root's queue like the rest
+    app.logger.removeHandler(default_handler)
+    app.logger.setLevel(logging.NOTSET)
+
+    for category, level in dict(DEFAULT_LEVELS, **parse_mapping(config.get('LOG_LEVELS'))).items():
+        logging.getLogger(category).setLevel(level)
+
+    _queue_handler = queue_handler
+    _listener = QueueListener(queue_handler.queue, handler, respect_handler_level=True)
+    _listener.start()
+    return queue_handler
+
+
+def stop_logging():
+    """Write out whatever is still queued and stop the listener thread"""
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _restart_in_child():
+    """After a fork (gunicorn --preload workers), give the child its own queue and listener thread.
+
+    Threads don't survive a fork, so the child has the queue handler but nothing draining it. Whatever
+    was still queued is the parent's to write, the child starts with an empty queue.
+    """
+    global _listener
+
+    if _listener is None:
+        return
+    _queue_handler.queue = queue.Queue(_queue_handler.queue.maxsize)
+    _listener = QueueListener(_queue_handler.queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+
+
+atexit.register(stop_logging)
+os.register_at_fork(after_in_child=_restart_in_child)
@@ -0,0 +1,480 @@
+"""Prometheus style metrics, served as text from /metrics
+
+Everything we want to see in production lives here as module level counters and histograms:
+
+    onsei_http_request_seconds          route latency, per endpoint / method / status
+    onsei_anilist_request_seconds       upstream AniList latency, per query name and page
+    onsei_anilist_requests_total        upstream AniList requests, per query name and status
+    onsei_anilist_pages_per_request     AniList pages sent for one request to the app
+    onsei_cache_requests_total          lookups per cache and result (hit / miss / stale)
+    onsei_db_query_seconds              SQLAlchemy statement time, per statement kind
+    onsei_log_records_dropped_total     log lines dropped because the log queue was full
+
+Percentiles come from the histograms on the Prometheus side, ie. the p95 per route is
+histogram_quantile(0.95, sum by (endpoint, le) (rate(onsei_http_request_seconds_bucket[5m]))).
+A hit ratio is rate(onsei_cache_requests_total{result="hit"}[5m]) over the sum of all results.
+
+Recording a value never takes a lock. Every thread keeps its own shard of each metric and
+only ever writes to that, /metrics adds the shards up. The lock is only taken the first time a
+thread touches a metric and while scraping. Shards of threads that have exited are folded
+into one total at the next scrape, so thread-per-request servers don't pile them up.
+
+The numbers are per process, so with several gunicorn workers each one is scraped on its own
+(or run fewer workers with more threads).
+"""
+
+import bisect
+import contextvars
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+
+
+# Seconds. Route and AniList latency from a few ms (cache hits) to the read timeout.
+LATENCY_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1, 2.5, 5, 10)
+# Most statements are well under a millisecond on a warm connection
+DB_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+PAGE_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Statements are labelled by their first keyword, anything else is OTHER
+STATEMENT_KINDS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'BEGIN', 'COMMIT', 'ROLLBACK'}
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LABEL_ESCAPE_RE = re.compile(r'[\\"\n]')
+LABEL_ESCAPES = {'\\': '\\\\', '"': '\\"', '\n': '\\n'}
+
+
+class Metric(object):
+    """Values per label tuple, sharded per thread. Subclasses say what a value is."""
+
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # (thread, {labels: values}) for every thread that has recorded something
+        self._shards = []
+        # What exited threads recorded, added up
+        self._retired = {}
+
+    def _new_values(self):
+        raise NotImplementedError
+
+    def _values(self, labels):
+        """This thread's values for labels, only ever written by this thread"""
+
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+
+        values = shard.get(labels)
+        if values is None:
+            values = shard[labels] = self._new_values()
+        return values
+
+    def collect(self):
+        """{labels: values} added up over every thread"""
+
+        def add(totals, shard):
+            # list() copies the dict in one go, a thread adding a label meanwhile can't break the loop
+            for labels, values in list(shard.items()):
+                total = totals.get(labels)
+                if total is None:
+                    totals[labels] = list(values)
+                else:
+                    for i, value in enumerate(values):
+                        total[i] += value
+
+        with self._lock:
+            live = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    # Nothing writes to it any more
+                    add(self._retired, shard)
+            self._shards = live
+
+            totals = {}
+            add(totals, self._retired)
+            for thread, shard in live:
+                add(totals, shard)
+        return totals
+
+    def clear(self):
+        with self._lock:
+            for thread, shard in self._shards:
+                shard.clear()
+            self._retired.clear()
+
+    def samples(self):
+        """(suffix, labels, value) for the exposition format, labels as a tuple of (name, value)"""
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """Only goes up"""
+
+    kind = 'counter'
+
+    def _new_values(self):
+        return [0]
+
+    def inc(self, *labels, amount=1):
+        self._values(labels)[0] += amount
+
+    def value(self, *labels):
+        return self.collect().get(labels, [0])[0]
+
+    def samples(self):
+        for labels, values in sorted(self.collect().items()):
+            yield '', tuple(zip(self.labelnames, labels)), values[0]
+
+
+class Histogram(Metric):
+    """Counts of observations per bucket, plus their sum"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_values(self):
+        # One count per bucket, one for +Inf, then the sum
+        return [0] * (len(self.buckets) + 2)
+
+    def observe(self, value, *labels):
+        values = self._values(labels)
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def count(self, *labels):
+        values = self.collect().get(labels)
+        return sum(values[:-1]) if values else 0
+
+    def total(self, *labels):
+        values = self.collect().get(labels)
+        return values[-1] if values else 0
+
+    def samples(self):
+        for labels, values in sorted(self.collect().items()):
+            labels = tuple(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values):
+                cumulative += count
+                yield '_bucket', labels + (('le', format_number(bound)),), cumulative
+            yield '_sum', labels, values[-1]
+            yield '_count', labels, cumulative
+
+
+class Registry(object):
+    """Every metric /metrics shows, in the order they were made"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+    def render(self):
+        """Everything in the Prometheus text exposition format"""
+
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for suffix, labels, value in metric.samples():
+                lines.append(f'{metric.name}{suffix}{format_labels(labels)} {format_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escape = lambda value: LABEL_ESCAPE_RE.sub(lambda match: LABEL_ESCAPES[match.group()], str(value))
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+def format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+REGISTRY = Registry()
+
+ROUTE_SECONDS = REGISTRY.histogram(
+    'onsei_http_request_seconds', 'Time to handle a request, up to the response being returned (not streamed)',
+    ('endpoint', 'method', 'status'))
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    'onsei_anilist_request_seconds', 'AniList request latency, not counting the wait for the rate limit',
+    ('query', 'page'))
+UPSTREAM_REQUESTS = REGISTRY.counter(
+    'onsei_anilist_requests_total', 'AniList requests sent, status is the HTTP status or error', ('query', 'status'))
+PAGES_PER_REQUEST = REGISTRY.histogram(
+    'onsei_anilist_pages_per_request', 'AniList pages sent for one request to the app, batched pages counted each',
+    ('endpoint',), buckets=PAGE_BUCKETS)
+CACHE_REQUESTS = REGISTRY.counter(
+    'onsei_cache_requests_total', 'Cache lookups, result is hit, miss or stale', ('cache', 'result'))
+DB_QUERY_SECONDS = REGISTRY.histogram(
+    'onsei_db_query_seconds', 'SQLAlchemy statement time', ('statement',), buckets=DB_BUCKETS)
+LOG_RECORDS_DROPPED = REGISTRY.counter(
+    'onsei_log_records_dropped_total', 'Log records dropped because the log queue was full, see logs.py')
+
+
+def render():
+    return REGISTRY.render()
+
+
+def reset_metrics():
+    """Zero every metric, for tests"""
+    REGISTRY.clear()
+
+
+##############################################################################
+# Per request tallies
+#
+# Pages are sent from the page worker pool and the async AniList loop as well as the request's
+# own thread, so the tally rides along in a ContextVar. bind_request / bind_request_coro carry
+# it over to the other thread.
+#
+# The tally also breaks the request down for its Server-Timing header (and the timing log line,
+# see REQUEST_TIMING_LOG in config.py), ie.
+#
+#     Server-Timing: user;dur=0.4, anilist;dur=182.0;desc="3 requests", db;dur=2.1;desc="6 queries",
+#                    template;dur=8.7, total;dur=196.3
+#
+# anilist is the wall time at least one AniList request was in flight, so pages fetched in
+# parallel aren't counted twice. db is the sum of every statement.
+
+
+class RequestTally(object):
+    """What one request to the app has cost so far"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.finished = None
+        # One entry per AniList request, how many pages it carried, and (start, end) of each.
+        # list.append is atomic, so the page workers can all add to them at once.
+        self.pages = []
+        self.upstream = []
+        # Seconds per SQL statement
+        self.queries = []
+        # Seconds per named phase, only ever added to from the request's own thread
+        self.phases = {}
+        self.template_depth = 0
+        self.template_started = None
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    def page_count(self):
+        return sum(self.pages)
+
+    def add_phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def upstream_time(self):
+        """Seconds at least one AniList request was in flight"""
+
+        busy = 0
+        busy_until = None
+        for start, end in sorted(self.upstream):
+            if busy_until is None or start > busy_until:
+                busy += end - start
+                busy_until = end
+            elif end > busy_until:
+                busy += end - busy_until
+                busy_until = end
+        return busy
+
+    def breakdown(self):
+        """[(name, seconds, description)], the phases that happened then the total"""
+
+        entries = [(name, seconds, None) for name, seconds in self.phases.items() if name != 'template']
+        if self.upstream:
+            entries.append(('anilist', self.upstream_time(), f"{len(self.upstream)} request{'s' if len(self.upstream) > 1 else ''}"))
+        if self.queries:
+            entries.append(('db', sum(self.queries), f"{len(self.queries)} quer{'ies' if len(self.queries) > 1 else 'y'}"))
+        if 'template' in self.phases:
+            entries.append(('template', self.phases['template'], None))
+        entries.append(('total', self.elapsed, None))
+        return entries
+
+    def server_timing(self):
+        """Server-Timing header value, durations in ms"""
+
+        return ', '.join(f'{name};dur={seconds * 1000:.1f}' + (f';desc="{description}"' if description else '')
+                         for name, seconds, description in self.breakdown())
+
+    def summary(self):
+        """One line for the log, ie. total=196.3ms anilist=182.0ms(3) db=2.1ms(6) template=8.7ms"""
+
+        parts = []
+        for name, seconds, description in self.breakdown():
+            count = f'({description.split()[0]})' if description else ''
+            parts.append(f'{name}={seconds * 1000:.1f}ms{count}')
+        # total first, it's what you scan for
+        return ' '.join(parts[-1:] + parts[:-1])
+
+
+_tally = contextvars.ContextVar('onsei_request_tally', default=None)
+
+
+def start_request():
+    """Start tallying the current request, returns the tally for finish_request"""
+
+    tally = RequestTally()
+    _tally.set(tally)
+    return tally
+
+
+def finish_request(tally, endpoint, method, status):
+    """Record the route latency and AniList pages of a request start_request started"""
+
+    tally.finished = time.perf_counter()
+    endpoint = endpoint or 'unmatched'
+    ROUTE_SECONDS.observe(tally.elapsed, endpoint, method, str(status))
+    PAGES_PER_REQUEST.observe(tally.page_count(), endpoint)
+    _tally.set(None)
+
+
+def bind_request(fn):
+    """fn, counting toward the current request's tally from whichever thread it runs on"""
+
+    tally = _tally.get()
+    if tally is None:
+        return fn
+
+    def bound(*args, **kwargs):
+        token = _tally.set(tally)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _tally.reset(token)
+    return bound
+
+
+def bind_request_coro(coro):
+    """coro, counting toward the current request's tally when it's run on another loop"""
+
+    tally = _tally.get()
+    if tally is None:
+        return coro
+
+    async def bound():
+        # A task runs in its own copy of the context, so this stays inside the task
+        _tally.set(tally)
+        return await coro
+    return bound()
+
+
+def current_tally():
+    return _tally.get()
+
+
+@contextmanager
+def phase(name):
+    """Time the with block as a named phase of the current request, ie. with phase('user'):"""
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        tally = _tally.get()
+        if tally is not None:
+            tally.add_phase(name, time.perf_counter() - started)
+
+
+def record_upstream(query, page, status, started, pages=1):
+    """One AniList request that went out at started (time.perf_counter()) is done, status is the HTTP status or 'error'"""
+
+    finished = time.perf_counter()
+    UPSTREAM_SECONDS.observe(finished - started, query, page)
+    UPSTREAM_REQUESTS.inc(query, str(status))
+
+    tally = _tally.get()
+    if tally is not None:
+        tally.pages.append(pages)
+        tally.upstream.append((started, finished))
+
+
+def record_cache(cache, result):
+    CACHE_REQUESTS.inc(cache, result)
+
+
+##############################################################################
+# SQLAlchemy and Jinja
+
+
+def statement_kind(statement):
+    words = statement.split(None, 1)
+    kind = words[0].upper() if words else ''
+    return kind if kind in STATEMENT_KINDS else 'OTHER'
+
+
+def track_queries(engine):
+    """Time every statement engine runs into onsei_db_query_seconds and the request's db time"""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_started = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - context._metrics_started
+        DB_QUERY_SECONDS.observe(seconds, statement_kind(statement))
+
+        tally = _tally.get()
+        if tally is not None:
+            tally.queries.append(seconds)
+
+
+def track_templates(app):
+    """Time render_template calls into the request's template phase"""
+
+    def started(sender, **extra):
+        tally = _tally.get()
+        if tally is not None:
+            # Only the outermost render, a template rendered while rendering another is inside its time
+            if tally.template_depth == 0:
+                tally.template_started = time.perf_counter()
+            tally.template_depth += 1
+
+    def rendered(sender, **extra):
+        tally = _tally.get()
+        if tally is not None and tally.template_depth:
+            tally.template_depth -= 1
+            if tally.template_depth == 0:
+                tally.add_phase('template', time.perf_counter() - tally.template_started)
+
+    # weak=False, nothing else holds on to these
+    before_render_template.connect(started, app, weak=False)
+    template_rendered.connect(rendered, app, weak=False)
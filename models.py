@@ -1,19 +1,21 @@
 """SQLAlchemy models for Onsei"""
 
+import click
 from flask_bcrypt import Bcrypt
-from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import PickleType
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import deferred
 from sqlalchemy.orm.exc import NoResultFound
-from datetime import datetime
-from api_clients import is_anilist_username_accessible
+from datetime import datetime, timedelta
+from api_clients import is_anilist_username_accessible, IncompleteList
+from name_index import get_name_index, staff_entry, media_entry
 from flask import current_app
+import metrics
 import requests
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
-migrate = Migrate()
 
 
 def connect_db(app):
@@ -23,7 +25,12 @@ def connect_db(app):
     """
     db.app = app
     db.init_app(app)
-    migrate.init_app(app, db)
+
+    # Flask-Migrate (and alembic under it) is only used by the flask db commands and takes longer to
+    # import than the rest of the app, so web workers and the tests don't load it
+    if click.get_current_context(silent=True) is not None:
+        from flask_migrate import Migrate
+        Migrate(app, db)
 
 
 class User(db.Model):
@@ -59,14 +66,89 @@ class User(db.Model):
     )
     anilist_profile_accessible = db.Column(db.Boolean, default=False)
 
-    anime_list = db.Column(PickleType, nullable=True)
+    # Old pickled {media_id: {'status', 'score'}} list, only read by migrate_pickled_anime_lists().
+    # Deferred so loading a user doesn't unpickle it, the list lives in user_list_entries now.
+    legacy_anime_list = deferred(db.Column('anime_list', PickleType, nullable=True))
     anime_list_updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-    
+    # Newest AniList updatedAt (unix time) stored so far, delta syncs only ask for changes after
+    # it. None means the next sync has to be a full one, see jobs.sync_anime_list().
+    anime_list_synced_through = db.Column(db.Integer, nullable=True)
+    anime_list_full_sync_at = db.Column(db.DateTime, nullable=True)
+
+    list_entries = db.relationship('UserListEntry', cascade='all, delete-orphan', passive_deletes=True)
 
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @property
+    def anime_list(self):
+        """The whole list as {media_id: {'status': .., 'score': ..}}, one query"""
+        return self.anime_list_entries()
+
+    @anime_list.setter
+    def anime_list(self, entries):
+        self.replace_anime_list(entries)
+
+    def anime_list_entries(self, media_ids=None):
+        """{media_id: {'status': .., 'score': ..}} for the list entries, only the given media_ids if passed"""
+
+        if self.id is None:
+            return {}
+
+        query = db.select(UserListEntry.media_id, UserListEntry.status, UserListEntry.score).where(UserListEntry.user_id == self.id)
+        if media_ids is not None:
+            query = query.where(UserListEntry.media_id.in_(set(media_ids)))
+
+        return {media_id: {'status': status, 'score': score} for media_id, status, score in db.session.execute(query)}
+
+    def has_anime_list(self):
+        """Is there anything on the list? An EXISTS query, nothing gets loaded"""
+
+        if self.id is None:
+            return False
+        return db.session.execute(db.select(db.exists().where(UserListEntry.user_id == self.id))).scalar()
+
+    def replace_anime_list(self, entries):
+        """Swap the whole list for entries ({media_id: {'status': .., 'score': ..}}) with one bulk insert.
+
+        Runs in the current transaction, the caller commits.
+        """
+
+        if self.id is None:
+            db.session.flush()
+
+        db.session.execute(db.delete(UserListEntry).where(UserListEntry.user_id == self.id))
+
+        now = datetime.utcnow()
+        rows = [
+            {'user_id': self.id, 'media_id': media_id, 'status': entry['status'], 'score': entry['score'], 'updated_at': now}
+            for media_id, entry in (entries or {}).items()
+        ]
+        if rows:
+            db.session.execute(db.insert(UserListEntry), rows)
+
+    def update_anime_list(self, entries, removed_media_ids=()):
+        """Upsert entries ({media_id: {'status': .., 'score': ..}}) and drop removed_media_ids,
+        leaving the rest of the list alone. Runs in the current transaction, the caller commits.
+        """
+
+        changed_ids = set(entries) | set(removed_media_ids)
+        if not changed_ids:
+            return
+
+        db.session.execute(
+            db.delete(UserListEntry).where(UserListEntry.user_id == self.id, UserListEntry.media_id.in_(changed_ids))
+        )
+
+        now = datetime.utcnow()
+        rows = [
+            {'user_id': self.id, 'media_id': media_id, 'status': entry['status'], 'score': entry['score'], 'updated_at': now}
+            for media_id, entry in entries.items()
+        ]
+        if rows:
+            db.session.execute(db.insert(UserListEntry), rows)
+
     @classmethod
     def signup(cls, username, email, password):
         """Sign up user.
@@ -120,6 +202,8 @@ class User(db.Model):
     def update_anilist_username(self, new_username):
         """Update the AniList username and check if the profile is accessible."""
         self.anilist_username = new_username
+        # Someone else's list now, the next sync can't build on the old one
+        self.anime_list_synced_through = None
 
         # Check if the AniList username is accessible
         if is_anilist_username_accessible(new_username, current_app):
@@ -128,4 +212,250 @@ class User(db.Model):
             self.anilist_profile_accessible = False
 
 
+class UserListEntry(db.Model):
+    """One series on a user's AniList list."""
+
+    __tablename__ = 'user_list_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    media_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    status = db.Column(db.String(20), nullable=False)
+
+    score = db.Column(db.Float, nullable=True)
+
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    # The primary key covers lookups by user (and user + media), these cover "who has this series"
+    # and filtering a user's list by status
+    __table_args__ = (
+        db.Index('ix_user_list_entries_media_id', 'media_id'),
+        db.Index('ix_user_list_entries_user_id_status', 'user_id', 'status'),
+    )
+
+    def __repr__(self):
+        return f"<UserListEntry user #{self.user_id}: media #{self.media_id} {self.status}>"
+
+
+def migrate_pickled_anime_lists():
+    """Move every pickled users.anime_list into user_list_entries, returns how many users moved.
+
+    Users that already have entries keep them. The pickled column is cleared as each user is
+    moved, so running this again only picks up whoever is left.
+    """
+
+    migrated = 0
+    user_ids = db.session.execute(db.select(User.id).where(User.legacy_anime_list.is_not(None))).scalars().all()
+
+    for user_id in user_ids:
+        user = db.session.get(User, user_id)
+        if not user.has_anime_list():
+            user.replace_anime_list(user.legacy_anime_list)
+        user.legacy_anime_list = None
+        db.session.commit()
+        migrated += 1
+
+    return migrated
+
+
+##############################################################################
+# AniList document cache
+#
+# Fetched Staff / Media details and the big paginated lists behind the JSON API live here,
+# so the cache survives restarts and is shared by every worker on the same database.
+
+
+class CachedDocumentMixin(object):
+    """Shared columns and helpers for tables caching an AniList document by its AniList id."""
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    data = db.Column(db.JSON, nullable=False)
+
+    fetched_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} #{self.id}: fetched {self.fetched_at}>"
+
+    def is_stale(self, max_age):
+        """Is this document older than max_age (a timedelta)?"""
+        return datetime.utcnow() - self.fetched_at > max_age
+
+    @classmethod
+    def name_entries(cls, anilist_id, data):
+        """(kind, id, names, image) for every VA / series named in a document, for name_index.py"""
+        return ()
+
+    @classmethod
+    def store(cls, anilist_id, data):
+        """Insert or refresh the cached document for anilist_id."""
+
+        document = cls(id=anilist_id, data=data, fetched_at=datetime.utcnow())
+        get_name_index(current_app).add_many(cls.name_entries(anilist_id, data))
+
+        try:
+            db.session.merge(document)
+            db.session.commit()
+        except IntegrityError:
+            # Another worker inserted the same id between our select and insert, theirs is just as fresh
+            db.session.rollback()
 
+    @classmethod
+    def get_or_fetch(cls, anilist_id, fetch, max_age):
+        """Return the cached document for anilist_id, calling fetch() to refresh it when missing or stale.
+
+        fetch() returns the document or None if AniList didn't give us one. If a refresh fails
+        we still hand back the stale copy rather than nothing. A list missing pages (IncompleteList)
+        is never stored, it's handed back as is when there's no stale copy to prefer.
+        """
+
+        document = db.session.get(cls, anilist_id)
+
+        if document is not None and not document.is_stale(max_age):
+            metrics.record_cache(cls.__tablename__, 'hit')
+            return document.data
+
+        metrics.record_cache(cls.__tablename__, 'miss' if document is None else 'stale')
+        data = fetch()
+
+        if data is None or isinstance(data, IncompleteList):
+            return document.data if document is not None else data
+
+        cls.store(anilist_id, data)
+        return data
+
+    @classmethod
+    async def get_or_fetch_async(cls, anilist_id, fetch, max_age):
+        """Same as get_or_fetch, for async views where fetch() is a coroutine function."""
+
+        document = db.session.get(cls, anilist_id)
+
+        if document is not None and not document.is_stale(max_age):
+            metrics.record_cache(cls.__tablename__, 'hit')
+            return document.data
+
+        metrics.record_cache(cls.__tablename__, 'miss' if document is None else 'stale')
+        data = await fetch()
+
+        if data is None or isinstance(data, IncompleteList):
+            return document.data if document is not None else data
+
+        cls.store(anilist_id, data)
+        return data
+
+
+class StaffDocument(CachedDocumentMixin, db.Model):
+    """Staff (voice actor) details, keyed by AniList staff id."""
+
+    __tablename__ = 'staff_documents'
+
+    @classmethod
+    def name_entries(cls, anilist_id, data):
+        return [staff_entry(dict(data, id=anilist_id))]
+
+
+class MediaDocument(CachedDocumentMixin, db.Model):
+    """Media (series) details, keyed by AniList media id."""
+
+    __tablename__ = 'media_documents'
+
+    @classmethod
+    def name_entries(cls, anilist_id, data):
+        return [media_entry(data, anilist_id)]
+
+
+class CharacterMediaList(CachedDocumentMixin, db.Model):
+    """Every characterMedia edge for a voice actor, keyed by AniList staff id."""
+
+    __tablename__ = 'character_media_lists'
+
+    @classmethod
+    def name_entries(cls, anilist_id, data):
+        return [media_entry(edge['node']) for edge in data]
+
+
+class SeriesRoleList(CachedDocumentMixin, db.Model):
+    """Every character + voice actor edge for a series, keyed by AniList media id."""
+
+    __tablename__ = 'series_role_lists'
+
+    @classmethod
+    def name_entries(cls, anilist_id, data):
+        return [staff_entry(voice_actor) for edge in data for voice_actor in edge.get('voiceActors') or []]
+
+
+def load_name_index(index):
+    """Fill a NameIndex from every document in the cache tables, oldest first so the newest survive the size cap"""
+
+    for model in (SeriesRoleList, CharacterMediaList, MediaDocument, StaffDocument):
+        rows = db.session.execute(db.select(model.id, model.data).order_by(model.fetched_at)).yield_per(100)
+        for anilist_id, data in rows:
+            index.add_many(model.name_entries(anilist_id, data))
+
+
+##############################################################################
+# Background jobs
+#
+# Durable work queued by the web app and run by worker.py, see jobs.py.
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+
+class Job(db.Model):
+    """One queued piece of background work, ie. refreshing a user's anime list."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    kind = db.Column(db.String(50), nullable=False)
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=True,
+    )
+
+    payload = db.Column(db.JSON, nullable=False, default=dict)
+
+    status = db.Column(db.String(20), nullable=False, default=JOB_QUEUED)
+
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+
+    error = db.Column(db.Text, nullable=True)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    # Not picked up before this, pushed back when a failed job is retried
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    started_at = db.Column(db.DateTime, nullable=True)
+
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    # Workers look for the next queued job, the web app for a user's pending ones
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+        db.Index('ix_jobs_user_id_kind_status', 'user_id', 'kind', 'status'),
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.kind} user #{self.user_id} {self.status}>"
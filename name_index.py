@@ -0,0 +1,168 @@
+"""In-process prefix index of VA and series names, answers /api/suggest without asking AniList
+
+Filled from what we've already fetched: the document cache tables on first use, then every
+document stored and every search result page as they come in. Names are kept in a sorted
+array of (token, kind, id) so a prefix lookup is a bisect plus a short scan. Every word
+boundary gets a token, so "hana" finds "Kana Hanazawa" too.
+
+The index holds at most max_entries people / series, the ones added or refreshed least
+recently are dropped first.
+"""
+
+import bisect
+import threading
+import unicodedata
+from collections import OrderedDict
+
+
+KIND_VA = 'va'
+KIND_SERIES = 'series'
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def normalize(text):
+    """Lowercase, accent free, single spaced version of text for matching"""
+
+    decomposed = unicodedata.normalize('NFKD', text)
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return ' '.join(stripped.casefold().split())
+
+
+def name_tokens(name):
+    """Every tail of the name starting at a word, ie. {'kana hanazawa', 'hanazawa'}"""
+
+    words = normalize(name).split()
+    return {' '.join(words[i:]) for i in range(len(words))}
+
+
+def staff_entry(staff):
+    """(kind, id, names, image) for a Staff object shaped like AniList's"""
+    return KIND_VA, staff['id'], [(staff.get('name') or {}).get('full')], (staff.get('image') or {}).get('medium')
+
+
+def media_entry(media, media_id=None):
+    """(kind, id, names, image) for a Media object shaped like AniList's, English title first"""
+
+    title = media.get('title') or {}
+    return (KIND_SERIES, media_id or media['id'], [title.get('english'), title.get('romaji')],
+            (media.get('coverImage') or {}).get('medium'))
+
+
+class NameIndex(object):
+    """Bounded prefix index of names, safe to share between threads."""
+
+    def __init__(self, max_entries=50000):
+        self.max_entries = max_entries
+        self.loaded = False
+        self._lock = threading.Lock()
+        # (kind, id) -> suggestion dict + its tokens, oldest first
+        self._entries = OrderedDict()
+        # Sorted (token, kind, id)
+        self._keys = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, kind, anilist_id, names, image=None):
+        """Add or refresh one VA / series. names are all the names it goes by, the first one is shown."""
+
+        names = [name for name in names if name]
+        if not names:
+            return
+
+        key = (kind, anilist_id)
+        tokens = set()
+        for name in names:
+            tokens |= name_tokens(name)
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = {
+                'type': kind,
+                'id': anilist_id,
+                'name': names[0],
+                'image': image,
+                'tokens': tokens,
+            }
+            for token in tokens:
+                bisect.insort(self._keys, (token, kind, anilist_id))
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def add_many(self, entries):
+        """add() every (kind, id, names, image) in entries"""
+
+        for entry in entries:
+            self.add(*entry)
+
+    def _remove(self, key):
+        kind, anilist_id = key
+        entry = self._entries.pop(key)
+
+        for token in entry['tokens']:
+            i = bisect.bisect_left(self._keys, (token, kind, anilist_id))
+            if i < len(self._keys) and self._keys[i] == (token, kind, anilist_id):
+                del self._keys[i]
+
+    def suggest(self, prefix, kind=None, limit=10):
+        """Up to limit {'type', 'id', 'name', 'image'} dicts with a name starting with prefix"""
+
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+
+        results = []
+        seen = set()
+
+        with self._lock:
+            i = bisect.bisect_left(self._keys, (prefix,))
+
+            while i < len(self._keys) and len(results) < limit:
+                token, entry_kind, anilist_id = self._keys[i]
+                i += 1
+
+                if not token.startswith(prefix):
+                    break
+                if (kind and entry_kind != kind) or (entry_kind, anilist_id) in seen:
+                    continue
+
+                seen.add((entry_kind, anilist_id))
+                entry = self._entries[(entry_kind, anilist_id)]
+                results.append({field: entry[field] for field in ('type', 'id', 'name', 'image')})
+
+        return results
+
+    def ensure_loaded(self, load):
+        """Run load(self) once, the first time anyone asks"""
+
+        if self.loaded:
+            return
+
+        with _index_lock:
+            if not self.loaded:
+                load(self)
+                self.loaded = True
+
+
+def get_name_index(app):
+    """Grab the process wide NameIndex, creating it on first use"""
+    global _index
+
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = NameIndex(max_entries=app.config.get('NAME_INDEX_MAX_ENTRIES', 50000))
+    return _index
+
+
+def reset_name_index():
+    """Drop the index (next use builds a fresh one)"""
+    global _index
+
+    with _index_lock:
+        _index = None
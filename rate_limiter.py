@@ -0,0 +1,184 @@
+"""Process wide scheduler that keeps AniList requests under the rate limit"""
+
+import heapq
+import itertools
+import threading
+import time
+
+
+# Lower number goes first. Page views a user is waiting on are interactive,
+# list refreshes and other work nobody is staring at are background.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+# AniList documents 90 requests per minute, the headers tell us if it's lower right now
+DEFAULT_LIMIT = 90
+DEFAULT_PERIOD = 60.0
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class UpstreamScheduler(object):
+    """Token bucket shared by every AniList request in the process.
+
+    Callers block in acquire() until a token is free instead of firing the request and
+    getting a 429. Waiters are served by priority, then arrival order, and background
+    callers can't dip into the last `background_reserve` fraction of the bucket so page
+    views still get through while a big list refresh is draining the budget.
+
+    The bucket learns the real budget from X-RateLimit-Limit / X-RateLimit-Remaining and
+    stops everyone until Retry-After has passed when we do get a 429.
+    """
+
+    def __init__(self, limit=DEFAULT_LIMIT, period=DEFAULT_PERIOD, background_reserve=0.2, clock=time.monotonic):
+        self.limit = limit
+        self.period = period
+        self.background_reserve = background_reserve
+        self.clock = clock
+
+        self.tokens = float(limit)
+        self.updated_at = clock()
+        self.blocked_until = 0.0
+
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.counter = itertools.count()
+
+    def _refill(self, now):
+        """Top up the bucket for the time passed since the last refill"""
+        rate = self.limit / self.period
+        self.tokens = min(float(self.limit), self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+
+    def _wait_time(self, ticket, now):
+        """How long `ticket` has to wait for a token, 0 if it can go now, None if it's not its turn"""
+
+        if self.blocked_until > now:
+            return self.blocked_until - now
+
+        # Only the head of the queue gets to take a token
+        if self.waiting[0] != ticket:
+            return None
+
+        needed = 1.0
+        if ticket[0] >= PRIORITY_BACKGROUND:
+            needed += self.limit * self.background_reserve
+
+        if self.tokens >= needed:
+            return 0
+        return (needed - self.tokens) * self.period / self.limit
+
+    def acquire(self, priority=PRIORITY_INTERACTIVE, timeout=None):
+        """Wait for a token. Returns True when the caller may send, False if `timeout` ran out."""
+
+        ticket = (priority, next(self.counter))
+        deadline = None if timeout is None else self.clock() + timeout
+
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while True:
+                    now = self.clock()
+                    self._refill(now)
+                    wait = self._wait_time(ticket, now)
+
+                    if wait == 0:
+                        self.tokens -= 1
+                        return True
+
+                    if deadline is not None:
+                        if deadline <= now:
+                            return False
+                        wait = deadline - now if wait is None else min(wait, deadline - now)
+
+                    self.condition.wait(wait)
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                # Whoever is now at the head of the queue should re-check
+                self.condition.notify_all()
+
+    def join(self, priority=PRIORITY_INTERACTIVE):
+        """Take a place in the queue without waiting, for callers that can't block on the condition
+        (the asyncio client). Call poll() until it returns 0, then leave() whatever happened."""
+
+        ticket = (priority, next(self.counter))
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+        return ticket
+
+    def poll(self, ticket):
+        """Take a token for ticket if it's its turn. 0 when it got one, else the seconds to wait
+        (None when it's not at the head of the queue yet)."""
+
+        with self.condition:
+            now = self.clock()
+            self._refill(now)
+            wait = self._wait_time(ticket, now)
+            if wait == 0:
+                self.tokens -= 1
+            return wait
+
+    def leave(self, ticket):
+        """Give up ticket's place in the queue, after it got its token or gave up waiting"""
+
+        with self.condition:
+            self.waiting.remove(ticket)
+            heapq.heapify(self.waiting)
+            # Whoever is now at the head of the queue should re-check
+            self.condition.notify_all()
+
+    def update(self, status_code, headers):
+        """Learn the budget from an AniList response"""
+
+        with self.condition:
+            now = self.clock()
+            self._refill(now)
+
+            limit = _header_number(headers, 'X-RateLimit-Limit')
+            if limit:
+                self.limit = limit
+
+            # The server knows better than our estimate, but only trust it downwards since
+            # responses for requests sent earlier can arrive after newer ones.
+            remaining = _header_number(headers, 'X-RateLimit-Remaining')
+            if remaining is not None:
+                self.tokens = min(self.tokens, float(remaining))
+
+            if status_code == 429:
+                retry_after = _header_number(headers, 'Retry-After')
+                self.tokens = 0.0
+                self.blocked_until = max(self.blocked_until, now + (retry_after if retry_after is not None else self.period))
+
+            self.condition.notify_all()
+
+
+def _header_number(headers, name):
+    """Read a numeric header, None if it's missing or junk"""
+    try:
+        return int(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def get_scheduler(app):
+    """Grab the process wide scheduler, creating it on first use"""
+    global _scheduler
+
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = UpstreamScheduler(
+                    limit=app.config.get('ANILIST_RATE_LIMIT', DEFAULT_LIMIT),
+                    background_reserve=app.config.get('ANILIST_BACKGROUND_RESERVE', 0.2),
+                )
+    return _scheduler
+
+
+def reset_scheduler():
+    """Drop the process wide scheduler (next request builds a fresh one)"""
+    global _scheduler
+
+    with _scheduler_lock:
+        _scheduler = None
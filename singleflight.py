@@ -0,0 +1,49 @@
+"""Collapse concurrent identical calls into a single in-flight call"""
+
+import copy
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight(object):
+    """Run one call per key at a time, everyone else asking for that key waits for its result.
+
+    When a popular VA page gets opened by 50 people at once, only the first request actually
+    talks to AniList and the other 49 wait for it. Followers get a deep copy of the result so
+    nobody can modify what someone else is holding.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        """Return fn(), or the result of the identical call already running for key"""
+
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.calls[key] = future
+
+        if not leader:
+            return copy.deepcopy(future.result())
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            # Done, the next caller for this key starts a fresh call
+            with self.lock:
+                del self.calls[key]
+
+    def in_flight(self):
+        """How many distinct calls are running right now"""
+        with self.lock:
+            return len(self.calls)
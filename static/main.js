@@ -19,13 +19,61 @@ function sortMedia(media, attr, order = 'asc') {
     });
 }
 
+// Downsized, cached copy of an AniList image through our /img proxy (see thumbnails.py).
+// width has to be one of IMAGE_PROXY_WIDTHS in config.py.
+function thumbnailUrl(url, width) {
+    return url ? `/img/${width}?url=${encodeURIComponent(url)}` : url;
+}
+
+// Read an NDJSON response line by line, calling onItems with each line's array as soon as it
+// arrives. Resolves with every item once the stream ends.
+async function streamItems(url, onItems) {
+    const allItems = [];
+
+    try {
+        const response = await fetch(url, {
+            // Always revalidate: the browser sends the ETag it has, and a 304 reuses its copy
+            cache: 'no-cache',
+            headers: {
+                Authorization: 'Bearer wnYW3pY6b/pmAsNur?sbx=EOrTDKqslHIGjG',
+            },
+        });
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+            const { done, value } = await reader.read();
+            // A chunk can end halfway through a line, keep the partial line for the next one
+            buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+            const lines = buffer.split('\n');
+            buffer = done ? '' : lines.pop();
+
+            for (let line of lines) {
+                if (!line.trim()) continue;
+                const items = JSON.parse(line);
+                allItems.push(...items);
+                onItems(items);
+            }
+
+            if (done) break;
+        }
+    } catch (error) {
+        console.error(error);
+    }
+
+    return allItems;
+}
+
 /*******************************
  * VA SPECIFIC FUNCTIONS
  ***************************** */
-// Grab the character media from our API endpoint
-async function getCharacterMedia(vaId) {
+// Grab the character media from our API endpoint. With withUserList the server marks
+// every series with the logged in user's list status & score (onUserList, userListScore...)
+async function getCharacterMedia(vaId, withUserList = false) {
     try {
         const response = await axios.get(`/api/character_media/${vaId}`, {
+            params: withUserList ? { user_list: 1 } : {},
             headers: {
                 Authorization: 'Bearer wnYW3pY6b/pmAsNur?sbx=EOrTDKqslHIGjG',
             },
@@ -37,6 +85,12 @@ async function getCharacterMedia(vaId) {
     }
 }
 
+// Stream the character media a page at a time, onPage gets each page as it comes in
+function streamCharacterMedia(vaId, withUserList = false, onPage = () => {}) {
+    const query = withUserList ? '?user_list=1' : '';
+    return streamItems(`/api/stream/character_media/${vaId}${query}`, onPage);
+}
+
 // Display character media after we've pulled it all!
 function displayCharacterMedia(charMedia, aniListUsername) {
     if (charMedia.length === 0) {
@@ -63,8 +117,10 @@ function createMediaCard(media, aniListUsername = '') {
 
     // If character and character image exist, create character img tag
     if (character && character.image) {
-        characterImg = `<img data-src="${character.image.large}" alt="${character.name.full}" class="lozad character-img img-fluid" />`;
-        characterImgUrl = `${character.image.large}`;
+        // Cards are ~150px wide, 300px covers high DPI screens
+        characterImg = `<img data-src="${thumbnailUrl(character.image.large, 150)}" data-srcset="${thumbnailUrl(character.image.large, 150)} 1x, ${thumbnailUrl(character.image.large, 300)} 2x" alt="${character.name.full}" class="lozad character-img img-fluid" />`;
+        // Blurred anyway, the smallest will do
+        characterImgUrl = thumbnailUrl(character.image.large, 64);
     }
 
     // If cover image exists, create series img tag
@@ -196,6 +252,11 @@ async function getSeriesRoles(seriesId) {
     }
 }
 
+// Stream the series characters and roles a page at a time, onPage gets each page as it comes in
+function streamSeriesRoles(seriesId, onPage = () => {}) {
+    return streamItems(`/api/stream/series_roles/${seriesId}`, onPage);
+}
+
 // Display character media after we've pulled it all!
 function displaySeriesRoles(seriesRoles) {
     if (seriesRoles.length === 0) {
@@ -263,8 +324,8 @@ function createRoleCard(char) {
                 voiceActorCharacters += `
                 <div class="character w-20">
                     <div class="img-wrap d-flex justify-content-center align-items-center" data-bs-toggle="tooltip" data-bs-title="${character.name.full}">
-                        <img data-src="${character.image.medium}" alt="${character.name.full}" class="lozad character-img img-fluid" />
-                        <div class="blur-bg lozad" data-background-image="${character.image.medium}"></div>
+                        <img data-src="${thumbnailUrl(character.image.medium, 64)}" alt="${character.name.full}" class="lozad character-img img-fluid" />
+                        <div class="blur-bg lozad" data-background-image="${thumbnailUrl(character.image.medium, 64)}"></div>
                     </div>
                 </div>`;
                 count++;
@@ -341,6 +402,117 @@ function getScoreClass(score) {
     else return '';
 }
 
+/*******************************
+ * SEARCH FUNCTIONS
+ ***************************** */
+// Fetch the next page of search result cards and append them. The server says which page
+// comes after it in X-Next-Page, blank when there isn't one.
+async function loadMoreResults(button) {
+    if (button.disabled) return;
+    button.disabled = true;
+
+    try {
+        const response = await axios.get(button.dataset.url, {
+            params: { page: button.dataset.nextPage, partial: 1 },
+        });
+        const cards = $(response.data).appendTo(button.dataset.target);
+
+        // New cards need lozad & tooltips like the ones rendered with the page
+        window.observer.observe();
+        cards.find('[data-bs-toggle="tooltip"]').each((i, el) => bootstrap.Tooltip.getOrCreateInstance(el));
+
+        const nextPage = response.headers['x-next-page'];
+        if (nextPage) {
+            button.dataset.nextPage = nextPage;
+            button.disabled = false;
+        } else {
+            $(button).remove();
+        }
+    } catch (error) {
+        console.error(error);
+        button.disabled = false;
+    }
+}
+
+// Typeahead for a search box from /api/suggest, names we've already seen on the server.
+// Picking one goes straight to its page instead of running the search.
+function setupSuggest(input, type) {
+    if (!input) return;
+
+    const list = $('<div class="list-group suggest position-absolute w-100 text-start" style="top: 100%; z-index: 10"></div>');
+    $(input).attr('autocomplete', 'off').closest('.input-group').addClass('position-relative').append(list);
+    let timer;
+
+    input.addEventListener('input', () => {
+        clearTimeout(timer);
+        // Wait for a pause in the typing before asking
+        timer = setTimeout(async () => {
+            const q = input.value.trim();
+            if (!q) return list.empty();
+
+            try {
+                const response = await axios.get('/api/suggest', {
+                    params: { q: q, type: type, limit: 8 },
+                    headers: {
+                        Authorization: 'Bearer wnYW3pY6b/pmAsNur?sbx=EOrTDKqslHIGjG',
+                    },
+                });
+                // Typed something else in the meantime
+                if (input.value.trim() !== q) return;
+
+                list.empty();
+                for (let item of response.data) {
+                    $('<a class="list-group-item list-group-item-action"></a>')
+                        .attr('href', `/${item.type}/${item.id}`)
+                        .text(item.name)
+                        .appendTo(list);
+                }
+            } catch (error) {
+                console.error(error);
+            }
+        }, 100);
+    });
+
+    // Let a click on a suggestion land before the list goes away
+    input.addEventListener('blur', () => setTimeout(() => list.empty(), 200));
+}
+
+// Wire up the "load more" button, which also loads by itself once it scrolls into view
+function setupLoadMore() {
+    const button = document.querySelector('.load-more');
+    if (!button) return;
+
+    button.addEventListener('click', () => loadMoreResults(button));
+
+    new IntersectionObserver(
+        (entries) => {
+            if (entries.some((entry) => entry.isIntersecting)) {
+                loadMoreResults(button);
+            }
+        },
+        { rootMargin: '400px' }
+    ).observe(button);
+}
+
+/*******************************
+ * USER SPECIFIC FUNCTIONS
+ ***************************** */
+// The list refresh runs in worker.py, so keep asking until it's done and then reload the
+// profile to show the new "List Updated" time
+async function waitForListRefresh(interval = 3000) {
+    try {
+        const response = await axios.get('/api/list_status');
+
+        if (response.data.refreshing) {
+            setTimeout(() => waitForListRefresh(interval), interval);
+        } else {
+            window.location.reload();
+        }
+    } catch (error) {
+        console.error(error);
+    }
+}
+
 // // DEPRECATED: Load and sort the media
 // async function loadAndSortMedia(vaId, attr, order = 'asc') {
 //     try {
@@ -0,0 +1,4 @@
+"""pytest setup for tests/, the test settings are in place before any test module imports app"""
+
+# Sets them when it is imported, see the top of fake_anilist.py
+import fake_anilist
@@ -0,0 +1,619 @@
+"""Local stand-in for the AniList GraphQL API, used by tests and benchmarks.
+
+Usage:
+    with FakeAniList(pages=20, latency=0.01) as fake:
+        app.config['ANILIST_API_URL'] = fake.url
+        ...
+        fake.request_count     # number of GraphQL POSTs served
+        fake.connection_count  # number of TCP connections opened by clients
+
+Answers are generated (Fake Staff 5, Series 7...) unless a recorded fixture matches the
+query, see tests/fixtures/anilist and record_anilist_fixtures.py. With generate=False only
+fixtures are served and anything else gets AniList's 404, like asking for an id that doesn't
+exist. fake.misses lists the (field, variables) nothing matched.
+
+To skip the sockets altogether (benchmarks), mount it straight on a requests session:
+    fake = FakeAniList()
+    fake.install(api_clients.get_session(app))
+    app.config['ANILIST_API_URL'] = fake.url
+
+It also serves generated artwork for the image proxy, GET /images/<name>.jpg (or .png) answers
+with a 460x650 image, fake.image_requests counts them. fake.images[path] = bytes serves those
+instead, ie. blank_png(20000, 20000).
+
+Importing this module also sets up the test settings, so test modules import it before app,
+and AniListTestCase is the base for tests running the app against the fake.
+"""
+
+import json
+import os
+import re
+import ssl
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from unittest import TestCase
+
+import requests
+from PIL import Image
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+
+# Test settings. config.py reads these when app.py is imported, which builds the app, so this has to
+# run first. The tests drop every table, so never the DATABASE_URL the app normally runs against:
+# a throwaway sqlite file, or TEST_DATABASE_URL to run them against something else.
+os.environ['DATABASE_URL'] = (os.environ.get('TEST_DATABASE_URL') or
+                              'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='onsei-tests-'), 'test.db'))
+os.environ['SECRET_KEY'] = 'notsosecret'
+
+
+# First root field of the query, ie. 'Staff' in: query ($id: Int) { Staff(id: $id) { ...
+ROOT_FIELD_RE = re.compile(r'\{\s*(\w+)')
+# 'q0: Staff' at the start of an aliased root field
+ALIAS_RE = re.compile(r'^(\w+)\s*:\s*(\w+)')
+# 'page: $q0_page' arguments, to map a batch's variables back to the plain names
+ARGUMENT_RE = re.compile(r'(\w+)\s*:\s*\$(\w+)')
+
+
+def top_level_fields(query):
+    """Text of every root field in the query, ie. ['q0: Staff(id: $q0_id) { ... }', ...]"""
+
+    start = query.index('{') + 1
+    fields = []
+    depth = 0
+    field_start = start
+
+    for i in range(start, len(query)):
+        char = query[i]
+        if char in '{(':
+            depth += 1
+        elif char in '})':
+            if depth == 0:
+                break
+            depth -= 1
+            if depth == 0 and char == '}':
+                fields.append(query[field_start:i + 1].strip())
+                field_start = i + 1
+    return fields
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'anilist')
+# URL the fake answers on when it's mounted in-process instead of listening on a port
+IN_PROCESS_URL = 'http://anilist.fake/'
+
+
+def query_field(query):
+    """What a single root field query asks for: 'Staff', 'Staff.characterMedia', 'Page.staff'...
+
+    Fixtures are matched on this plus their variables, so a VA's details and their
+    characterMedia pages don't answer for each other even though both are Staff(id: ...).
+    """
+
+    match = ROOT_FIELD_RE.search(query)
+    root = match.group(1) if match else None
+
+    if root == 'Staff' and 'characterMedia' in query:
+        return 'Staff.characterMedia'
+    if root == 'Media' and re.search(r'\bcharacters\s*\(', query):
+        return 'Media.characters'
+    if root == 'Page':
+        for connection in ('mediaList', 'staff', 'media'):
+            if re.search(r'\b%s\s*\(' % connection, query):
+                return f'Page.{connection}'
+    return root
+
+
+def load_fixtures(folder):
+    """Every fixture in folder, [{'field', 'variables', 'status', 'response'}, ...]"""
+
+    fixtures = []
+    for name in sorted(os.listdir(folder)):
+        if name.endswith('.json'):
+            with open(os.path.join(folder, name)) as f:
+                fixtures.append(json.load(f))
+    return fixtures
+
+
+def not_found(root):
+    """AniList's answer for an id that doesn't exist"""
+    return 404, {'errors': [{'message': 'Not Found.', 'status': 404}], 'data': {root: None}}
+
+
+def fake_media(media_id):
+    """Build a Media node shaped like the ones AniList returns"""
+    return {
+        'id': media_id,
+        'idMal': media_id,
+        'title': {
+            'romaji': f'Series {media_id}',
+            'english': f'Series {media_id} (EN)',
+            'userPreferred': f'Series {media_id}',
+        },
+        'type': 'ANIME',
+        'seasonYear': 2000 + media_id % 24,
+        'coverImage': {
+            'large': f'https://s4.anilist.co/file/anilistcdn/media/anime/cover/large/{media_id}.jpg',
+            'medium': f'https://s4.anilist.co/file/anilistcdn/media/anime/cover/medium/{media_id}.jpg',
+            'color': '#e4a15d',
+        },
+        'averageScore': 50 + media_id % 50,
+        'meanScore': 50 + media_id % 50,
+        'popularity': media_id * 7,
+        'trending': media_id % 13,
+        'favourites': media_id * 3,
+    }
+
+
+def fake_character(character_id):
+    """Build a Character node shaped like the ones AniList returns"""
+    return {
+        'id': character_id,
+        'name': {'full': f'Character {character_id}'},
+        'image': {
+            'large': f'https://s4.anilist.co/file/anilistcdn/character/large/{character_id}.png',
+            'medium': f'https://s4.anilist.co/file/anilistcdn/character/medium/{character_id}.png',
+        },
+    }
+
+
+def blank_png(width, height):
+    """A 1-bit PNG of width x height that's only a few KB, every row is zeros and compresses to nothing"""
+
+    def chunk(kind, body):
+        return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body))
+
+    compressor = zlib.compressobj(9)
+    # Filter byte + the row, a row at a time so the raw image is never in memory
+    row = bytes(1 + (width + 7) // 8)
+    idat = b''.join(compressor.compress(row) for _ in range(height)) + compressor.flush()
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 1, 0, 0, 0, 0)) +
+            chunk(b'IDAT', idat) + chunk(b'IEND', b''))
+
+
+def page_info(page, pages, per_page):
+    return {
+        'total': pages * per_page,
+        'perPage': per_page,
+        'currentPage': page,
+        'lastPage': pages,
+        'hasNextPage': page < pages,
+    }
+
+
+class FakeAniListHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep connections alive, like the real API
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out as separate writes, without TCP_NODELAY keep-alive
+    # requests stall ~40ms on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        # setup() runs once per TCP connection, not once per request
+        self.server.fake.record_connection()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        status, body, headers = self.server.fake.respond(payload.get('query', ''), payload.get('variables') or {})
+
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def do_GET(self):
+        status, content_type, data = self.server.fake.image(self.path)
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class InProcessAdapter(BaseAdapter):
+    """requests transport that hands POSTs straight to a FakeAniList, no sockets or threads involved"""
+
+    def __init__(self, fake):
+        super().__init__()
+        self.fake = fake
+
+    def send(self, request, **kwargs):
+        payload = json.loads(request.body or b'{}')
+        status, body, headers = self.fake.respond(payload.get('query', ''), payload.get('variables') or {})
+
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(dict({'Content-Type': 'application/json'}, **headers))
+        response._content = json.dumps(body).encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+class FakeAniListServer(ThreadingHTTPServer):
+    # The default backlog of 5 drops connects when dozens of clients open at once,
+    # and a dropped SYN costs a 1s retransmit
+    request_queue_size = 128
+
+
+class FakeAniList(object):
+    """Threaded HTTP server answering AniList style GraphQL queries with generated data.
+
+    pages    -- how many pages every paginated query reports
+    per_page -- how many items each page holds
+    latency  -- seconds to sleep before answering each request
+    fixtures -- folder of recorded responses to serve where they match, ie. FIXTURES_DIR
+    generate -- make up answers for queries no fixture matches, else 404 them
+    repeat_pages -- stretch recorded lists to this many pages by answering every page with
+                    the page 1 recording, for benchmarking long lists with real shaped data
+    """
+
+    def __init__(self, pages=5, per_page=25, latency=0.0, certfile=None, keyfile=None, fixtures=None, generate=True,
+                 repeat_pages=None):
+        self.pages = pages
+        self.per_page = per_page
+        self.latency = latency
+        self.fixtures = load_fixtures(fixtures) if fixtures else []
+        self.generate = generate
+        self.repeat_pages = repeat_pages
+        self.misses = []
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.connection_count = 0
+        self.image_requests = 0
+        # Bytes served for these image paths instead of the generated image, ie. {'/images/big.png': ...}
+        self.images = {}
+        self.requests = []
+        self.forced = []
+        # Pages that always answer 500, ie. {2} to fail a walk after its first page
+        self.failing_pages = set()
+        # The user's anime list, {mediaId: entry}. Tests can edit it to fake list changes.
+        self.list_entries = {
+            i: {'mediaId': i, 'status': 'COMPLETED', 'score': i % 10, 'updatedAt': 1600000000 + i}
+            for i in range(1, per_page + 1)
+        }
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        if self.server is None:
+            return IN_PROCESS_URL
+        scheme = 'https' if self.certfile else 'http'
+        host, port = self.server.server_address[:2]
+        return f'{scheme}://{host}:{port}/'
+
+    def start(self):
+        self.server = FakeAniListServer(('127.0.0.1', 0), FakeAniListHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+
+        if self.certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.certfile, self.keyfile)
+            self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+
+        # shutdown() waits out a poll, the default 0.5s adds up over a test run
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def install(self, session):
+        """Answer session's requests to self.url in-process, see InProcessAdapter"""
+        session.mount(self.url, InProcessAdapter(self))
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reset_counts(self):
+        with self.lock:
+            self.request_count = 0
+            self.connection_count = 0
+            self.image_requests = 0
+            self.requests = []
+            self.misses = []
+
+    def image(self, path):
+        """(status, content type, bytes) for GET path"""
+
+        match = re.match(r'^/images/[\w/-]+\.(jpg|png)$', path)
+        if not match:
+            return 404, 'text/plain', b'Not found'
+
+        with self.lock:
+            self.image_requests += 1
+
+        if path in self.images:
+            return 200, f'image/{"jpeg" if match.group(1) == "jpg" else "png"}', self.images[path]
+
+        out = BytesIO()
+        Image.new('RGB', (460, 650), (228, 161, 93)).save(out, 'JPEG' if match.group(1) == 'jpg' else 'PNG')
+        return 200, f'image/{"jpeg" if match.group(1) == "jpg" else "png"}', out.getvalue()
+
+    def record_connection(self):
+        with self.lock:
+            self.connection_count += 1
+
+    def force_response(self, status, body=None, headers=None, count=1):
+        """Answer the next `count` requests with this instead, ie. a 429 with Retry-After"""
+        with self.lock:
+            self.forced.extend([(status, body or {'data': None}, headers or {})] * count)
+
+    def respond(self, query, variables):
+        """Answer a single GraphQL POST, returns (status_code, body, headers)"""
+
+        with self.lock:
+            forced = self.forced.pop(0) if self.forced else None
+
+        if forced:
+            with self.lock:
+                self.request_count += 1
+            return forced
+
+        if variables.get('page') in self.failing_pages:
+            with self.lock:
+                self.request_count += 1
+            return 500, {'data': None}, {}
+
+        status, body = self.handle(query, variables)
+        return status, body, {}
+
+    def handle(self, query, variables):
+        """Answer a single GraphQL POST, returns (status_code, body)"""
+
+        fields = top_level_fields(query) if '{' in query else []
+
+        if fields and ALIAS_RE.match(fields[0]):
+            # Aliased batch, answer every root field as if it came in its own query
+            parts = []
+            for field in fields:
+                alias, root = ALIAS_RE.match(field).groups()
+                part_variables = {name: variables.get(variable) for name, variable in ARGUMENT_RE.findall(field)}
+                parts.append((alias, root, 'query { %s }' % field.split(':', 1)[1], part_variables))
+        else:
+            match = ROOT_FIELD_RE.search(query)
+            parts = [(None, match.group(1) if match else None, query, variables)]
+
+        with self.lock:
+            self.request_count += 1
+            self.requests.extend((root, dict(part_variables)) for alias, root, part_query, part_variables in parts)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if parts[0][0] is None:
+            return self.answer(query, variables)
+
+        data = {}
+        errors = []
+        for alias, root, part_query, part_variables in parts:
+            status, body = self.answer(part_query, part_variables)
+            data[alias] = (body.get('data') or {}).get(root)
+            # AniList puts the alias at the start of each error's path
+            errors.extend(dict(error, path=[alias]) for error in body.get('errors') or [])
+
+        if errors:
+            return errors[0].get('status', 400), {'errors': errors, 'data': data}
+        return 200, {'data': data}
+
+    def repeat_page(self, response, page):
+        """Copy of a recorded page 1 response claiming to be page of repeat_pages"""
+
+        response = json.loads(json.dumps(response))
+
+        def patch(node):
+            if isinstance(node, dict):
+                if 'pageInfo' in node:
+                    node['pageInfo'].update(page_info(page, self.repeat_pages, node['pageInfo'].get('perPage') or self.per_page))
+                for value in node.values():
+                    patch(value)
+            elif isinstance(node, list):
+                for value in node:
+                    patch(value)
+
+        patch(response)
+        return response
+
+    def find_fixture(self, field, variables):
+        """The fixture recorded for this field whose variables all match, or None. Variables the
+        fixture doesn't name (perPage...) are ignored, and a missing page is page 1."""
+
+        for fixture in self.fixtures:
+            if fixture['field'] == field and all(
+                    (variables.get(name) or (1 if name == 'page' else None)) == value
+                    for name, value in fixture['variables'].items()):
+                return fixture
+        return None
+
+    def answer(self, query, variables):
+        """Response body for a single root field query, returns (status_code, body)"""
+
+        match = ROOT_FIELD_RE.search(query)
+        root = match.group(1) if match else None
+        field = query_field(query)
+
+        page = variables.get('page') or 1
+        if self.repeat_pages and 'page' in variables and page <= self.repeat_pages:
+            fixture = self.find_fixture(field, dict(variables, page=1))
+            if fixture:
+                return fixture.get('status', 200), self.repeat_page(fixture['response'], page)
+
+        fixture = self.find_fixture(field, variables)
+        if fixture:
+            return fixture.get('status', 200), fixture['response']
+
+        with self.lock:
+            self.misses.append((field, dict(variables)))
+
+        if not self.generate:
+            if root == 'Page':
+                # A search nothing matches is just an empty page
+                connection = field.split('.')[1]
+                return 200, {'data': {'Page': {'pageInfo': page_info(1, 1, variables.get('perPage') or self.per_page),
+                                               connection: []}}}
+            return not_found(root)
+
+        return self.generate_answer(root, query, variables)
+
+    def generate_answer(self, root, query, variables):
+        """Make up a response body for a single root field query, returns (status_code, body)"""
+
+        page = variables.get('page') or 1
+        per_page = variables.get('perPage') or self.per_page
+
+        if root == 'Staff' and 'characterMedia' in query:
+            edges = []
+            for i in range(per_page):
+                item_id = (page - 1) * per_page + i + 1
+                edges.append({'node': fake_media(item_id), 'characters': [fake_character(item_id)]})
+            return 200, {'data': {'Staff': {'characterMedia': {
+                'pageInfo': page_info(page, self.pages, per_page),
+                'edges': edges,
+            }}}}
+
+        if root == 'Staff':
+            staff_id = variables.get('id')
+            return 200, {'data': {'Staff': {
+                'id': staff_id,
+                'name': {'first': 'Fake', 'last': str(staff_id), 'full': f'Fake Staff {staff_id}'},
+                'image': {'large': None, 'medium': None},
+                'languageV2': 'Japanese',
+                'description': '',
+                'gender': 'Female',
+                'primaryOccupations': ['Voice Actor'],
+                'dateOfBirth': {'year': 1990, 'month': 1, 'day': 1},
+                'dateOfDeath': {'year': None, 'month': None, 'day': None},
+                'age': 33,
+                'yearsActive': [2010],
+                'homeTown': None,
+                'bloodType': None,
+            }}}
+
+        if root == 'Media' and 'characters' in query:
+            edges = []
+            for i in range(per_page):
+                item_id = (page - 1) * per_page + i + 1
+                character = fake_character(item_id)
+                voice_actor = dict(fake_character(100000 + item_id), characters={'nodes': [fake_character(item_id)]})
+                edges.append({'role': 'MAIN', 'node': character, 'voiceActors': [voice_actor]})
+            return 200, {'data': {'Media': {'characters': {
+                'pageInfo': page_info(page, self.pages, per_page),
+                'edges': edges,
+            }}}}
+
+        if root == 'Media':
+            return 200, {'data': {'Media': dict(fake_media(variables.get('id') or 1), bannerImage=None,
+                                                description='', genres=[], episodes=12, season='SPRING',
+                                                studios={'edges': [{'node': {'name': 'Fake Studio'}}]}, tags=[])}}
+
+        if root == 'Page' and re.search(r'\bmediaList\s*\(', query):
+            # Newest change first, like sort: UPDATED_TIME_DESC
+            entries = sorted(self.list_entries.values(), key=lambda entry: entry['updatedAt'], reverse=True)
+            pages = max(1, -(-len(entries) // per_page))
+            return 200, {'data': {'Page': {
+                'pageInfo': page_info(page, pages, per_page),
+                'mediaList': [dict(entry) for entry in entries[(page - 1) * per_page:page * per_page]],
+            }}}
+
+        if root == 'Page':
+            items = [(page - 1) * per_page + i + 1 for i in range(per_page)]
+            if re.search(r'\bstaff\s*\(', query):
+                results = {'staff': [dict(fake_character(i), characters={'nodes': [fake_character(i)]}) for i in items]}
+            else:
+                results = {'media': [fake_media(i) for i in items]}
+            return 200, {'data': {'Page': dict(results, pageInfo=page_info(page, self.pages, per_page))}}
+
+        if root == 'MediaListCollection':
+            entries = [dict(entry) for entry in self.list_entries.values() if entry['status'] in ('COMPLETED', 'CURRENT')]
+            return 200, {'data': {'MediaListCollection': {'lists': [{'name': 'Completed', 'entries': entries}]}}}
+
+        if root == 'User':
+            return 200, {'data': {'User': {'id': 1, 'name': variables.get('name')}}}
+
+        return 400, {'errors': [{'message': 'Unknown query', 'status': 400}], 'data': None}
+
+
+class AniListTestCase(TestCase):
+    """Base for tests running the app against a FakeAniList, with empty tables each test.
+
+    anilist -- FakeAniList arguments
+    config  -- app settings for the length of each test, put back afterwards
+
+    Nothing from the last test is left behind either: the AniList session, rate limit
+    scheduler and response cache start over. Subclasses call super().setUp() first.
+    """
+
+    anilist = {}
+    config = {}
+
+    def setUp(self):
+        import api_cache
+        import api_clients
+        import rate_limiter
+        from app import app
+        from models import db
+
+        if app.config['SQLALCHEMY_DATABASE_URI'] != os.environ['DATABASE_URL']:
+            # drop_all() would go to whatever database app.py was imported with
+            raise RuntimeError('app was imported before the test settings, import fake_anilist first')
+
+        self.app_context = app.app_context()
+        self.app_context.push()
+
+        # Start from a clean session, objects left over from the last test share ids with the new ones
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+        self.fake = FakeAniList(**self.anilist).start()
+        settings = dict(self.config, ANILIST_API_URL=self.fake.url)
+        self.saved_config = {key: app.config.get(key) for key in settings}
+        app.config.update(settings)
+
+        api_clients.reset_session()
+        rate_limiter.reset_scheduler()
+        api_cache.reset_response_cache()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        from app import app
+        from models import db
+
+        self.fake.stop()
+        app.config.update(self.saved_config)
+
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
@@ -0,0 +1,66 @@
+"""Record live AniList responses as fixtures for fake_anilist.py
+
+    python tests/record_anilist_fixtures.py                  # everything in FIXTURES
+    python tests/record_anilist_fixtures.py staff-100938     # just these
+
+Needs network access. tests/test_routes.py and benchmarks/bench_routes.py only ever see
+what's saved in tests/fixtures/anilist, so re-record when a query in api_clients.py changes
+shape. Lists are recorded one page deep, FakeAniList(repeat_pages=...) stretches them.
+"""
+
+import json
+import os
+import sys
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api_clients import (ANILIST_API_URL, VA_DETAILS_QUERY, CHARACTER_MEDIA_QUERY, VA_SEARCH_QUERY, SERIES_DETAILS_QUERY,
+                         SERIES_ROLES_QUERY, SERIES_SEARCH_QUERY, USER_QUERY)
+from fake_anilist import FIXTURES_DIR, query_field
+
+# (fixture name, query, variables)
+FIXTURES = [
+    ('staff-100938', VA_DETAILS_QUERY, {'id': 100938}),
+    ('staff-100938-character-media-p1', CHARACTER_MEDIA_QUERY, {'id': 100938, 'page': 1, 'perPage': 25}),
+    ('staff-111635-character-media-p1', CHARACTER_MEDIA_QUERY, {'id': 111635, 'page': 1, 'perPage': 25}),
+    ('staff-search-nakai-p1', VA_SEARCH_QUERY, {'search': 'Nakai', 'page': 1, 'perPage': 50}),
+    ('media-101922', SERIES_DETAILS_QUERY, {'id': 101922}),
+    ('media-101922-characters-p1', SERIES_ROLES_QUERY, {'id': 101922, 'page': 1, 'perPage': 25}),
+    ('media-search-demon-slayer-p1', SERIES_SEARCH_QUERY, {'search': 'Demon Slayer', 'page': 1, 'perPage': 50}),
+    ('user-hopesix', USER_QUERY, {'name': 'hopesix'}),
+    ('user-whalejucs', USER_QUERY, {'name': 'WhaleJucs'}),
+]
+
+
+def record(name, query, variables, url=ANILIST_API_URL):
+    """Ask AniList and save the answer as tests/fixtures/anilist/<name>.json"""
+
+    response = requests.post(url, json={'query': query, 'variables': variables}, timeout=(3.05, 30))
+
+    fixture = {
+        'field': query_field(query),
+        # perPage only changes how much comes back, matching on it would just make fixtures brittle
+        'variables': {key: value for key, value in variables.items() if key != 'perPage'},
+        'status': response.status_code,
+        'response': response.json(),
+    }
+
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    with open(os.path.join(FIXTURES_DIR, f'{name}.json'), 'w') as f:
+        json.dump(fixture, f, indent=2, ensure_ascii=False)
+        f.write('\n')
+    return fixture
+
+
+def main(names):
+    for name, query, variables in FIXTURES:
+        if names and name not in names:
+            continue
+        fixture = record(name, query, variables)
+        print(f"{name}: {fixture['status']}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
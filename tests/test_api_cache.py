@@ -0,0 +1,68 @@
+""" Response cache tests """
+
+# run these tests like:
+# python -m unittest discover -s tests
+
+import json
+from unittest import TestCase
+
+from api_cache import ResponseCache, cache_key, query_name
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class ResponseCacheTestCase(TestCase):
+    """ Test keys, TTLs and LRU eviction """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = ResponseCache(max_entries=3, max_bytes=1000, ttls={'Staff': 60}, clock=self.clock)
+
+    def test_query_name(self):
+        self.assertEqual(query_name('query ($id: Int) { Staff(id: $id) { id } }'), 'Staff')
+        self.assertEqual(query_name('query { Page(page: 1) { pageInfo { total } media(search: "a") { id } } }'), 'Page.media')
+
+    def test_key_is_normalized(self):
+        """ Whitespace and variable order don't change the key """
+
+        self.assertEqual(cache_key('{ Staff(id: 1) {\n  id } }', {'a': 1, 'b': 2}),
+                         cache_key('{ Staff(id: 1) { id } }', {'b': 2, 'a': 1}))
+        self.assertNotEqual(cache_key('{ Staff { id } }', {'a': 1}), cache_key('{ Staff { id } }', {'a': 2}))
+
+    def test_hit_miss_and_ttl(self):
+        self.assertIsNone(self.cache.get('k'))
+        self.cache.set('k', 'Staff', json.dumps({'data': 1}))
+        self.assertEqual(self.cache.get('k'), {'data': 1})
+
+        self.clock.now = 61
+        self.assertIsNone(self.cache.get('k'))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+    def test_uncacheable_query_name(self):
+        """ Names without a TTL (user lists) are never stored """
+
+        self.cache.set('k', 'MediaListCollection', '{}')
+        self.assertIsNone(self.cache.get('k'))
+
+    def test_lru_eviction(self):
+        """ Least recently used goes first, by count and by bytes """
+
+        for key in ('a', 'b', 'c'):
+            self.cache.set(key, 'Staff', '{}')
+        self.cache.get('a')
+        self.cache.set('d', 'Staff', '{}')
+
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('a'))
+
+        self.cache.set('big', 'Staff', json.dumps('x' * 997))
+        self.assertEqual(self.cache.stats()['entries'], 1)
+        self.assertLessEqual(self.cache.stats()['bytes'], 1000)
+        self.assertEqual(self.cache.stats()['evictions'], 4)
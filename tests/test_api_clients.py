@@ -0,0 +1,129 @@
+""" AniList client tests, run against the local stand-in in fake_anilist.py """
+
+# run these tests like:
+# python -m unittest discover -s tests
+
+import time
+from unittest import TestCase
+
+from flask import Flask
+
+import api_cache
+import api_clients
+import rate_limiter
+from fake_anilist import FakeAniList
+
+
+class ApiClientsTestCase(TestCase):
+    """ Test api_clients against a fake AniList """
+
+    def setUp(self):
+        self.fake = FakeAniList(pages=6, per_page=25, latency=0.1).start()
+
+        self.app = Flask('test_api_clients')
+        self.app.config['ANILIST_API_URL'] = self.fake.url
+        api_clients.reset_session()
+        rate_limiter.reset_scheduler()
+        api_cache.reset_response_cache()
+
+    def tearDown(self):
+        api_clients.reset_session()
+        self.fake.stop()
+
+    def test_fetch_all_character_media(self):
+        """ Are all pages returned, in page order? """
+
+        edges = api_clients.fetch_all_character_media(1, self.app)
+
+        self.assertEqual(len(edges), 6 * 25)
+        self.assertEqual([edge['node']['id'] for edge in edges], list(range(1, 6 * 25 + 1)))
+        self.assertEqual(self.fake.request_count, 6)
+
+    def test_pages_fetched_in_parallel(self):
+        """ Page 1 then the rest at once: about two round trips, not six """
+
+        start = time.perf_counter()
+        api_clients.fetch_series_characters_roles(1, self.app)
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(self.fake.request_count, 6)
+        self.assertLess(elapsed, 0.1 * 4)
+
+    def test_failed_first_page(self):
+        """ A dead upstream gives an empty list / 500, not an exception """
+
+        self.fake.stop()
+
+        self.assertEqual(api_clients.fetch_all_character_media(1, self.app), [])
+        self.assertEqual(api_clients.search_voice_actors('Nakai', self.app)['data']['status_code'], 500)
+        self.assertFalse(api_clients.is_anilist_username_accessible('someone', self.app))
+
+    def test_rate_limited_page_is_retried(self):
+        """ A 429 waits out Retry-After and retries instead of truncating the results """
+
+        self.fake.force_response(429, headers={'Retry-After': 1, 'X-RateLimit-Remaining': 0})
+
+        start = time.perf_counter()
+        edges = api_clients.fetch_all_character_media(1, self.app)
+
+        self.assertEqual(len(edges), 6 * 25)
+        self.assertGreaterEqual(time.perf_counter() - start, 1)
+
+    def test_repeat_lookup_is_cached(self):
+        """ The second fetch of the same VA doesn't touch the network """
+
+        first = api_clients.fetch_all_character_media(1, self.app)
+        first[0]['node']['onUserList'] = True
+        second = api_clients.fetch_all_character_media(1, self.app)
+
+        self.assertEqual(self.fake.request_count, 6)
+        self.assertEqual(len(second), len(first))
+        self.assertNotIn('onUserList', second[0]['node'])
+
+    def test_batch_request_splits_results(self):
+        """ Several queries go out in one POST and come back as separate responses """
+
+        details, first_page = api_clients.make_batch_request([
+            (api_clients.VA_DETAILS_QUERY, {'id': 5}),
+            (api_clients.CHARACTER_MEDIA_QUERY, {'id': 5, 'page': 1, 'perPage': 25}),
+        ], self.app)
+
+        self.assertEqual(self.fake.request_count, 1)
+        self.assertEqual(details['data']['Staff']['name']['full'], 'Fake Staff 5')
+        self.assertEqual(len(first_page['data']['Staff']['characterMedia']['edges']), 25)
+
+    def test_va_details_prefetch_first_page(self):
+        """ The details request also brings in characterMedia page 1 """
+
+        self.assertEqual(api_clients.fetch_va_details(5, self.app)['id'], 5)
+        edges = api_clients.fetch_all_character_media(5, self.app)
+
+        self.assertEqual(len(edges), 6 * 25)
+        self.assertEqual(self.fake.request_count, 1 + 5)
+
+    def test_iter_pages_streams_in_order(self):
+        """ Page 1 is handed over after one round trip, the rest follow in page order """
+
+        start = time.perf_counter()
+        pages = api_clients.iter_character_media_pages(1, self.app)
+        first = next(pages)
+        first_page_time = time.perf_counter() - start
+
+        self.assertEqual([edge['node']['id'] for edge in first], list(range(1, 26)))
+        self.assertLess(first_page_time, 0.1 * 2)
+
+        rest = [edge['node']['id'] for page in pages for edge in page]
+        self.assertEqual(rest, list(range(26, 6 * 25 + 1)))
+        self.assertEqual(self.fake.request_count, 6)
+
+    def test_iter_pages_stops_when_closed(self):
+        """ Nobody reading any more, so no pages past the read ahead window get fetched """
+
+        self.app.config['ANILIST_PAGE_WORKERS'] = 2
+        pages = api_clients.iter_series_roles_pages(1, self.app)
+        next(pages)
+        next(pages)
+        pages.close()
+
+        time.sleep(0.3)
+        self.assertLessEqual(self.fake.request_count, 1 + 1 + 2)
@@ -0,0 +1,125 @@
+""" Async AniList client tests, run against the local stand-in in fake_anilist.py """
+
+# run these tests like:
+# python -m unittest discover -s tests
+
+import asyncio
+import os
+import time
+from unittest import TestCase
+
+from flask import Flask
+
+import api_cache
+import api_clients
+import api_clients_async
+import rate_limiter
+from fake_anilist import FakeAniList
+
+
+class ApiClientsAsyncTestCase(TestCase):
+    """ Test api_clients_async against a fake AniList """
+
+    def setUp(self):
+        self.fake = FakeAniList(pages=6, per_page=25, latency=0.1).start()
+
+        self.app = Flask('test_api_clients_async')
+        self.app.config['ANILIST_API_URL'] = self.fake.url
+        api_clients_async.reset_client()
+        rate_limiter.reset_scheduler()
+        api_cache.reset_response_cache()
+
+    def tearDown(self):
+        api_clients_async.reset_client()
+        self.fake.stop()
+
+    def test_fetch_all_character_media(self):
+        """ All pages come back in page order, page 1 then the rest at once """
+
+        start = time.perf_counter()
+        edges = asyncio.run(api_clients_async.fetch_all_character_media(1, self.app))
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual([edge['node']['id'] for edge in edges], list(range(1, 6 * 25 + 1)))
+        self.assertEqual(self.fake.request_count, 6)
+        self.assertLess(elapsed, 0.1 * 4)
+
+    def test_fork(self):
+        """ A forked worker (gunicorn --preload) gets its own loop, the parent's thread didn't come along """
+
+        self.assertEqual(len(asyncio.run(api_clients_async.fetch_all_character_media(1, self.app))), 6 * 25)
+
+        pid = os.fork()
+        if pid == 0:
+            # The child, exit status 0 if the lookup worked. The fake's server thread is gone too, so it's
+            # the response cache answering, what matters is that the loop ran the call at all.
+            status = 1
+            try:
+                edges = asyncio.run(asyncio.wait_for(api_clients_async.fetch_all_character_media(1, self.app), 5))
+                status = 0 if len(edges) == 6 * 25 else 1
+            finally:
+                os._exit(status)
+
+        self.assertEqual(os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]), 0)
+
+    def test_rate_limited_walk(self):
+        """ Pages waiting on the rate limit sleep on the loop, they don't each hold an executor thread """
+
+        self.fake.stop()
+        self.fake = FakeAniList(pages=12, per_page=25).start()
+        self.app.config['ANILIST_API_URL'] = self.fake.url
+        # A bucket of 4 refilling at 10 a second, so 8 of the 12 pages have to wait their turn
+        rate_limiter._scheduler = rate_limiter.UpstreamScheduler(limit=4, period=0.4)
+
+        start = time.perf_counter()
+        edges = asyncio.run(api_clients_async.fetch_all_character_media(1, self.app))
+
+        self.assertEqual(len(edges), 12 * 25)
+        self.assertGreater(time.perf_counter() - start, 0.6)
+        # Nothing on the AniList loop ever needed its default executor
+        self.assertIsNone(api_clients_async.get_loop()._default_executor)
+
+    def test_failed_first_page(self):
+        """ A dead upstream gives an empty list / 500, not an exception """
+
+        self.fake.stop()
+
+        self.assertEqual(asyncio.run(api_clients_async.fetch_all_character_media(1, self.app)), [])
+        response = asyncio.run(api_clients_async.search_voice_actors('Nakai', self.app))
+        self.assertEqual(response['data']['status_code'], 500)
+        self.assertFalse(asyncio.run(api_clients_async.is_anilist_username_accessible('someone', self.app)))
+
+    def test_failed_later_page(self):
+        """ A walk that stops at a failed page comes back marked incomplete, for every waiter """
+
+        self.fake.failing_pages = {3}
+
+        async def many():
+            return await asyncio.gather(*(api_clients_async.fetch_series_characters_roles(1, self.app) for _ in range(3)))
+
+        for edges in asyncio.run(many()):
+            self.assertIsInstance(edges, api_clients.IncompleteList)
+            self.assertEqual(len(edges), 2 * 25)
+
+    def test_search_page(self):
+        """ page= gets just that page, the same as the sync client """
+
+        response = asyncio.run(api_clients_async.search_anime_series('Slayer', self.app, page=2))
+        api_cache.reset_response_cache()
+        self.assertEqual(response, api_clients.search_anime_series('Slayer', self.app, page=2))
+        self.assertEqual(response['data']['next_page'], 3)
+        self.assertEqual(len(response['data']['series']), 50)
+
+    def test_concurrent_lookups_share_one_walk(self):
+        """ Identical lookups awaited together cost one set of page requests """
+
+        async def many():
+            return await asyncio.gather(*(api_clients_async.fetch_series_characters_roles(1, self.app) for _ in range(10)))
+
+        results = asyncio.run(many())
+
+        self.assertEqual(self.fake.request_count, 6)
+        for edges in results:
+            self.assertEqual(len(edges), 6 * 25)
+        # Everyone has their own copy
+        self.assertEqual(len(set(id(edges) for edges in results)), 10)
@@ -0,0 +1,103 @@
+""" Static asset pipeline tests """
+
+# run these tests like:
+# python -m unittest discover -s tests
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import brotli
+from PIL import Image
+
+# Sets up the test settings before app is imported
+import fake_anilist
+
+import assets
+from app import app
+
+
+class AssetPipelineTestCase(TestCase):
+    """ Test building fingerprinted assets and serving them """
+
+    def setUp(self):
+        self.static_folder = tempfile.mkdtemp()
+        self.real_static_folder = app.static_folder
+        app.static_folder = self.static_folder
+
+        os.makedirs(os.path.join(self.static_folder, 'images'))
+        Image.new('RGB', (1200, 600), (200, 80, 40)).save(os.path.join(self.static_folder, 'images', 'bg.png'))
+        with open(os.path.join(self.static_folder, 'app.css'), 'w') as f:
+            f.write('.hero {\n  background-image: url(/static/images/bg.png);\n}\n' * 50)
+        with open(os.path.join(self.static_folder, 'app.scss'), 'w') as f:
+            f.write('// source only\n')
+
+        self.manifest = assets.build_assets(self.static_folder, assets.dist_folder(app),
+                                            widths=(480, 960, 1920), formats=('webp',))
+        assets.reset_manifest()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.static_folder = self.real_static_folder
+        assets.reset_manifest()
+        shutil.rmtree(self.static_folder)
+
+    def test_build(self):
+        css_name = self.manifest['files']['app.css']
+        self.assertRegex(css_name, r'^app\.[0-9a-f]{12}\.css$')
+        self.assertNotIn('app.scss', self.manifest['files'])
+
+        dist = assets.dist_folder(app)
+        with open(os.path.join(dist, css_name), 'rb') as f:
+            css = f.read()
+        with open(os.path.join(dist, css_name + '.br'), 'rb') as f:
+            self.assertEqual(brotli.decompress(f.read()), css)
+        with open(os.path.join(dist, css_name + '.gz'), 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), css)
+
+        # Image urls point at the hashed files, backgrounds get an image-set() too
+        self.assertIn(f"url(/assets/{self.manifest['files']['images/bg.png']})", css.decode())
+        self.assertIn('image-set(url(/assets/images/bg-1200w.', css.decode())
+
+        # Never upscaled past the image's own 1200px
+        widths = [width for name, width in self.manifest['images']['images/bg.png']['variants']['image/webp']]
+        self.assertEqual(widths, [480, 960, 1200])
+
+    def test_serve_asset(self):
+        url = '/assets/' + self.manifest['files']['app.css']
+
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        resp.close()
+
+        resp = self.client.get(url, headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn(b'.hero', resp.data)
+        resp.close()
+
+    def test_template_helpers(self):
+        with app.test_request_context():
+            self.assertEqual(assets.asset_url('app.css', app), '/assets/' + self.manifest['files']['app.css'])
+
+            picture = assets.responsive_image('images/bg.png', app, alt='Background', class_='img-fluid')
+            self.assertIn('<source type="image/webp" srcset="/assets/images/bg-480w.', picture)
+            self.assertIn('960w, /assets/images/bg-1200w.', picture)
+            self.assertIn('class="img-fluid"', picture)
+            self.assertIn('width="1200" height="600"', picture)
+
+    def test_no_manifest(self):
+        """ Without a build, templates fall back to the plain static files """
+
+        shutil.rmtree(assets.dist_folder(app))
+        assets.reset_manifest()
+
+        with app.test_request_context():
+            self.assertEqual(assets.asset_url('app.css', app), '/static/app.css')
+            self.assertEqual(assets.responsive_image('images/bg.png', app),
+                             '<picture><img src="/static/images/bg.png" alt="" /></picture>')
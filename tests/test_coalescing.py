@@ -0,0 +1,100 @@
+""" Request coalescing tests, run against the local stand-in in fake_anilist.py """
+
+# run these tests like:
+# python -m unittest discover -s tests
+
+import threading
+from unittest import TestCase
+
+# Before app, importing it sets up the test settings
+from fake_anilist import AniListTestCase
+
+from app import app
+from singleflight import SingleFlight
+
+AUTH_HEADER = {'Authorization': 'Bearer wnYW3pY6b/pmAsNur?sbx=EOrTDKqslHIGjG'}
+
+
+class SingleFlightTestCase(TestCase):
+    """ Test the SingleFlight helper on its own """
+
+    def test_followers_share_result(self):
+        """ Callers arriving while a call is running get its result, not a new call """
+
+        flights = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {'items': [1, 2, 3]}
+
+        leader = threading.Thread(target=lambda: results.append(flights.do('k', slow)))
+        leader.start()
+        started.wait(5)
+
+        followers = [threading.Thread(target=lambda: results.append(flights.do('k', slow))) for _ in range(4)]
+        for thread in followers:
+            thread.start()
+
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'items': [1, 2, 3]}] * 5)
+        # Everyone has their own copy
+        self.assertEqual(len(set(id(result) for result in results)), 5)
+        self.assertEqual(flights.in_flight(), 0)
+
+    def test_exception_is_shared(self):
+        """ A failing call raises for the leader and followers, then the key is free again """
+
+        flights = SingleFlight()
+
+        def fail():
+            raise ValueError('nope')
+
+        with self.assertRaises(ValueError):
+            flights.do('k', fail)
+        self.assertEqual(flights.do('k', lambda: 'ok'), 'ok')
+
+
+class CoalescingTestCase(AniListTestCase):
+    """ Test concurrent identical views cost one set of upstream requests """
+
+    PAGES = 4
+    CLIENTS = 10
+    # Slow enough that every client shows up while the first walk is still running
+    anilist = {'pages': PAGES, 'latency': 0.2}
+
+    def test_concurrent_character_media_coalesced(self):
+        """ N clients asking for the same VA at once trigger exactly one page sequence """
+
+        barrier = threading.Barrier(self.CLIENTS)
+        responses = []
+
+        def get_character_media():
+            client = app.test_client()
+            barrier.wait(5)
+            responses.append(client.get('/api/character_media/5', headers=AUTH_HEADER))
+
+        threads = [threading.Thread(target=get_character_media) for _ in range(self.CLIENTS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+
+        self.assertEqual(len(responses), self.CLIENTS)
+        for resp in responses:
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(resp.get_json()), self.PAGES * 25)
+
+        # One request per page, and only one walk started
+        self.assertEqual(self.fake.request_count, self.PAGES)
+        pages = sorted(variables['page'] for root, variables in self.fake.requests)
+        self.assertEqual(pages, list(range(1, self.PAGES + 1)))
@@ -0,0 +1,52 @@
+""" App factory tests """
+
+# run these tests like:
+# python -m unittest discover -s tests
+
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+# Sets up the test settings before app is imported
+import fake_anilist
+
+from app import create_app
+
+
+class CreateAppTestCase(TestCase):
+    """ Test what create_app() sets up, and that it leaves the database alone """
+
+    def test_no_database_needed(self):
+        """ Building the app and serving a page that doesn't need the database never opens it """
+
+        missing = os.path.join(tempfile.gettempdir(), 'onsei-no-such-dir', 'test.db')
+        app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{missing}', 'DEBUG_TB_ENABLED': False})
+
+        resp = app.test_client().get('/')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('Login', str(resp.data))
+        self.assertFalse(os.path.exists(os.path.dirname(missing)))
+
+    def test_extensions(self):
+        """ The toolbar only when it's switched on, Flask-Migrate only under the flask command """
+
+        app = create_app({'DEBUG_TB_ENABLED': False})
+        self.assertNotIn('_debug_toolbar.static', app.view_functions)
+        self.assertNotIn('migrate', app.extensions)
+        self.assertIn('sqlalchemy', app.extensions)
+        self.assertIn('va_details', {rule.endpoint.rpartition('.')[2] for rule in app.url_map.iter_rules()})
+
+        app = create_app({'DEBUG_TB_ENABLED': True, 'SECRET_KEY': 'x'})
+        self.assertIn('_debug_toolbar.static', app.view_functions)
+
+    def test_async_client_not_imported(self):
+        """ aiohttp and the async client load on the first /api/async request, not with the app """
+
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        # A fresh interpreter, this one has imported everything the other tests use
+        check = 'import sys, app; print(sorted({"aiohttp", "api_clients_async"} & set(sys.modules)))'
+        result = subprocess.run([sys.executable, '-c', check], cwd=root, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.splitlines()[-1], '[]')
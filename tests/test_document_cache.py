@@ -0,0 +1,184 @@
+""" Database document cache tests, run against the local stand-in in fake_anilist.py """
+
+# run these tests like:
+# python -m unittest discover -s tests
+
+import gzip
+import json
+from datetime import datetime, timedelta
+
+# Before app, importing it sets up the test settings
+from fake_anilist import AniListTestCase
+
+import api_cache
+import api_clients_async
+from app import app
+from models import db, StaffDocument, CharacterMediaList, SeriesRoleList, User
+
+AUTH_HEADER = {'Authorization': 'Bearer wnYW3pY6b/pmAsNur?sbx=EOrTDKqslHIGjG'}
+
+
+class DocumentCacheTestCase(AniListTestCase):
+    """ Test Staff / Media documents and lists are served from the database """
+
+    anilist = {'pages': 3}
+
+    def test_va_details_survive_restart(self):
+        """ With the in-process cache gone, the VA still comes from the database """
+
+        resp = self.client.get('/va/5')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('Fake Staff 5', str(resp.data))
+
+        # Simulate a worker restart
+        api_cache.reset_response_cache()
+
+        resp = self.client.get('/va/5')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('Fake Staff 5', str(resp.data))
+        self.assertEqual(self.fake.request_count, 1)
+
+    def test_stale_document_is_refreshed(self):
+        StaffDocument.store(5, {'id': 5, 'name': {'full': 'Old Name'}})
+        document = db.session.get(StaffDocument, 5)
+        document.fetched_at = datetime.utcnow() - app.config['DOCUMENT_CACHE_MAX_AGE'] - timedelta(minutes=1)
+        db.session.commit()
+
+        resp = self.client.get('/va/5')
+        self.assertIn('Fake Staff 5', str(resp.data))
+        self.assertEqual(self.fake.request_count, 1)
+
+    def test_character_media_from_database(self):
+        first = self.client.get('/api/character_media/5', headers=AUTH_HEADER).get_json()
+        api_cache.reset_response_cache()
+        second = self.client.get('/api/character_media/5', headers=AUTH_HEADER).get_json()
+
+        self.assertEqual(len(first), 3 * 25)
+        self.assertEqual(first, second)
+        self.assertEqual(self.fake.request_count, 3)
+
+    def test_incomplete_list_not_stored(self):
+        """ A page failing part way through is served as far as it got, but not cached as the whole list """
+
+        self.fake.failing_pages = {2}
+        self.assertEqual(len(self.client.get('/api/character_media/5', headers=AUTH_HEADER).get_json()), 25)
+        self.assertIsNone(db.session.get(CharacterMediaList, 5))
+
+        self.fake.failing_pages = set()
+        api_cache.reset_response_cache()
+        self.assertEqual(len(self.client.get('/api/character_media/5', headers=AUTH_HEADER).get_json()), 3 * 25)
+        self.assertEqual(len(db.session.get(CharacterMediaList, 5).data), 3 * 25)
+
+    def test_incomplete_async_list_not_stored(self):
+        """ Same for the async route, and everyone waiting on the walk is told it's incomplete """
+
+        self.fake.failing_pages = {2}
+        api_clients_async.reset_client()
+        self.assertEqual(len(self.client.get('/api/async/series_roles/7', headers=AUTH_HEADER).get_json()), 25)
+        api_clients_async.reset_client()
+        self.assertIsNone(db.session.get(SeriesRoleList, 7))
+
+    def test_async_series_roles_match_sync(self):
+        """ The async route stores and serves the same list as the sync one """
+
+        api_clients_async.reset_client()
+        async_roles = self.client.get('/api/async/series_roles/7', headers=AUTH_HEADER).get_json()
+        api_clients_async.reset_client()
+
+        self.assertEqual(len(async_roles), 3 * 25)
+        self.assertEqual(self.client.get('/api/series_roles/7', headers=AUTH_HEADER).get_json(), async_roles)
+        self.assertEqual(self.fake.request_count, 3)
+        self.assertEqual(self.client.get('/api/async/series_roles/7').status_code, 403)
+
+    def test_character_media_with_user_list(self):
+        """ Logged in users get their list merged in server side, only when asked for """
+
+        user = User.signup('listuser', 'listuser@example.com', 'Password8784$$')
+        user.anilist_profile_accessible = True
+        user.anime_list = {2: {'status': 'COMPLETED', 'score': 8}}
+        db.session.commit()
+
+        with self.client.session_transaction() as session:
+            session['curr_user'] = user.id
+
+        plain = self.client.get('/api/character_media/5', headers=AUTH_HEADER).get_json()
+        self.assertNotIn('onUserList', plain[0]['node'])
+
+        merged = self.client.get('/api/character_media/5?user_list=1', headers=AUTH_HEADER).get_json()
+        self.assertEqual(len(merged), 3 * 25)
+        self.assertEqual([e['node']['id'] for e in merged if e['node']['onUserList']], [2])
+        self.assertEqual(merged[1]['node']['userListScore'], 8)
+
+        only = self.client.get('/api/character_media/5?user_list=only', headers=AUTH_HEADER).get_json()
+        self.assertEqual([e['node']['id'] for e in only], [2])
+
+    def test_streamed_character_media(self):
+        """ One NDJSON line per page, never held whole so not stored, streamed from the database once it is """
+
+        resp = self.client.get('/api/stream/character_media/5?user_list=1', headers=AUTH_HEADER)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+
+        pages = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual([len(page) for page in pages], [25, 25, 25])
+        self.assertEqual(self.fake.request_count, 3)
+        self.assertIsNone(db.session.get(CharacterMediaList, 5))
+
+        # The JSON endpoint stores it, from the pages the response cache kept
+        listed = self.client.get('/api/character_media/5', headers=AUTH_HEADER).get_json()
+        self.assertEqual(self.fake.request_count, 3)
+
+        api_cache.reset_response_cache()
+        resp = self.client.get('/api/stream/character_media/5', headers=AUTH_HEADER)
+        streamed = [edge for line in resp.get_data(as_text=True).splitlines() for edge in json.loads(line)]
+
+        self.assertEqual(streamed, listed)
+        self.assertEqual(self.fake.request_count, 3)
+        self.assertEqual(self.client.get('/api/stream/series_roles/7').status_code, 403)
+
+    def test_incomplete_stream_not_stored(self):
+        """ A stream that stopped at a failed page sends what it has, but isn't cached as the whole list """
+
+        self.fake.failing_pages = {3}
+        resp = self.client.get('/api/stream/character_media/5', headers=AUTH_HEADER)
+        self.assertEqual([len(json.loads(line)) for line in resp.get_data(as_text=True).splitlines()], [25, 25])
+        self.assertIsNone(db.session.get(CharacterMediaList, 5))
+
+    def test_conditional_get(self):
+        """ A repeat visit with the ETag gets a 304 and no body """
+
+        resp = self.client.get('/api/series_roles/7', headers=AUTH_HEADER)
+        etag = resp.headers['ETag']
+        self.assertIn('private', resp.headers['Cache-Control'])
+
+        resp = self.client.get('/api/series_roles/7', headers=dict(AUTH_HEADER, **{'If-None-Match': etag}))
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b'')
+
+        # Streamed lists get an ETag once they're served from the database
+        resp = self.client.get('/api/stream/character_media/5', headers=AUTH_HEADER)
+        resp.get_data()
+        self.assertNotIn('ETag', resp.headers)
+        self.client.get('/api/character_media/5', headers=AUTH_HEADER)
+        etag = self.client.get('/api/stream/character_media/5', headers=AUTH_HEADER).headers['ETag']
+
+        resp = self.client.get('/api/stream/character_media/5', headers=dict(AUTH_HEADER, **{'If-None-Match': etag}))
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(self.fake.request_count, 3 + 3)
+
+    def test_compressed_response(self):
+        """ Big JSON goes out compressed, and the compressed ETag still gets a 304 """
+
+        resp = self.client.get('/api/series_roles/7', headers=dict(AUTH_HEADER, **{'Accept-Encoding': 'gzip'}))
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(resp.data))), 3 * 25)
+        self.assertTrue(resp.headers['ETag'].endswith(':gzip"'))
+
+        resp = self.client.get('/api/series_roles/7', headers=dict(AUTH_HEADER, **{
+            'Accept-Encoding': 'gzip',
+            'If-None-Match': resp.headers['ETag'],
+        }))
+        self.assertEqual(resp.status_code, 304)
+
+        # Not worth compressing
+        resp = self.client.get('/api/suggest?q=zzz', headers=dict(AUTH_HEADER, **{'Accept-Encoding': 'gzip'}))
+        self.assertNotIn('Content-Encoding', resp.headers)
@@ -0,0 +1,38 @@
+""" Helper tests """
+
+# run these tests like:
+# python -m unittest discover -s tests
+
+from unittest import TestCase
+
+import helpers
+
+ANIME_LIST = {
+    1: {'status': 'COMPLETED', 'score': 9},
+    3: {'status': 'CURRENT', 'score': 0},
+}
+
+
+def edge(media_id):
+    return {'node': {'id': media_id, 'seasonYear': 2000 + media_id}, 'characters': []}
+
+
+class HelpersTestCase(TestCase):
+    """ Test merging the user's list into characterMedia edges """
+
+    def test_annotate_character_media(self):
+        edges = [edge(1), edge(2), edge(3)]
+        annotated = helpers.annotate_character_media(edges, ANIME_LIST)
+
+        self.assertEqual([e['node']['onUserList'] for e in annotated], [True, False, True])
+        self.assertEqual(annotated[0]['node']['userListScore'], 9)
+        self.assertEqual(annotated[0]['node']['userListStatus'], 'COMPLETED')
+        self.assertEqual(annotated[2]['node']['userListSeasonYear'], 2003)
+        # The cached edges aren't touched
+        self.assertNotIn('onUserList', edges[0]['node'])
+
+    def test_annotate_on_list_only(self):
+        annotated = helpers.annotate_character_media([edge(1), edge(2), edge(3)], ANIME_LIST, on_list_only=True)
+
+        self.assertEqual([e['node']['id'] for e in annotated], [1, 3])
+
@@ -0,0 +1,148 @@
+""" Background job queue tests, list refreshes run against the local stand-in in fake_anilist.py """
+
+# run these tests like:
+# python -m unittest discover -s tests
+
+from datetime import datetime, timedelta
+
+# Before app, importing it sets up the test settings
+from fake_anilist import AniListTestCase
+
+import jobs
+from app import app
+from models import db, User, Job, JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED
+
+
+class JobQueueTestCase(AniListTestCase):
+    """ Test queueing and running anime list refreshes """
+
+    config = {'WTF_CSRF_ENABLED': False}
+
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.signup('testuser', 'testuser@example.com', 'Password8784$$')
+        self.user.anilist_username = 'someone'
+        self.user.anilist_profile_accessible = True
+        self.user.anime_list_updated_at = datetime.utcnow() - timedelta(days=30)
+        db.session.commit()
+
+    def test_enqueue_list_refresh_once(self):
+        first = jobs.enqueue_list_refresh(self.user)
+        db.session.commit()
+        second = jobs.enqueue_list_refresh(self.user)
+        db.session.commit()
+
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(Job.query.count(), 1)
+        self.assertTrue(jobs.list_refresh_pending(self.user))
+
+    def test_login_queues_refresh(self):
+        """ Logging in with a stale list queues the refresh instead of fetching it """
+
+        resp = self.client.post('/login', data={'username': 'testuser', 'password': 'Password8784$$'})
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.fake.request_count, 0)
+        self.assertEqual(Job.query.one().status, JOB_QUEUED)
+
+        with self.client.session_transaction() as sess:
+            sess['curr_user'] = self.user.id
+        self.assertTrue(self.client.get('/api/list_status').get_json()['refreshing'])
+
+    def test_worker_refreshes_list(self):
+        jobs.enqueue_list_refresh(self.user)
+        db.session.commit()
+
+        self.assertEqual(jobs.run_worker(app, once=True), 1)
+
+        user = db.session.get(User, self.user.id)
+        self.assertEqual(len(user.anime_list), self.fake.per_page)
+        self.assertGreater(user.anime_list_updated_at, datetime.utcnow() - timedelta(minutes=1))
+        self.assertEqual(Job.query.one().status, JOB_DONE)
+        self.assertFalse(jobs.list_refresh_pending(user))
+
+    def test_failed_job_retried_then_failed(self):
+        job = jobs.enqueue('no_such_kind')
+        db.session.commit()
+
+        jobs.run_job(jobs.claim_next_job(), app)
+        self.assertEqual(job.status, JOB_QUEUED)
+        self.assertGreater(job.run_at, datetime.utcnow())
+
+        # Not runnable again until its retry delay is up
+        self.assertIsNone(jobs.claim_next_job())
+
+        for attempt in range(app.config['JOB_MAX_ATTEMPTS'] - 1):
+            job.run_at = datetime.utcnow()
+            db.session.commit()
+            jobs.run_job(jobs.claim_next_job(), app)
+
+        self.assertEqual(job.status, JOB_FAILED)
+        self.assertIn('no_such_kind', job.error)
+
+    def test_stale_running_job_requeued(self):
+        job = jobs.enqueue_list_refresh(self.user)
+        db.session.commit()
+        jobs.claim_next_job()
+
+        self.assertEqual(jobs.requeue_stale_jobs(timedelta(minutes=10)), 0)
+
+        job.started_at = datetime.utcnow() - timedelta(hours=1)
+        db.session.commit()
+        self.assertEqual(jobs.requeue_stale_jobs(timedelta(minutes=10)), 1)
+        self.assertEqual(db.session.get(Job, job.id).status, JOB_QUEUED)
+
+    def test_delta_sync_only_fetches_changes(self):
+        self.assertEqual(jobs.sync_anime_list(self.user, app), 'full')
+        db.session.commit()
+        self.assertEqual(len(self.user.anime_list), 25)
+
+        # Nothing changed on AniList, one small page comes back empty
+        self.fake.reset_counts()
+        self.assertEqual(jobs.sync_anime_list(self.user, app), 'delta')
+        self.assertEqual(self.fake.requests, [('Page', {'userName': 'someone', 'page': 1, 'perPage': 50})])
+
+        # Rescored, dropped and newly added entries
+        self.fake.list_entries[1].update(score=10, updatedAt=1700000001)
+        self.fake.list_entries[2].update(status='DROPPED', updatedAt=1700000002)
+        self.fake.list_entries[99] = {'mediaId': 99, 'status': 'CURRENT', 'score': 7, 'updatedAt': 1700000003}
+
+        self.assertEqual(jobs.sync_anime_list(self.user, app), 'delta')
+        db.session.commit()
+
+        anime_list = self.user.anime_list
+        self.assertEqual(anime_list[1]['score'], 10)
+        self.assertNotIn(2, anime_list)
+        self.assertEqual(anime_list[99], {'status': 'CURRENT', 'score': 7})
+        self.assertEqual(self.user.anime_list_synced_through, 1700000003)
+
+    def test_full_sync_on_schedule(self):
+        jobs.sync_anime_list(self.user, app)
+        self.user.anime_list_full_sync_at -= app.config['ANILIST_LIST_FULL_SYNC_INTERVAL'] + timedelta(minutes=1)
+        db.session.commit()
+
+        # Deleted outright on AniList, only a full sync notices
+        del self.fake.list_entries[3]
+
+        self.assertEqual(jobs.sync_anime_list(self.user, app), 'full')
+        db.session.commit()
+        self.assertNotIn(3, self.user.anime_list)
+
+    def test_failed_full_sync_keeps_list(self):
+        """ AniList failing mid full sync leaves the stored list alone, and the job is retried """
+
+        jobs.sync_anime_list(self.user, app)
+        full_sync_at = self.user.anime_list_full_sync_at - app.config['ANILIST_LIST_FULL_SYNC_INTERVAL'] - timedelta(minutes=1)
+        self.user.anime_list_full_sync_at = full_sync_at
+        job = jobs.enqueue_list_refresh(self.user)
+        db.session.commit()
+
+        self.fake.force_response(500, count=10)
+        jobs.run_worker(app, once=True)
+
+        user = db.session.get(User, self.user.id)
+        self.assertEqual(len(user.anime_list), 25)
+        self.assertEqual(user.anime_list_full_sync_at, full_sync_at)
+        self.assertEqual(db.session.get(Job, job.id).status, JOB_QUEUED)
+        self.assertIn('failed', db.session.get(Job, job.id).error)
@@ -0,0 +1,142 @@
+""" Logging pipeline tests """
+
+# run these tests like:
+# python -m unittest discover -s tests
+
+import json
+import logging
+import os
+import queue
+import sys
+import tempfile
+from unittest import TestCase
+
+# Sets up the test settings before app is imported
+import fake_anilist
+
+import logs
+import metrics
+from app import app
+
+
+class LogPipelineTestCase(TestCase):
+    """ Test sampling, caps, the queue and the formatters """
+
+    def setUp(self):
+        self.queue = queue.Queue(3)
+        self.handler = logs.CappedQueueHandler(self.queue, max_chars=20)
+        self.logger = logging.getLogger('onsei.test')
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.propagate = True
+        self.logger.setLevel(logging.NOTSET)
+
+    def test_prepare(self):
+        """ The message is merged and capped before it's queued, the arguments aren't held on to """
+
+        page = {'id': 1}
+        self.logger.debug('Page %s', page, extra={'body': 'x' * 50, 'status': 200})
+        page['id'] = 2
+
+        record = self.queue.get_nowait()
+        self.assertEqual(record.msg, "Page {'id': 1}")
+        self.assertIsNone(record.args)
+        self.assertEqual(record.body, 'x' * 20 + '... (30 more chars)')
+        self.assertEqual(record.status, 200)
+
+    def test_lazy(self):
+        calls = []
+        self.logger.setLevel(logging.INFO)
+        self.logger.debug('Body: %s', logs.lazy(lambda: calls.append(1)))
+        self.assertEqual(calls, [])
+        self.assertTrue(self.queue.empty())
+
+    def test_full_queue(self):
+        """ A full queue drops the record instead of blocking the request """
+
+        dropped = metrics.LOG_RECORDS_DROPPED.value()
+        for i in range(5):
+            self.logger.info('Line %s', i)
+
+        self.assertEqual(self.queue.qsize(), 3)
+        self.assertEqual(metrics.LOG_RECORDS_DROPPED.value(), dropped + 2)
+
+    def test_sampling(self):
+        self.handler.addFilter(logs.SampleFilter({'onsei.test': 10, 'onsei': 1}))
+
+        kept = []
+        for i in range(30):
+            self.logger.debug('Line %s', i)
+            while not self.queue.empty():
+                kept.append(self.queue.get_nowait())
+        self.assertEqual([record.msg for record in kept], ['Line 0', 'Line 10', 'Line 20'])
+        self.assertEqual(kept[0].sampled, 10)
+
+        # Warnings always go out
+        self.logger.warning('Careful')
+        self.assertEqual(self.queue.get_nowait().msg, 'Careful')
+
+    def test_json_formatter(self):
+        try:
+            raise ValueError('nope')
+        except ValueError:
+            self.logger.exception('Failed %s', 'job', extra={'job_id': 7})
+
+        entry = json.loads(logs.JsonFormatter().format(self.queue.get_nowait()))
+        self.assertEqual(entry['level'], 'ERROR')
+        self.assertEqual(entry['logger'], 'onsei.test')
+        self.assertEqual(entry['msg'], 'Failed job')
+        self.assertEqual(entry['job_id'], 7)
+        self.assertIn('ValueError: nope', entry['exc'])
+
+    def test_text_formatter(self):
+        self.logger.info('Page %s', 2, extra={'query': 'Staff'})
+        self.assertRegex(logs.TextFormatter().format(self.queue.get_nowait()), r' INFO onsei.test: Page 2 query=Staff$')
+
+    def test_levels(self):
+        """ LOG_LEVELS sets a level per category, the rest follow LOG_LEVEL """
+
+        levels = app.config.get('LOG_LEVELS')
+        app.config['LOG_LEVELS'] = 'onsei.anilist=DEBUG, onsei.anilist.cache=ERROR'
+        try:
+            logs.setup_logging(app)
+            self.assertTrue(logging.getLogger('onsei.anilist').isEnabledFor(logging.DEBUG))
+            self.assertFalse(logging.getLogger('onsei.anilist.cache').isEnabledFor(logging.WARNING))
+            self.assertFalse(logging.getLogger('sqlalchemy.engine').isEnabledFor(logging.INFO))
+        finally:
+            app.config['LOG_LEVELS'] = levels
+            logging.getLogger('onsei.anilist').setLevel(logging.NOTSET)
+            logging.getLogger('onsei.anilist.cache').setLevel(logging.NOTSET)
+            logs.setup_logging(app)
+
+    def test_fork(self):
+        """ A forked worker (gunicorn --preload) gets its own listener thread, its records are written """
+
+        stderr = sys.stderr
+        with tempfile.TemporaryFile('w+') as output:
+            sys.stderr = output
+            try:
+                logs.setup_logging(app)
+            finally:
+                sys.stderr = stderr
+
+            try:
+                pid = os.fork()
+                if pid == 0:
+                    # The child, write a line and flush it out, then leave without running anything else
+                    try:
+                        logging.getLogger('onsei.forked').warning('From the child')
+                        logs.stop_logging()
+                    finally:
+                        os._exit(0)
+
+                os.waitpid(pid, 0)
+            finally:
+                logs.setup_logging(app)
+
+            output.seek(0)
+            self.assertIn('From the child', output.read())
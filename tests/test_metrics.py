@@ -0,0 +1,175 @@
+""" Metrics registry and /metrics tests """
+
+# run these tests like:
+# python -m unittest discover -s tests
+
+import threading
+import time
+from unittest import TestCase
+
+# Before app, importing it sets up the test settings
+from fake_anilist import AniListTestCase, FIXTURES_DIR
+
+import api_clients
+import metrics
+from app import app
+from metrics import Registry
+
+AUTH_HEADER = {'Authorization': 'Bearer wnYW3pY6b/pmAsNur?sbx=EOrTDKqslHIGjG'}
+
+
+class RegistryTestCase(TestCase):
+    """ Test counting across threads and the text format """
+
+    def setUp(self):
+        self.registry = Registry()
+        self.requests = self.registry.counter('requests_total', 'Requests', ('route',))
+        self.latency = self.registry.histogram('latency_seconds', 'Latency', ('route',), buckets=(0.1, 1))
+
+    def test_render(self):
+        self.requests.inc('home')
+        self.requests.inc('home', amount=2)
+        self.requests.inc('say "hi"\n')
+        self.latency.observe(0.05, 'home')
+        self.latency.observe(0.1, 'home')
+        self.latency.observe(3, 'home')
+
+        text = self.registry.render()
+        self.assertIn('# TYPE requests_total counter\n', text)
+        self.assertIn('requests_total{route="home"} 3\n', text)
+        self.assertIn('requests_total{route="say \\"hi\\"\\n"} 1\n', text)
+
+        # Buckets are cumulative and le is inclusive
+        self.assertIn('latency_seconds_bucket{route="home",le="0.1"} 2\n', text)
+        self.assertIn('latency_seconds_bucket{route="home",le="1"} 2\n', text)
+        self.assertIn('latency_seconds_bucket{route="home",le="+Inf"} 3\n', text)
+        self.assertIn('latency_seconds_sum{route="home"} 3.15\n', text)
+        self.assertIn('latency_seconds_count{route="home"} 3\n', text)
+
+    def test_threads(self):
+        """ Every thread writes its own shard, nothing is lost adding them up, even after the threads exit """
+
+        def work():
+            for i in range(1000):
+                self.requests.inc('home')
+                self.latency.observe(0.5, 'home')
+
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.requests.value('home'), 8000)
+        self.assertEqual(self.latency.count('home'), 8000)
+        # The exited threads' shards were folded into one
+        self.assertEqual(self.requests._shards, [])
+        self.assertEqual(self.requests.value('home'), 8000)
+
+        self.requests.inc('home')
+        self.assertEqual(self.requests.value('home'), 8001)
+
+        self.registry.clear()
+        self.assertEqual(self.requests.value('home'), 0)
+
+    def test_request_tally(self):
+        """ Pages sent from other threads count toward the request that asked for them """
+
+        tally = metrics.start_request()
+        started = time.perf_counter()
+        record = metrics.bind_request(lambda: metrics.record_upstream('Staff', '1', 200, started, pages=3))
+        thread = threading.Thread(target=record)
+        thread.start()
+        thread.join()
+        metrics.record_upstream('Staff', '', 200, started)
+
+        self.assertEqual(tally.page_count(), 4)
+        self.assertEqual(len(tally.upstream), 2)
+        metrics.finish_request(tally, 'va_details', 'GET', 200)
+        self.assertIsNone(metrics.current_tally())
+
+    def test_breakdown(self):
+        """ AniList time is how long anything was in flight, overlapping requests aren't counted twice """
+
+        tally = metrics.RequestTally()
+        tally.upstream = [(1.0, 1.2), (1.2, 1.5), (1.3, 1.4), (2.0, 2.1)]
+        tally.queries = [0.001, 0.002]
+        tally.add_phase('user', 0.0005)
+        tally.add_phase('template', 0.01)
+        tally.started, tally.finished = 0.0, 2.5
+
+        self.assertAlmostEqual(tally.upstream_time(), 0.6)
+        self.assertEqual(tally.server_timing(), 'user;dur=0.5, anilist;dur=600.0;desc="4 requests", '
+                                                'db;dur=3.0;desc="2 queries", template;dur=10.0, total;dur=2500.0')
+        self.assertEqual(tally.summary(), 'total=2500.0ms user=0.5ms anilist=600.0ms(4) db=3.0ms(2) template=10.0ms')
+
+    def test_describe_request(self):
+        query = api_clients.CHARACTER_MEDIA_QUERY
+        self.assertEqual(api_clients.describe_request(query, {'id': 1, 'page': 2}), ('Staff', '2', 1))
+        self.assertEqual(api_clients.describe_request(query, {'id': 1, 'page': 40}), ('Staff', '11+', 1))
+
+        batch_query, batch_variables = api_clients.build_batch_query(
+            [(f'q{i}', api_clients.VA_SEARCH_QUERY, {'search': 'a', 'page': page}) for i, page in enumerate((4, 5, 6))])
+        self.assertEqual(api_clients.describe_request(batch_query, batch_variables), ('Page.staff', '4', 3))
+
+
+class MetricsRouteTestCase(AniListTestCase):
+    """ Test what the routes record and the /metrics endpoint """
+
+    anilist = {'fixtures': FIXTURES_DIR, 'generate': False, 'repeat_pages': 3}
+    config = {'METRICS_TOKEN': None, 'METRICS_PUBLIC': False, 'REQUEST_TIMING_LOG': None}
+
+    def setUp(self):
+        super().setUp()
+        metrics.reset_metrics()
+
+    def test_character_media(self):
+        url = '/api/character_media/111635'
+        self.assertEqual(self.client.get(url, headers=AUTH_HEADER).status_code, 200)
+        self.assertEqual(self.client.get(url, headers=AUTH_HEADER).status_code, 200)
+
+        # 3 pages from AniList for the first request, the second came out of the document cache
+        self.assertEqual(metrics.UPSTREAM_REQUESTS.value('Staff', '200'), 3)
+        self.assertEqual(metrics.UPSTREAM_SECONDS.count('Staff', '1'), 1)
+        self.assertEqual(metrics.ROUTE_SECONDS.count('get_character_media', 'GET', '200'), 2)
+        self.assertEqual(metrics.PAGES_PER_REQUEST.count('get_character_media'), 2)
+        self.assertEqual(metrics.PAGES_PER_REQUEST.total('get_character_media'), 3)
+        self.assertEqual(metrics.CACHE_REQUESTS.value('character_media_lists', 'miss'), 1)
+        self.assertEqual(metrics.CACHE_REQUESTS.value('character_media_lists', 'hit'), 1)
+        self.assertGreater(metrics.DB_QUERY_SECONDS.count('SELECT'), 0)
+
+    def test_metrics_view(self):
+        self.client.get('/va/100938')
+
+        # No token and not made public, it isn't there
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+        app.config['METRICS_PUBLIC'] = True
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, metrics.CONTENT_TYPE)
+        text = resp.get_data(as_text=True)
+        self.assertIn('onsei_http_request_seconds_count{endpoint="va_details",method="GET",status="200"} 1\n', text)
+        self.assertIn('onsei_anilist_requests_total{query="Staff",status="200"} 1\n', text)
+        self.assertIn('onsei_cache_requests_total{cache="staff_documents",result="miss"} 1\n', text)
+
+        app.config['METRICS_TOKEN'] = 'scrape-me'
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        app.config['METRICS_PUBLIC'] = False
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer scrape-me'}).status_code, 200)
+
+    def test_server_timing(self):
+        with self.assertLogs('onsei.timing', 'INFO') as logs:
+            app.config['REQUEST_TIMING_LOG'] = 0
+            resp = self.client.get('/va/100938')
+
+        timing = resp.headers['Server-Timing']
+        self.assertRegex(timing, r'anilist;dur=[\d.]+;desc="1 request"')
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="\d+ queries"')
+        self.assertRegex(timing, r'template;dur=[\d.]+, total;dur=[\d.]+$')
+        self.assertRegex(logs.output[-1], r'GET /va/100938 200 total=[\d.]+ms anilist=[\d.]+ms\(1\) db=')
+
+        # Second time it's out of the document cache, no AniList time at all
+        timing = self.client.get('/va/100938').headers['Server-Timing']
+        self.assertNotIn('anilist', timing)
@@ -0,0 +1,48 @@
+""" Name index tests """
+
+# run these tests like:
+# python -m unittest discover -s tests
+
+import time
+from unittest import TestCase
+
+from name_index import NameIndex, KIND_VA, KIND_SERIES
+
+
+class NameIndexTestCase(TestCase):
+    """ Test prefix lookups on the in-process name index """
+
+    def setUp(self):
+        self.index = NameIndex(max_entries=3)
+        self.index.add(KIND_VA, 1, ['Kana Hanazawa'], 'kana.jpg')
+        self.index.add(KIND_SERIES, 2, ['Demon Slayer', 'Kimetsu no Yaiba'])
+
+    def test_prefix_of_any_word(self):
+        self.assertEqual([s['id'] for s in self.index.suggest('hana')], [1])
+        self.assertEqual([s['id'] for s in self.index.suggest('kimetsu')], [2])
+        # Shown under its first name, found under any of them
+        self.assertEqual(self.index.suggest('YAIBA')[0]['name'], 'Demon Slayer')
+        self.assertEqual(self.index.suggest('ka', kind=KIND_SERIES), [])
+
+    def test_accents_ignored(self):
+        self.index.add(KIND_VA, 3, ['Rié Kugimiya'])
+        self.assertEqual([s['id'] for s in self.index.suggest('rie k')], [3])
+
+    def test_bounded(self):
+        self.index.add(KIND_VA, 3, ['Rie Kugimiya'])
+        # Refreshing an entry makes it the newest
+        self.index.add(KIND_VA, 1, ['Kana Hanazawa'])
+        self.index.add(KIND_VA, 4, ['Aoi Yuki'])
+
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.suggest('demon'), [])
+        self.assertEqual(len(self.index.suggest('kana')), 1)
+
+    def test_fast_on_a_full_index(self):
+        index = NameIndex(max_entries=50000)
+        index.add_many((KIND_VA, i, [f'Name{i % 997} Family{i}'], None) for i in range(50000))
+
+        start = time.perf_counter()
+        for prefix in ('name1', 'family4', 'nam', 'zzz'):
+            index.suggest(prefix)
+        self.assertLess((time.perf_counter() - start) / 4, 0.01)
@@ -0,0 +1,62 @@
+""" Rate limit scheduler tests """
+
+# run these tests like:
+# python -m unittest discover -s tests
+
+import threading
+import time
+from unittest import TestCase
+
+from rate_limiter import UpstreamScheduler, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+
+
+class UpstreamSchedulerTestCase(TestCase):
+    """ Test the token bucket and priority lanes """
+
+    def test_learns_budget_from_headers(self):
+        """ Remaining from the server caps our own estimate """
+
+        scheduler = UpstreamScheduler(limit=90)
+        scheduler.update(200, {'X-RateLimit-Limit': '30', 'X-RateLimit-Remaining': '2'})
+
+        self.assertEqual(scheduler.limit, 30)
+        self.assertTrue(scheduler.acquire(timeout=0))
+        self.assertTrue(scheduler.acquire(timeout=0))
+        self.assertFalse(scheduler.acquire(timeout=0))
+
+    def test_retry_after_blocks_everyone(self):
+        scheduler = UpstreamScheduler(limit=90)
+        scheduler.update(429, {'Retry-After': '1'})
+
+        self.assertFalse(scheduler.acquire(timeout=0.5))
+        self.assertTrue(scheduler.acquire(timeout=1))
+
+    def test_background_leaves_reserve_for_interactive(self):
+        """ Background can't take the last tokens, interactive can """
+
+        scheduler = UpstreamScheduler(limit=10, period=1000, background_reserve=0.2)
+        scheduler.update(200, {'X-RateLimit-Remaining': '2'})
+
+        self.assertFalse(scheduler.acquire(PRIORITY_BACKGROUND, timeout=0))
+        self.assertTrue(scheduler.acquire(PRIORITY_INTERACTIVE, timeout=0))
+
+    def test_interactive_goes_first(self):
+        """ When both lanes are queued, interactive waiters get the next token """
+
+        scheduler = UpstreamScheduler(limit=10, period=1, background_reserve=0)
+        scheduler.update(200, {'X-RateLimit-Remaining': '0'})
+        order = []
+
+        def worker(priority, name):
+            scheduler.acquire(priority)
+            order.append(name)
+
+        background = threading.Thread(target=worker, args=(PRIORITY_BACKGROUND, 'background'))
+        background.start()
+        time.sleep(0.01)
+        interactive = threading.Thread(target=worker, args=(PRIORITY_INTERACTIVE, 'interactive'))
+        interactive.start()
+
+        background.join()
+        interactive.join()
+        self.assertEqual(order, ['interactive', 'background'])
@@ -2,15 +2,20 @@
 # export ENV=testing
 # python -m unittest discover -s tests
 
+# Before app, importing it sets up the test settings
+from fake_anilist import AniListTestCase, FIXTURES_DIR
 import os
 import unittest
-from unittest import TestCase
 from models import db, User
 from app import app
 from datetime import datetime
 
 
-class RoutesTestCase(TestCase):
+class RoutesTestCase(AniListTestCase):
+
+    # AniList is the recorded fixtures in tests/fixtures/anilist, anything else 404s
+    anilist = {'fixtures': FIXTURES_DIR, 'generate': False}
+    config = {'WTF_CSRF_ENABLED': False}
 
     def create_app(self):
         app.config['ENV'] = 'testing'
@@ -20,8 +25,7 @@ class RoutesTestCase(TestCase):
         return app
 
     def setUp(self):
-        db.drop_all()
-        db.create_all()
+        super().setUp()
 
         self.user = User.signup('testuser', 'testuser@example.com', 'Password8784$$')
         self.user.anilist_username = 'hopesix'
@@ -42,17 +46,6 @@ class RoutesTestCase(TestCase):
         self.user.anime_list_updated_at = datetime.utcnow()
         db.session.commit()
 
-        self.client = app.test_client()
-        self.app_context = app.app_context()
-        self.app_context.push()
-
-    def tearDown(self):
-        db.session.remove()
-        User.query.delete()
-        db.session.commit()
-        db.drop_all()
-        self.app_context.pop()
-    
     def test_index(self):
         """ Does index route work """
         with self.client as c:
@@ -147,6 +140,31 @@ class RoutesTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('Successfully logged out', str(resp.data))
 
+    def test_lazy_user(self):
+        """ The user is only loaded for views that use it, the header reads the session's identity """
+
+        with self.client as c:
+            form_data = {'username': 'testuser', 'password': 'Password8784$$'}
+            c.post('/login', data=form_data)
+
+            resp = c.get('/')
+            self.assertIn('Logout', str(resp.data))
+            self.assertNotIn('user;', resp.headers['Server-Timing'])
+
+            resp = c.get('/profile')
+            self.assertIn('user;', resp.headers['Server-Timing'])
+
+        # Deleted from under the session, they're logged out the next time the user is needed
+        db.session.delete(User.query.filter_by(username='testuser').first())
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get('/profile', follow_redirects=True)
+            self.assertIn('Access unauthorized', str(resp.data))
+
+            resp = c.get('/')
+            self.assertNotIn('Logout', str(resp.data))
+
     def test_profile_edit(self):
         """ Does viewing & editing profile work """    
 
@@ -185,6 +203,26 @@ class RoutesTestCase(TestCase):
             self.assertIsNotNone(updated_user)
             self.assertEqual(updated_user.anilist_username, 'WhaleJucs')
 
+    def test_profile_edit_anilist_down(self):
+        """ Changing the AniList username while AniList is unreachable still saves the profile """
+
+        with self.client as c:
+            form_data = {'username': 'testuser', 'password': 'Password8784$$'}
+            resp = c.post('/login', data=form_data, follow_redirects=True)
+
+        self.fake.stop()
+
+        with self.client as c:
+            form_data =  {'username': 'testuser', 'email': 'testuser2@test.com', 'password': 'Password8784$$', 'anilist_username': 'WhaleJucs'}
+            resp = c.post('/profile/edit', data=form_data, follow_redirects=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Profile edited successfully!', str(resp.data))
+
+            updated_user = User.query.filter_by(username='testuser').first()
+            self.assertEqual(updated_user.anilist_username, 'WhaleJucs')
+            self.assertFalse(updated_user.anilist_profile_accessible)
+
     def test_refresh_list(self):
         """ Can we refresh list? """    
 
@@ -198,7 +236,7 @@ class RoutesTestCase(TestCase):
             resp = c.get('/refresh-list', follow_redirects=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn('Anime List successfully refreshed!', str(resp.data)) 
+            self.assertIn('Anime List refresh queued!', str(resp.data)) 
 
     def test_fail_refresh_list(self):
         """ Get a fail response for an incorrect anilist username """    
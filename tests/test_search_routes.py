@@ -0,0 +1,56 @@
+""" Search route tests, run against the local stand-in in fake_anilist.py """
+
+# run these tests like:
+# python -m unittest discover -s tests
+
+# Before app, importing it sets up the test settings
+from fake_anilist import AniListTestCase
+
+import name_index
+
+AUTH_HEADER = {'Authorization': 'Bearer wnYW3pY6b/pmAsNur?sbx=EOrTDKqslHIGjG'}
+
+
+class SearchRoutesTestCase(AniListTestCase):
+    """ Test search results come a page at a time """
+
+    anilist = {'pages': 3}
+
+    def setUp(self):
+        super().setUp()
+        # /api/suggest fills the index from the document cache tables, empty now
+        name_index.reset_name_index()
+
+    def test_va_search_first_page_only(self):
+        resp = self.client.post('/va/search', data={'va-search': 'Nakai'})
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.fake.request_count, 1)
+        self.assertIn('href="/va/50"', html)
+        self.assertNotIn('href="/va/51"', html)
+        self.assertIn('data-next-page="2"', html)
+
+    def test_load_more_pages(self):
+        resp = self.client.get('/series/search?q=Demon&page=2&partial=1')
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.headers['X-Next-Page'], '3')
+        self.assertIn('href="/series/51"', html)
+        self.assertNotIn('Search Results', html)
+
+        # Last page, nothing more to load
+        resp = self.client.get('/series/search?q=Demon&page=3&partial=1')
+        self.assertEqual(resp.headers['X-Next-Page'], '')
+        self.assertEqual(self.fake.request_count, 2)
+
+    def test_suggest_names_already_seen(self):
+        """ Typeahead answers from names a search brought in, without going upstream """
+
+        self.client.post('/series/search', data={'series-search': 'Demon'})
+        self.fake.reset_counts()
+
+        resp = self.client.get('/api/suggest?q=series 4&type=series', headers=AUTH_HEADER)
+        self.assertEqual([s['id'] for s in resp.get_json()], [4, 40, 41, 42, 43, 44, 45, 46, 47, 48])
+        self.assertEqual(self.client.get('/api/suggest?q=series&type=va', headers=AUTH_HEADER).get_json(), [])
+        self.assertEqual(self.fake.request_count, 0)
@@ -0,0 +1,123 @@
+""" Image proxy tests, artwork comes from the local stand-in in fake_anilist.py """
+
+# run these tests like:
+# python -m unittest discover -s tests
+
+import os
+import shutil
+import tempfile
+from io import BytesIO
+from unittest import TestCase
+
+from PIL import Image
+
+# Before app, importing it sets up the test settings
+from fake_anilist import FakeAniList, blank_png
+
+import thumbnails
+from app import app
+
+
+class ImageProxyTestCase(TestCase):
+    """ Test /img fetches, downsizes and caches artwork """
+
+    def setUp(self):
+        self.fake = FakeAniList().start()
+        self.folder = tempfile.mkdtemp()
+
+        self.config = {key: app.config.get(key) for key in ('IMAGE_PROXY_HOSTS', 'IMAGE_PROXY_FOLDER')}
+        app.config['IMAGE_PROXY_HOSTS'] = ('127.0.0.1',)
+        app.config['IMAGE_PROXY_FOLDER'] = self.folder
+        thumbnails.reset_thumbnail_cache()
+
+        self.image_url = self.fake.url + 'images/character/large/1.png'
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self.fake.stop()
+        app.config.update(self.config)
+        thumbnails.reset_thumbnail_cache()
+        shutil.rmtree(self.folder)
+
+    def test_thumbnail_cached(self):
+        resp = self.client.get('/img/150', query_string={'url': self.image_url}, headers={'Accept': 'image/webp,*/*'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'image/webp')
+        self.assertIn('Accept', resp.headers['Vary'])
+        with Image.open(BytesIO(resp.data)) as image:
+            self.assertEqual(image.size, (150, 212))
+        resp.close()
+
+        # Second time it's off disk, even after a restart
+        thumbnails.reset_thumbnail_cache()
+        resp = self.client.get('/img/150', query_string={'url': self.image_url}, headers={'Accept': 'image/webp,*/*'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.fake.image_requests, 1)
+        resp.close()
+
+        # No WebP, no problem
+        resp = self.client.get('/img/150', query_string={'url': self.image_url}, headers={'Accept': 'image/png,*/*;q=0.8'})
+        self.assertEqual(resp.mimetype, 'image/jpeg')
+        resp.close()
+
+    def test_only_proxies_allowed_hosts_and_widths(self):
+        self.assertEqual(self.client.get('/img/150', query_string={'url': 'http://example.com/a.png'}).status_code, 404)
+        self.assertEqual(self.client.get('/img/151', query_string={'url': self.image_url}).status_code, 404)
+        self.assertEqual(self.fake.image_requests, 0)
+
+    def test_upstream_failure_redirects_to_original(self):
+        url = self.fake.url + 'missing'
+        resp = self.client.get('/img/150', query_string={'url': url})
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.location, url)
+
+    def test_huge_image_redirects_to_original(self):
+        """ A small file that decodes to billions of pixels is refused, not decoded """
+
+        self.fake.images['/images/huge.png'] = blank_png(20000, 20000)
+        url = self.fake.url + 'images/huge.png'
+
+        resp = self.client.get('/img/150', query_string={'url': url})
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.location, url)
+
+        # Without our own limit PIL's decompression bomb check still turns it away
+        with self.assertRaises(thumbnails.ImageProxyError):
+            thumbnails.make_thumbnail(self.fake.images['/images/huge.png'], 150, 'webp')
+        with self.assertRaises(thumbnails.ImageProxyError):
+            thumbnails.make_thumbnail(blank_png(3000, 3000), 150, 'webp', max_pixels=1000000)
+
+    def test_thumbnail_filter(self):
+        with app.test_request_context():
+            self.assertEqual(app.jinja_env.filters['thumbnail']('https://s4.anilist.co/a b.png', 64),
+                             '/img/64?url=https%3A%2F%2Fs4.anilist.co%2Fa+b.png')
+            self.assertIsNone(app.jinja_env.filters['thumbnail'](None))
+
+
+class ThumbnailCacheTestCase(TestCase):
+    """ Test the on disk LRU """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_evicts_least_recently_used(self):
+        cache = thumbnails.ThumbnailCache(self.folder, max_bytes=250)
+        cache.put('a.webp', b'a' * 100)
+        cache.put('b.webp', b'b' * 100)
+
+        # a is used again, so b is the one to go
+        self.assertIsNotNone(cache.get('a.webp'))
+        cache.put('c.webp', b'c' * 100)
+
+        self.assertIsNone(cache.get('b.webp'))
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'b.webp')))
+        self.assertIsNotNone(cache.get('a.webp'))
+        self.assertEqual(cache.size, 200)
+
+        # A fresh process picks up what's on disk
+        self.assertEqual(thumbnails.ThumbnailCache(self.folder, max_bytes=250).size, 200)
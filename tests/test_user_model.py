@@ -7,39 +7,27 @@
 # python -m unittest test_user_model.py
 
 import os
-from unittest import TestCase
+# Before app, importing it sets up the test settings
+from fake_anilist import AniListTestCase
 from sqlalchemy import exc
 
-from models import db, User
+from models import db, User, UserListEntry, migrate_pickled_anime_lists
 
 from app import app
 
-db.create_all()
 
-class UserModelTestCase(TestCase):
+class UserModelTestCase(AniListTestCase):
     """ Test user model """
 
     def setUp(self):
         """ Create test client, add sample data """
 
-        db.drop_all()
-        db.create_all()
+        super().setUp()
 
         self.user = User.signup('testuser', 'testuser@example.com', 'Password8784$$')
         
         db.session.commit()
 
-        self.client = app.test_client()
-        self.app_context = app.app_context()
-        self.app_context.push()
-
-    def tearDown(self):
-        db.session.remove()
-        User.query.delete()
-        db.session.commit()
-        db.drop_all()
-        self.app_context.pop()
-
     def test_user_model(self):
         """ Does basic model, non signup or auth"""
 
@@ -92,4 +80,32 @@ class UserModelTestCase(TestCase):
             User.signup("testtest", "email@test.com", "")
         
         with self.assertRaises(ValueError) as context:
-            User.signup("testtest", "email@test.com", None)
\ No newline at end of file
+            User.signup("testtest", "email@test.com", None)
+
+    def test_replace_anime_list(self):
+        # setUp's user belongs to the session from before the app context was pushed
+        self.user = User.query.filter_by(username='testuser').one()
+
+        self.user.replace_anime_list({1: {'status': 'COMPLETED', 'score': 9}, 3: {'status': 'CURRENT', 'score': 0}})
+        db.session.commit()
+        self.assertTrue(self.user.has_anime_list())
+        self.assertEqual(self.user.anime_list_entries([3, 4]), {3: {'status': 'CURRENT', 'score': 0}})
+
+        # A refresh swaps the whole list
+        self.user.replace_anime_list({4: {'status': 'CURRENT', 'score': 7}})
+        db.session.commit()
+        self.assertEqual(self.user.anime_list, {4: {'status': 'CURRENT', 'score': 7}})
+        self.assertEqual(UserListEntry.query.count(), 1)
+
+    def test_migrate_pickled_anime_lists(self):
+        self.user = User.query.filter_by(username='testuser').one()
+        self.user.legacy_anime_list = {1: {'status': 'COMPLETED', 'score': 9}}
+        db.session.commit()
+        self.assertFalse(self.user.has_anime_list())
+
+        self.assertEqual(migrate_pickled_anime_lists(), 1)
+        self.assertEqual(self.user.anime_list, {1: {'status': 'COMPLETED', 'score': 9}})
+        self.assertIsNone(self.user.legacy_anime_list)
+
+        # Nothing left to move the second time around
+        self.assertEqual(migrate_pickled_anime_lists(), 0)
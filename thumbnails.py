@@ -0,0 +1,243 @@
+"""Image proxy for AniList artwork, downsized thumbnails cached on disk
+
+Cards render covers and character art at ~150px but AniList's large images are 2-3x that,
+and every page view pulls them from the CDN again. /img/<width>?url=... fetches the
+original once, shrinks it to width, re-encodes it (WebP if the browser takes it, else JPEG)
+and keeps the result in IMAGE_PROXY_FOLDER for next time.
+
+The folder is capped at IMAGE_PROXY_MAX_BYTES, the least recently served thumbnails are
+deleted first. Only hosts in IMAGE_PROXY_HOSTS are fetched so this can't be used as an open
+proxy, tests add the local fixture server (fake_anilist.py serves images too).
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from urllib.parse import urlsplit
+
+import requests
+from PIL import Image, UnidentifiedImageError
+
+import metrics
+from singleflight import SingleFlight
+
+
+FORMATS = {
+    'webp': ('WEBP', 'image/webp', '.webp'),
+    'jpeg': ('JPEG', 'image/jpeg', '.jpg'),
+}
+# Tallest thumbnail we'll make, in widths. Covers are ~1.5, character art about the same.
+MAX_ASPECT = 3
+
+_cache = None
+_session = None
+_lock = threading.Lock()
+_flights = SingleFlight()
+
+
+class ImageProxyError(Exception):
+    """The original couldn't be fetched or isn't an image"""
+
+
+class ThumbnailCache(object):
+    """Folder of thumbnails kept under max_bytes, least recently used deleted first.
+
+    Safe to share between threads. Several processes can share the folder too, each keeps
+    its own idea of what's in there and a file another process deleted is just a miss.
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._lock = threading.Lock()
+        # name -> bytes, least recently used first
+        self._files = OrderedDict()
+
+        os.makedirs(folder, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        """Pick up what's already on disk (from before a restart), oldest first"""
+
+        found = []
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _, name, size in sorted(found):
+            self._files[name] = size
+            self.size += size
+        self._evict()
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def get(self, name):
+        """Path of the cached thumbnail, None on a miss"""
+
+        with self._lock:
+            if name not in self._files:
+                return None
+            self._files.move_to_end(name)
+
+        path = self.path(name)
+        try:
+            # mtime is the recency after a restart
+            os.utime(path)
+        except FileNotFoundError:
+            self._forget(name)
+            return None
+        return path
+
+    def put(self, name, data):
+        """Store a thumbnail, returns its path"""
+
+        path = self.path(name)
+        tmp_path = os.path.join(self.folder, f'.{name}.{threading.get_ident()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self.size += len(data) - self._files.pop(name, 0)
+            self._files[name] = len(data)
+            self._evict()
+        return path
+
+    def _forget(self, name):
+        with self._lock:
+            self.size -= self._files.pop(name, 0)
+
+    def _evict(self):
+        # Caller holds the lock (or is __init__). Never evicts the newest file, even if it's
+        # bigger than the whole budget on its own.
+        while self.size > self.max_bytes and len(self._files) > 1:
+            name, size = self._files.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+
+
+def get_thumbnail_cache(app):
+    """Grab the process wide ThumbnailCache, creating it on first use"""
+    global _cache
+
+    if _cache is None:
+        with _lock:
+            if _cache is None:
+                _cache = ThumbnailCache(app.config['IMAGE_PROXY_FOLDER'], app.config.get('IMAGE_PROXY_MAX_BYTES', 256 * 1024 * 1024))
+    return _cache
+
+
+def get_session():
+    """Pooled session for image fetches, separate from the AniList API one (different host, headers)"""
+    global _session
+
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = requests.Session()
+    return _session
+
+
+def reset_thumbnail_cache():
+    """Drop the cache index and upstream session (next request builds fresh ones). Files stay on disk."""
+    global _cache, _session
+
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _cache = None
+        _session = None
+
+
+def allowed_url(url, app):
+    """Is url an http(s) image on a host we proxy?"""
+
+    parts = urlsplit(url)
+    return parts.scheme in ('http', 'https') and parts.hostname in app.config.get('IMAGE_PROXY_HOSTS', ())
+
+
+def thumbnail_name(url, width, fmt):
+    return hashlib.sha256(f'{url}|{width}'.encode('utf-8')).hexdigest() + FORMATS[fmt][2]
+
+
+def fetch_original(url, app):
+    """Bytes of the original image, raises ImageProxyError"""
+
+    max_bytes = app.config.get('IMAGE_PROXY_MAX_SOURCE_BYTES', 10 * 1024 * 1024)
+
+    try:
+        # No redirects, they could point anywhere
+        with get_session().get(url, stream=True, allow_redirects=False, timeout=(
+                app.config.get('ANILIST_CONNECT_TIMEOUT', 3.05), app.config.get('ANILIST_READ_TIMEOUT', 10))) as resp:
+            if resp.status_code != 200:
+                raise ImageProxyError(f'{url} returned {resp.status_code}')
+
+            data = resp.raw.read(max_bytes + 1, decode_content=True)
+    except requests.RequestException as e:
+        raise ImageProxyError(f'{url} failed: {e}') from e
+
+    if len(data) > max_bytes:
+        raise ImageProxyError(f'{url} is over {max_bytes} bytes')
+    return data
+
+
+def make_thumbnail(data, width, fmt, quality=80, max_pixels=None):
+    """Shrink image bytes to width (never enlarging) and encode them as fmt.
+
+    Images over max_pixels are refused before they're decoded, a few KB of PNG can
+    decode to gigabytes.
+    """
+
+    try:
+        image = Image.open(BytesIO(data))
+        # Only the header has been read so far
+        if max_pixels and image.size[0] * image.size[1] > max_pixels:
+            raise ImageProxyError(f'Image is {image.size[0]}x{image.size[1]}, over {max_pixels} pixels')
+        # JPEGs can decode straight at a fraction of their size, much faster than a full decode
+        image.draft('RGB', (width, width * MAX_ASPECT))
+        image.thumbnail((width, width * MAX_ASPECT), Image.LANCZOS)
+    # PIL's own size check (Image.MAX_IMAGE_PIXELS) raises DecompressionBombError, which isn't an OSError
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise ImageProxyError(f'Not an image: {e}') from e
+
+    pil_format = FORMATS[fmt][0]
+    if pil_format == 'JPEG' or image.mode not in ('RGB', 'RGBA'):
+        has_alpha = pil_format != 'JPEG' and ('A' in image.mode or 'transparency' in image.info)
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+
+    out = BytesIO()
+    image.save(out, pil_format, quality=quality)
+    return out.getvalue()
+
+
+def thumbnail(url, width, fmt, app):
+    """Path of the cached width px thumbnail of url, made on a miss. Raises ImageProxyError."""
+
+    cache = get_thumbnail_cache(app)
+    name = thumbnail_name(url, width, fmt)
+
+    path = cache.get(name)
+    metrics.record_cache('thumbnails', 'hit' if path else 'miss')
+    if path:
+        return path
+
+    def make():
+        app.logger.debug('Thumbnail miss, fetching %s', url)
+        data = make_thumbnail(fetch_original(url, app), width, fmt, app.config.get('IMAGE_PROXY_QUALITY', 80),
+                              app.config.get('IMAGE_PROXY_MAX_SOURCE_PIXELS'))
+        return cache.put(name, data)
+
+    # A page of cards can ask for the same image a few times at once, fetch it once
+    return _flights.do(name, make)
+
+
+def mimetype(fmt):
+    return FORMATS[fmt][1]
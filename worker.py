@@ -0,0 +1,21 @@
+"""Background worker, runs the jobs queued in the jobs table (see jobs.py)
+
+    python worker.py          # keep polling for jobs
+    python worker.py --once   # run whatever is queued, then exit
+
+Run as many as you like against the same database.
+"""
+
+import argparse
+
+from app import app
+from jobs import run_worker
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run queued background jobs')
+    parser.add_argument('--once', action='store_true', help='exit once the queue is empty')
+    args = parser.parse_args()
+
+    ran = run_worker(app, once=args.once)
+    print(f'Ran {ran} jobs')